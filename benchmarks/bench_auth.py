@@ -0,0 +1,50 @@
+"""Measure the authentication cost per request before and after the verified credentials cache.
+
+"before" builds a new PasswordHasher and runs Argon2 verify for every request, as
+receive_backup used to do. "after" uses auth.verify_password with the cache enabled.
+
+Usage:
+    python benchmarks/bench_auth.py --requests 50
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from argon2 import PasswordHasher
+
+import harness
+from ddmail_backup_receiver import create_app
+from ddmail_backup_receiver.auth import verify_password
+
+
+def main() -> None:
+    """Run the benchmark and print the mean auth time per request."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=50, help="number of verifications per case")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config_file = os.path.join(tmp, "config.toml")
+        harness.write_config(config_file, tmp)
+        os.environ["MODE"] = "TESTING"
+        app = create_app(config_file=config_file)
+        password_hash = app.config["PASSWORD_HASH"]
+
+        start = time.perf_counter()
+        for _ in range(args.requests):
+            PasswordHasher().verify(password_hash, harness.PASSWORD)
+        before = (time.perf_counter() - start) / args.requests
+
+        with app.app_context():
+            start = time.perf_counter()
+            for _ in range(args.requests):
+                verify_password(harness.PASSWORD)
+            after = (time.perf_counter() - start) / args.requests
+
+    print(f"before (new hasher + argon2 every request): {before * 1000:10.3f} ms/request")
+    print(f"after (shared hasher + verified cache):     {after * 1000:10.3f} ms/request")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""Benchmark the checksum algorithms in GB/s per number of threads.
+
+Hashes generated data from memory in 1 MiB updates, as the upload endpoints do,
+with every available algorithm from checksums.available_algorithms. sha256 always
+runs in one thread, sha256-tree and blake3 with every thread count in --threads.
+
+Usage:
+    python benchmarks/bench_checksums.py --size-mb 2048 --threads 1,2,4,8
+"""
+import argparse
+import hashlib
+import time
+
+from ddmail_backup_receiver import checksums
+
+
+def run(algorithm: str, threads: int, block: bytes, blocks: int) -> float:
+    """Hash blocks copies of block and return the seconds it took."""
+    start = time.perf_counter()
+    hasher = checksums.new_hasher(algorithm, threads)
+    for _ in range(blocks):
+        hasher.update(block)
+    hasher.hexdigest()
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    """Run the benchmark and print GB/s per algorithm and thread count."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=2048, help="MiB of data to hash per run")
+    parser.add_argument("--threads", default="1,2,4,8", help="comma separated thread counts")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs per case, best is reported")
+    args = parser.parse_args()
+
+    block = hashlib.shake_256(b"ddmail").digest(1024 * 1024)
+    size = args.size_mb * 1024 * 1024
+    for algorithm in checksums.available_algorithms():
+        thread_counts = [1] if algorithm == checksums.DEFAULT_ALGORITHM else [int(x) for x in args.threads.split(",")]
+        for threads in thread_counts:
+            best = min(run(algorithm, threads, block, args.size_mb) for _ in range(args.repeat))
+            print(f"{algorithm:12} threads={threads:<3} {size / 1e9 / best:6.2f} GB/s ({best:.3f}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Benchmark zstd compression on ingest, MB/s and ratio per compression level.
+
+The test upload is generated mail like text, with a part of random bytes for
+attachments that is already compressed, or read from --input to use a real backup.
+Every level is run with the compression in the calling thread (threads=0) and with
+zstd worker threads, and compared with the uncompressed save_and_sha256.
+
+Usage:
+    PYTHONPATH=src python benchmarks/bench_compression.py --size-mb 512 --levels 1,3,6,9
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from ddmail_backup_receiver.application import save_and_sha256
+from ddmail_backup_receiver.compression import save_zstd_and_sha256
+
+# Words used to generate the text part of the test upload.
+WORDS = (b"the backup mail server message from to subject received by with id for date "
+         b"postfix smtpd dovecot imap login user example com se hello regards meeting "
+         b"tomorrow invoice attached please find report 2026 10 18 12 00 01").split()
+
+
+def generate_upload(path: str, size: int, random_fraction: float, rng: random.Random) -> None:
+    """Write size bytes of text lines mixed with blocks of random bytes to path."""
+    written = 0
+    with open(path, 'wb') as f:
+        while written < size:
+            if rng.random() < random_fraction:
+                block = rng.randbytes(65536)
+            else:
+                lines = []
+                for _ in range(1000):
+                    lines.append(b" ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 14))))
+                block = b"\n".join(lines) + b"\n"
+            f.write(block)
+            written += len(block)
+
+
+def main() -> None:
+    """Run the benchmark and print MB/s and ratio per level and thread setting."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=256, help="size of the generated upload in MB")
+    parser.add_argument("--random-fraction", type=float, default=0.3, help="fraction of the upload that is random bytes")
+    parser.add_argument("--input", default=None, help="use this file as upload instead of generated data")
+    parser.add_argument("--levels", default="1,3,6,9,12", help="comma separated zstd levels")
+    parser.add_argument("--threads", default="0,-1", help="comma separated zstd thread settings")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the generated data")
+    parser.add_argument("--dir", default=None, help="folder to write test files to")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(dir=args.dir)
+    try:
+        src = args.input
+        if src is None:
+            src = os.path.join(work_dir, "upload.bin")
+            generate_upload(src, args.size_mb * 1024 * 1024, args.random_fraction, random.Random(args.seed))
+        size_mb = os.path.getsize(src) / 1024 / 1024
+        dst = os.path.join(work_dir, "saved")
+
+        with open(src, 'rb') as f:
+            start = time.perf_counter()
+            save_and_sha256(f, dst, 1048576)
+            elapsed = time.perf_counter() - start
+        print(f"{'plain':>5} {'':>7} {size_mb / elapsed:10.1f} MB/s in {size_mb / elapsed:10.1f} MB/s out  ratio 1.00")
+
+        for level in [int(x) for x in args.levels.split(",")]:
+            for threads in [int(x) for x in args.threads.split(",")]:
+                with open(src, 'rb') as f:
+                    start = time.perf_counter()
+                    save_zstd_and_sha256(f, dst, level, threads)
+                    elapsed = time.perf_counter() - start
+                out_mb = os.path.getsize(dst) / 1024 / 1024
+                print(f"{'zstd':>5} l={level:<2} t={threads:<2} {size_mb / elapsed:8.1f} MB/s in "
+                      f"{out_mb / elapsed:10.1f} MB/s out  ratio {size_mb / out_mb:.2f}")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
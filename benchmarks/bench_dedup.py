@@ -0,0 +1,117 @@
+"""Benchmark ingest throughput and dedup ratio of the dedup storage mode.
+
+A random base backup is changed a little every day, with inserts, deletes and
+overwrites at random places, like a database dump that mostly stays the same. Every
+day is ingested with save_dedup and with save_and_sha256 (plain mode) and the oldest
+backup is removed when more than --keep backups is stored, like delete_old_backups.
+
+Usage:
+    PYTHONPATH=src python benchmarks/bench_dedup.py --size-mb 512 --days 14 --change 0.05
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from ddmail_backup_receiver import dedup
+from ddmail_backup_receiver.application import save_and_sha256
+
+
+def change_data(data: bytes, fraction: float, max_edit: int, rng: random.Random) -> bytes:
+    """Return data with about fraction of it inserted, deleted or overwritten in edits of 4 KiB to max_edit bytes."""
+    data = bytearray(data)
+    changed = 0
+    while changed < len(data) * fraction:
+        size = rng.randint(4096, max_edit)
+        pos = rng.randrange(len(data))
+        kind = rng.choice(["insert", "delete", "overwrite"])
+        if kind == "insert":
+            data[pos:pos] = rng.randbytes(size)
+        elif kind == "delete":
+            del data[pos:pos + size]
+        else:
+            data[pos:pos + size] = rng.randbytes(len(data[pos:pos + size]))
+        changed += size
+    return bytes(data)
+
+
+def folder_size(folder: str) -> int:
+    """Return the total size of the files in folder."""
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(folder) for name in files)
+
+
+def main() -> None:
+    """Run the benchmark and print throughput and disc usage per day."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=256, help="size of the base backup in MB")
+    parser.add_argument("--days", type=int, default=10, help="number of daily backups to ingest")
+    parser.add_argument("--change", type=float, default=0.05, help="fraction of the backup changed per day")
+    parser.add_argument("--edit-kb", type=int, default=1024, help="max size of one edit in KiB, small edits spread the change")
+    parser.add_argument("--keep", type=int, default=7, help="number of backups to save")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the generated data")
+    parser.add_argument("--dir", default=None, help="folder to write test files to")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    work_dir = tempfile.mkdtemp(dir=args.dir)
+    try:
+        dedup_folder = os.path.join(work_dir, "dedup")
+        plain_folder = os.path.join(work_dir, "plain")
+        os.makedirs(dedup_folder)
+        os.makedirs(plain_folder)
+        store = dedup.chunk_store_folder(dedup_folder)
+        db_path = os.path.join(work_dir, "index.sqlite")
+        src = os.path.join(work_dir, "upload.bin")
+
+        data = b"".join(rng.randbytes(1024 * 1024) for _ in range(args.size_mb))
+        manifests = []
+        plain_files = []
+        total_bytes = 0
+        total_dedup = 0.0
+        total_plain = 0.0
+
+        print(f"{'day':>3} {'dedup MB/s':>10} {'plain MB/s':>10} {'dedup MB':>9} {'plain MB':>9} {'ratio':>6}")
+        for day in range(args.days):
+            if day > 0:
+                data = change_data(data, args.change, args.edit_kb * 1024, rng)
+            with open(src, 'wb') as f:
+                f.write(data)
+
+            manifest_path = os.path.join(dedup_folder, "backup" + str(day) + dedup.MANIFEST_SUFFIX)
+            with open(src, 'rb') as f:
+                start = time.perf_counter()
+                dedup.save_dedup(f, store, db_path, manifest_path)
+                dedup_time = time.perf_counter() - start
+            manifests.append(manifest_path)
+
+            plain_path = os.path.join(plain_folder, "backup" + str(day))
+            with open(src, 'rb') as f:
+                start = time.perf_counter()
+                save_and_sha256(f, plain_path, 1048576)
+                plain_time = time.perf_counter() - start
+            plain_files.append(plain_path)
+
+            # Retention, as delete_old_backups does with BACKUPS_TO_SAVE.
+            while len(manifests) > args.keep:
+                dedup.remove_manifest(store, db_path, manifests.pop(0))
+                os.remove(plain_files.pop(0))
+
+            mb = len(data) / 1024 / 1024
+            total_bytes += len(data)
+            total_dedup += dedup_time
+            total_plain += plain_time
+            dedup_size = folder_size(dedup_folder) / 1024 / 1024
+            plain_size = folder_size(plain_folder) / 1024 / 1024
+            print(f"{day:3} {mb / dedup_time:10.1f} {mb / plain_time:10.1f} "
+                  f"{dedup_size:9.1f} {plain_size:9.1f} {plain_size / dedup_size:6.2f}")
+
+        total_mb = total_bytes / 1024 / 1024
+        print(f"ingest: dedup {total_mb / total_dedup:.1f} MB/s, plain {total_mb / total_plain:.1f} MB/s")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""Load test the upload path under gunicorn and save the results as JSON.
+
+For every combination of worker class, body size and concurrency a new gunicorn
+server is started with the application from create_app. Then concurrency clients
+upload --requests bodies in total to /receive_backup, or to /receive_backup_stream
+with --endpoint stream. Bodies are generated data or zeros like a sparse file. The
+throughput, p50 and p99 latency, peak RSS of the gunicorn processes and CPU seconds
+per request is reported and saved to --output, which can be compared with the
+results of an earlier release with --baseline.
+
+Usage:
+    python benchmarks/bench_load.py --sizes 1K,1M,100M --concurrency 1,4,16 \\
+        --worker-classes sync,gthread --output results.json --baseline old.json
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import threading
+import time
+
+import harness
+
+# Difference in percent from the baseline that is reported as a regression.
+REGRESSION_PERCENT = 10
+
+
+def percentile(values: list, p: float) -> float:
+    """Return the p percentile of values with the nearest rank method."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def git_commit() -> str:
+    """Return the commit the benchmark is run on, or None outside of a git repository."""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_case(args, worker_class: str, size_name: str, concurrency: int) -> dict:
+    """Start a server and upload args.requests bodies of size_name with concurrency clients."""
+    size = harness.parse_size(size_name)
+    if args.body == "zero":
+        blocks, sha256 = harness.zero_body(size)
+    else:
+        blocks, sha256 = harness.generated_body(size)
+    post = harness.post_raw if args.endpoint == "stream" else harness.post_multipart
+
+    threads = args.threads if worker_class == "gthread" else 1
+    with harness.gunicorn_server(workers=args.workers, worker_class=worker_class, threads=threads,
+                                 work_dir=args.dir) as server:
+        # Warm up the workers with parallel uploads, so the first Argon2 verification in
+        # every worker process is not measured. The verified password is cached per process.
+        empty_blocks, empty_sha256 = harness.zero_body(0)
+        warmup = [threading.Thread(target=post, args=(server["host"], server["port"], "warmup-" + str(i) + ".bin",
+                                                      0, empty_blocks, empty_sha256))
+                  for i in range(args.workers * threads * 2)]
+        for thread in warmup:
+            thread.start()
+        for thread in warmup:
+            thread.join()
+
+        pids = harness.process_tree(server["process"].pid)
+        cpu_before = harness.cpu_seconds(pids)
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+        next_request = iter(range(args.requests))
+
+        def client():
+            while True:
+                with lock:
+                    i = next(next_request, None)
+                if i is None:
+                    return
+                start = time.perf_counter()
+                try:
+                    response = post(server["host"], server["port"], "load-" + str(i) + ".bin", size, blocks, sha256)
+                except OSError as e:
+                    response = str(e).encode()
+                elapsed = time.perf_counter() - start
+                with lock:
+                    if response == b"done":
+                        latencies.append(elapsed)
+                    else:
+                        errors.append(response.decode('utf-8', 'replace')[:200])
+
+        start = time.perf_counter()
+        clients = [threading.Thread(target=client) for _ in range(concurrency)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        wall = time.perf_counter() - start
+
+        cpu = harness.cpu_seconds(pids) - cpu_before
+        rss = harness.peak_rss(harness.process_tree(server["process"].pid))
+
+    done = len(latencies)
+    return {
+        "worker_class": worker_class,
+        "workers": args.workers,
+        "threads": threads,
+        "endpoint": args.endpoint,
+        "body": args.body,
+        "size": size,
+        "size_name": size_name,
+        "concurrency": concurrency,
+        "requests": args.requests,
+        "errors": len(errors),
+        "error_samples": sorted(set(errors))[:5],
+        "wall_seconds": wall,
+        "requests_per_second": done / wall,
+        "throughput_mb_per_second": done * size / 1024 / 1024 / wall,
+        "latency_p50_seconds": percentile(latencies, 50) if latencies else None,
+        "latency_p99_seconds": percentile(latencies, 99) if latencies else None,
+        "peak_rss_max_bytes": rss["max"],
+        "peak_rss_sum_bytes": rss["sum"],
+        "cpu_seconds_per_request": cpu / done if done else None,
+    }
+
+
+def case_key(result: dict) -> tuple:
+    """Return what identifies a case when results are compared."""
+    return (result["worker_class"], result["workers"], result["threads"], result["endpoint"], result["body"],
+            result["size"], result["concurrency"])
+
+
+def compare(results: list, baseline_path: str) -> None:
+    """Print the change of throughput and p99 latency of every case against a baseline result file."""
+    with open(baseline_path) as f:
+        baseline = {case_key(result): result for result in json.load(f)["results"]}
+
+    print("compared with " + baseline_path)
+    for result in results:
+        old = baseline.get(case_key(result))
+        if old is None or not old["throughput_mb_per_second"] or not old["latency_p99_seconds"] \
+                or result["latency_p99_seconds"] is None:
+            continue
+        throughput = (result["throughput_mb_per_second"] / old["throughput_mb_per_second"] - 1) * 100
+        p99 = (result["latency_p99_seconds"] / old["latency_p99_seconds"] - 1) * 100
+        flag = "  REGRESSION" if throughput < -REGRESSION_PERCENT or p99 > REGRESSION_PERCENT else ""
+        print(f"{result['worker_class']:8} {result['size_name']:>5} c={result['concurrency']:<3}"
+              f" throughput {throughput:+6.1f}%  p99 {p99:+6.1f}%{flag}")
+
+
+def main() -> None:
+    """Run every case, print a line per case and save the results."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1K,1M,100M", help="comma separated body sizes, 1K to 10G")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma separated number of parallel clients")
+    parser.add_argument("--worker-classes", default="sync,gthread", help="comma separated gunicorn worker classes")
+    parser.add_argument("--workers", type=int, default=4, help="number of gunicorn workers")
+    parser.add_argument("--threads", type=int, default=4, help="threads per worker for gthread")
+    parser.add_argument("--requests", type=int, default=32, help="number of uploads per case")
+    parser.add_argument("--endpoint", choices=["form", "stream"], default="form",
+                        help="form uploads to /receive_backup, stream to /receive_backup_stream")
+    parser.add_argument("--body", choices=["generated", "zero"], default="generated",
+                        help="generated data or zeros like a sparse file")
+    parser.add_argument("--output", default="bench_load.json", help="file to save the results to")
+    parser.add_argument("--baseline", default=None, help="results of an earlier run to compare with")
+    parser.add_argument("--dir", default=None, help="folder to run the server in")
+    args = parser.parse_args()
+
+    results = []
+    for worker_class in args.worker_classes.split(","):
+        for size_name in args.sizes.split(","):
+            for concurrency in [int(x) for x in args.concurrency.split(",")]:
+                result = run_case(args, worker_class, size_name, concurrency)
+                results.append(result)
+                p50 = result["latency_p50_seconds"] or 0
+                p99 = result["latency_p99_seconds"] or 0
+                cpu = result["cpu_seconds_per_request"] or 0
+                print(f"{worker_class:8} {size_name:>5} c={concurrency:<3}"
+                      f" {result['throughput_mb_per_second']:9.1f} MB/s {result['requests_per_second']:8.1f} req/s"
+                      f" p50 {p50 * 1000:9.1f} ms p99 {p99 * 1000:9.1f} ms"
+                      f" rss {result['peak_rss_max_bytes'] / 1024 / 1024:7.1f} MB"
+                      f" cpu {cpu * 1000:8.1f} ms/req errors {result['errors']}")
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "args": vars(args),
+            "results": results,
+        }, f, indent=2)
+    print("saved results to " + args.output)
+
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
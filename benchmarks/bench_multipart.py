@@ -0,0 +1,118 @@
+"""Benchmark a multipart upload sent as 1 part against N parts in parallel.
+
+Starts the application under gunicorn with one sync worker per connection and
+uploads a generated body with /multipart/create, /multipart/part and
+/multipart/complete. On localhost one TCP stream is not limited by latency, so
+--rate-mb can cap the speed of every connection to simulate a link where one
+stream is limited by its window and the round trip time.
+
+Usage:
+    python benchmarks/bench_multipart.py --size 1G --parts 1,4,8 --rate-mb 20
+"""
+import argparse
+import hashlib
+import http.client
+import threading
+import time
+import urllib.parse
+
+import harness
+
+
+def post_form(host: str, port: int, path: str, fields: dict) -> bytes:
+    """Post a urlencoded form and return the response body."""
+    conn = http.client.HTTPConnection(host, port, timeout=3600)
+    conn.request("POST", path, urllib.parse.urlencode(fields), {"Content-Type": "application/x-www-form-urlencoded"})
+    response = conn.getresponse().read()
+    conn.close()
+    return response
+
+
+def send_part(host: str, port: int, upload_id: str, part_number: int, size: int, blocks, sha256: str,
+              rate: float) -> None:
+    """Send one part, at most rate bytes per second if rate is set."""
+    conn = http.client.HTTPConnection(host, port, timeout=3600)
+    conn.putrequest("POST", "/multipart/part")
+    conn.putheader("Content-Type", "application/octet-stream")
+    conn.putheader("Content-Length", str(size))
+    conn.putheader("X-Password", harness.PASSWORD)
+    conn.putheader("X-Upload-Id", upload_id)
+    conn.putheader("X-Part-Number", str(part_number))
+    conn.putheader("X-Sha256", sha256)
+    conn.endheaders()
+    start = time.perf_counter()
+    sent = 0
+    for data in blocks():
+        for i in range(0, len(data), 65536):
+            conn.send(data[i:i + 65536])
+            sent += len(data[i:i + 65536])
+            if rate:
+                delay = sent / rate - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+    response = conn.getresponse().read()
+    conn.close()
+    if b"part_number" not in response:
+        raise RuntimeError("part " + str(part_number) + " failed: " + response.decode())
+
+
+def upload(host: str, port: int, size: int, parts: int, rate: float) -> float:
+    """Upload size bytes as parts parts in parallel and return the seconds it took."""
+    part_size = -(-size // parts)
+    bodies = []
+    sha256 = hashlib.sha256()
+    for i in range(parts):
+        part_bytes = min(part_size, size - i * part_size)
+        blocks, part_sha256 = harness.generated_body(part_bytes, b"ddmail" + str(i).encode())
+        for data in blocks():
+            sha256.update(data)
+        bodies.append((part_bytes, blocks, part_sha256))
+
+    start = time.perf_counter()
+    response = post_form(host, port, "/multipart/create", {
+        "password": harness.PASSWORD, "filename": "bench.bin", "sha256": sha256.hexdigest(),
+    })
+    upload_id = response.decode().split('"upload_id":"')[1].split('"')[0]
+
+    threads = []
+    for i, (part_bytes, blocks, part_sha256) in enumerate(bodies):
+        thread = threading.Thread(target=send_part, args=(host, port, upload_id, i + 1, part_bytes, blocks,
+                                                          part_sha256, rate))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    sent = time.perf_counter()
+
+    response = post_form(host, port, "/multipart/complete", {
+        "password": harness.PASSWORD, "upload_id": upload_id, "parts": str(parts),
+    })
+    if response != b"done":
+        raise RuntimeError("complete failed: " + response.decode())
+    end = time.perf_counter()
+    print(f"    parts sent in {sent - start:.3f}s, complete took {end - sent:.3f}s")
+    return end - start
+
+
+def main() -> None:
+    """Run the benchmark and print MB/s per number of parts."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", default="1G", help="size of the upload")
+    parser.add_argument("--parts", default="1,4,8", help="comma separated number of parallel parts")
+    parser.add_argument("--rate-mb", type=float, default=0, help="max MB/s per connection, 0 is no limit")
+    parser.add_argument("--dir", default=None, help="folder to run the server in")
+    args = parser.parse_args()
+
+    size = harness.parse_size(args.size)
+    counts = [int(x) for x in args.parts.split(",")]
+    rate = args.rate_mb * 1024 * 1024
+
+    with harness.gunicorn_server(workers=max(counts) + 1, work_dir=args.dir) as server:
+        for parts in counts:
+            print(f"parts={parts}")
+            elapsed = upload(server["host"], server["port"], size, parts, rate)
+            print(f"    {size / 1024 / 1024 / elapsed:10.1f} MB/s ({elapsed:.3f}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Benchmark save-then-hash against hashing while the upload streams to disc.
+
+The old receive_backup flow saved the upload with FileStorage.save and then read
+the whole file again with sha256_of_file. save_and_sha256 hashes the data while it
+is written. The source file simulates the spooled multipart upload.
+
+Usage:
+    python benchmarks/bench_save_and_hash.py --size-mb 1024 --repeat 3
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from ddmail_backup_receiver.application import sha256_of_file, save_and_sha256
+
+
+def drop_cache(path: str) -> None:
+    """Ask the kernel to drop cached pages of path, so reads hit the disc."""
+    with open(path, 'rb') as f:
+        os.fsync(f.fileno())
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def save_then_hash(src: str, dst: str, buf_size: int, cold: bool) -> str:
+    """The old flow: copy the stream to disc, then read the saved file again."""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        shutil.copyfileobj(fsrc, fdst, buf_size)
+    if cold:
+        drop_cache(dst)
+    return sha256_of_file(dst)
+
+
+def stream_and_hash(src: str, dst: str, buf_size: int, cold: bool) -> str:
+    """The new flow: hash the data while it is written to disc."""
+    with open(src, 'rb') as fsrc:
+        return save_and_sha256(fsrc, dst, buf_size)
+
+
+def main() -> None:
+    """Run the benchmark and print MB/s for every flow and chunk size."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=256, help="size of the test upload in MB")
+    parser.add_argument("--chunk-sizes", default="16384,65536,1048576", help="comma separated chunk sizes")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs per case, best is reported")
+    parser.add_argument("--cold", action="store_true", help="drop the page cache before re-reading the saved file")
+    parser.add_argument("--dir", default=None, help="folder to write test files to")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(dir=args.dir)
+    try:
+        src = os.path.join(work_dir, "upload.bin")
+        with open(src, 'wb') as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(1024 * 1024))
+        dst = os.path.join(work_dir, "saved.bin")
+
+        for buf_size in [int(x) for x in args.chunk_sizes.split(",")]:
+            for name, flow in [("save_then_hash", save_then_hash), ("stream_and_hash", stream_and_hash)]:
+                best = None
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    flow(src, dst, buf_size, args.cold)
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                print(f"{name:16} chunk={buf_size:8} {args.size_mb / best:10.1f} MB/s ({best:.3f}s)")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
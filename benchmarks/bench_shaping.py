@@ -0,0 +1,74 @@
+"""Show how RATE_LIMIT_MB is shared between concurrent uploads under gunicorn.
+
+Starts a server with the global limit --rate-mb and uploads --size bytes from
+--senders clients at the same time to /receive_backup_stream. With --slow-mb one
+more client sends at most that many MB/s, to show that what it do not use is shared
+by the others. Prints the throughput of every sender, the total and Jain's fairness
+index of the fast senders, 1.0 is a perfectly fair share. The time of an upload
+also includes authentication and saving, so the rates is a bit below the limit.
+
+Usage:
+    python benchmarks/bench_shaping.py --rate-mb 40 --senders 4 --size 100M --slow-mb 2
+"""
+import argparse
+import threading
+import time
+
+import harness
+
+
+def paced(blocks, rate: float):
+    """Return a function that yields the blocks of blocks at most rate bytes per second."""
+    def paced_blocks():
+        start = time.perf_counter()
+        sent = 0
+        for data in blocks():
+            time.sleep(max(0.0, start + sent / rate - time.perf_counter()))
+            yield data
+            sent += len(data)
+    return paced_blocks
+
+
+def main() -> None:
+    """Run the senders and print their throughput."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rate-mb", type=float, default=40, help="RATE_LIMIT_MB of the server")
+    parser.add_argument("--senders", type=int, default=4, help="number of clients that send as fast as they can")
+    parser.add_argument("--size", default="100M", help="body size of every upload, 1K to 10G")
+    parser.add_argument("--slow-mb", type=float, default=0, help="MB/s of one more slow client, 0 is none")
+    parser.add_argument("--workers", type=int, default=4, help="number of gunicorn workers")
+    parser.add_argument("--dir", default=None, help="folder to run the server in")
+    args = parser.parse_args()
+
+    size = harness.parse_size(args.size)
+    blocks, sha256 = harness.zero_body(size)
+    senders = [("fast-" + str(i), blocks) for i in range(args.senders)]
+    if args.slow_mb:
+        senders.append(("slow", paced(blocks, args.slow_mb * 1024 * 1024)))
+
+    results = {}
+    with harness.gunicorn_server(workers=max(args.workers, len(senders)), worker_class="sync",
+                                 extra_config={"RATE_LIMIT_MB": args.rate_mb}, work_dir=args.dir) as server:
+        def send(name, sender_blocks):
+            start = time.perf_counter()
+            response = harness.post_raw(server["host"], server["port"], name + ".bin", size, sender_blocks, sha256)
+            results[name] = (response, time.perf_counter() - start)
+
+        threads = [threading.Thread(target=send, args=sender) for sender in senders]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    rates = {}
+    for name, (response, seconds) in sorted(results.items()):
+        rates[name] = size / 1024 / 1024 / seconds
+        print(f"{name:8} {rates[name]:8.2f} MB/s {seconds:7.2f}s {response.decode('utf-8', 'replace')[:60]}")
+
+    fast = [rate for name, rate in rates.items() if name.startswith("fast-")]
+    print(f"limit {args.rate_mb:.2f} MB/s, fast senders {sum(fast):.2f} MB/s together")
+    print(f"fairness {sum(fast) ** 2 / (len(fast) * sum(rate ** 2 for rate in fast)):.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+"""Compare upload throughput of multipart /receive_backup and raw body /receive_backup_stream.
+
+Starts the application under gunicorn and uploads generated bodies of every size
+to both endpoints.
+
+Usage:
+    python benchmarks/bench_stream_upload.py --sizes 1M,1G,10G
+"""
+import argparse
+import time
+
+import harness
+
+
+def main() -> None:
+    """Run the benchmark and print MB/s per endpoint and body size."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1M,1G,10G", help="comma separated body sizes")
+    parser.add_argument("--repeat", type=int, default=3, help="number of uploads per case, best is reported")
+    parser.add_argument("--dir", default=None, help="folder to run the server in")
+    args = parser.parse_args()
+
+    with harness.gunicorn_server(work_dir=args.dir) as server:
+        for size_name in args.sizes.split(","):
+            size = harness.parse_size(size_name)
+            blocks, sha256 = harness.generated_body(size)
+            for name, post in [("multipart", harness.post_multipart), ("raw", harness.post_raw)]:
+                best = None
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    response = post(server["host"], server["port"], "bench.bin", size, blocks, sha256)
+                    elapsed = time.perf_counter() - start
+                    if response != b"done":
+                        raise RuntimeError(name + " upload failed: " + response.decode())
+                    best = elapsed if best is None else min(best, elapsed)
+                print(f"{name:10} {size_name:>5} {size / 1024 / 1024 / best:10.1f} MB/s ({best:.3f}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""Helpers shared by the benchmarks to run the application under gunicorn and upload to it."""
+import contextlib
+import hashlib
+import http.client
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from argon2 import PasswordHasher
+
+# Password used by the benchmark server, 24 chars as required by the validators.
+PASSWORD = "benchmarkpassword1234567"
+
+# Size of the blocks the generated upload bodies are sent in.
+BLOCK_SIZE = 1024 * 1024
+
+
+def parse_size(size: str) -> int:
+    """Parse a size like 512, 64K, 1M or 10G into bytes."""
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    size = size.strip().upper()
+    if size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def free_port() -> int:
+    """Return a free TCP port on localhost."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def write_config(path: str, upload_folder: str, extra: dict = None) -> None:
+    """Write a TESTING mode config file for the benchmark server."""
+    lines = [
+        "[TESTING]",
+        "SECRET_KEY = 'benchmark'",
+        "PASSWORD_HASH = '" + PasswordHasher().hash(PASSWORD) + "'",
+        "UPLOAD_FOLDER = '" + upload_folder + "'",
+        "BACKUPS_TO_SAVE = 3",
+    ]
+    for key, value in (extra or {}).items():
+        lines.append(key + " = " + repr(value).replace("True", "true").replace("False", "false"))
+    lines += [
+        "[TESTING.LOGGING]",
+        "LOGLEVEL = 'ERROR'",
+        "LOG_TO_FILE = false",
+        "LOGFILE = '/dev/null'",
+        "LOG_TO_SYSLOG = false",
+        "SYSLOG_SERVER = '/dev/log'",
+    ]
+    with open(path, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+
+
+@contextlib.contextmanager
+def gunicorn_server(workers: int = 1, worker_class: str = "sync", threads: int = 1,
+                    extra_config: dict = None, work_dir: str = None):
+    """Start the application under gunicorn in a temporary folder.
+
+    Yields:
+        dict: host, port, upload_folder and the gunicorn process.
+    """
+    tmp = tempfile.mkdtemp(dir=work_dir)
+    upload_folder = os.path.join(tmp, "backups")
+    os.makedirs(upload_folder)
+    config_file = os.path.join(tmp, "config.toml")
+    write_config(config_file, upload_folder, extra_config)
+
+    port = free_port()
+    env = dict(os.environ, MODE="TESTING")
+    cmd = [
+        sys.executable, "-m", "gunicorn",
+        "--bind", "127.0.0.1:" + str(port),
+        "--workers", str(workers),
+        "--worker-class", worker_class,
+        "--threads", str(threads),
+        "--timeout", "3600",
+        "--log-level", "warning",
+        "ddmail_backup_receiver:create_app(config_file='" + config_file + "')",
+    ]
+    process = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL)
+    try:
+        deadline = time.time() + 30
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if time.time() > deadline or process.poll() is not None:
+                    raise RuntimeError("gunicorn did not start")
+                time.sleep(0.1)
+        yield {"host": "127.0.0.1", "port": port, "upload_folder": upload_folder, "process": process}
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(tmp)
+
+
+def generated_body(size: int, seed: bytes = b"ddmail"):
+    """Return a function that yields size bytes of generated data and the SHA256 of the data."""
+    block = hashlib.shake_256(seed).digest(BLOCK_SIZE)
+
+    def blocks():
+        sent = 0
+        while sent < size:
+            n = min(BLOCK_SIZE, size - sent)
+            yield block[:n]
+            sent += n
+
+    sha256 = hashlib.sha256()
+    for data in blocks():
+        sha256.update(data)
+    return blocks, sha256.hexdigest()
+
+
+def zero_body(size: int):
+    """Return a function that yields size zero bytes, like a sparse file, and the SHA256 of the data."""
+    block = bytes(BLOCK_SIZE)
+    sha256 = hashlib.sha256()
+    for _ in range(size // BLOCK_SIZE):
+        sha256.update(block)
+    sha256.update(block[:size % BLOCK_SIZE])
+
+    def blocks():
+        sent = 0
+        while sent < size:
+            n = min(BLOCK_SIZE, size - sent)
+            yield block[:n]
+            sent += n
+
+    return blocks, sha256.hexdigest()
+
+
+def process_tree(pid: int) -> list:
+    """Return pid and the pids of all its descendants, from /proc."""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/" + entry + "/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name can contain spaces, the fields after it are space separated.
+        ppid = int(stat[stat.rindex(")") + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+
+    pids = [pid]
+    for p in pids:
+        pids.extend(children.get(p, []))
+    return pids
+
+
+def cpu_seconds(pids: list) -> float:
+    """Return the user and system CPU seconds used by the processes in pids."""
+    total = 0
+    for pid in pids:
+        try:
+            with open("/proc/" + str(pid) + "/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        total += int(fields[11]) + int(fields[12])
+    return total / os.sysconf("SC_CLK_TCK")
+
+
+def peak_rss(pids: list) -> dict:
+    """Return the largest and the summed peak resident set size (VmHWM) in bytes of the processes in pids."""
+    peaks = []
+    for pid in pids:
+        try:
+            with open("/proc/" + str(pid) + "/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        peaks.append(int(line.split()[1]) * 1024)
+        except OSError:
+            continue
+    return {"max": max(peaks, default=0), "sum": sum(peaks)}
+
+
+def post_raw(host: str, port: int, filename: str, size: int, blocks, sha256: str) -> bytes:
+    """Upload a generated body to /receive_backup_stream and return the response body."""
+    conn = http.client.HTTPConnection(host, port, timeout=3600)
+    conn.putrequest("POST", "/receive_backup_stream")
+    conn.putheader("Content-Type", "application/octet-stream")
+    conn.putheader("Content-Length", str(size))
+    conn.putheader("X-Filename", filename)
+    conn.putheader("X-Password", PASSWORD)
+    conn.putheader("X-Sha256", sha256)
+    conn.endheaders()
+    for data in blocks():
+        conn.send(data)
+    response = conn.getresponse().read()
+    conn.close()
+    return response
+
+
+def post_multipart(host: str, port: int, filename: str, size: int, blocks, sha256: str) -> bytes:
+    """Upload a generated body to /receive_backup as multipart/form-data and return the response body."""
+    boundary = "ddmailbenchmarkboundary"
+    head = b""
+    for name, value in [("filename", filename), ("password", PASSWORD), ("sha256", sha256)]:
+        head += ("--" + boundary + "\r\nContent-Disposition: form-data; name=\"" + name + "\"\r\n\r\n"
+                 + value + "\r\n").encode()
+    head += ("--" + boundary + "\r\nContent-Disposition: form-data; name=\"file\"; filename=\"" + filename
+             + "\"\r\nContent-Type: application/octet-stream\r\n\r\n").encode()
+    tail = ("\r\n--" + boundary + "--\r\n").encode()
+
+    conn = http.client.HTTPConnection(host, port, timeout=3600)
+    conn.putrequest("POST", "/receive_backup")
+    conn.putheader("Content-Type", "multipart/form-data; boundary=" + boundary)
+    conn.putheader("Content-Length", str(len(head) + size + len(tail)))
+    conn.endheaders()
+    conn.send(head)
+    for data in blocks():
+        conn.send(data)
+    conn.send(tail)
+    response = conn.getresponse().read()
+    conn.close()
+    return response
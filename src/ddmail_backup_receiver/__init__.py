@@ -77,19 +77,98 @@ def create_app(config_file=None, test_config=None):
         app.config["PASSWORD_HASH"] = toml_config[mode]["PASSWORD_HASH"]
         app.config["UPLOAD_FOLDER"] = toml_config[mode]["UPLOAD_FOLDER"]
         app.config["BACKUPS_TO_SAVE"] = toml_config[mode]["BACKUPS_TO_SAVE"]
+        app.config["CLIENTS"] = toml_config[mode].get("CLIENTS", {})
+        app.config["RETENTION_SYNC"] = toml_config[mode].get("RETENTION_SYNC", False)
+        app.config["MAX_CONTENT_LENGTH"] = toml_config[mode].get("MAX_CONTENT_LENGTH")
+        app.config["AUTH_CACHE_TTL"] = toml_config[mode].get("AUTH_CACHE_TTL", 300)
+        app.config["AUTH_CACHE_SIZE"] = toml_config[mode].get("AUTH_CACHE_SIZE", 64)
+        app.config["UPLOAD_TOKEN_TTL"] = toml_config[mode].get("UPLOAD_TOKEN_TTL", 3600)
+        app.config["UPLOAD_SESSION_MAX_AGE"] = toml_config[mode].get("UPLOAD_SESSION_MAX_AGE", 86400)
+        app.config["METRICS"] = toml_config[mode].get("METRICS", True)
+        app.config["SLOW_REQUEST_THRESHOLD"] = toml_config[mode].get("SLOW_REQUEST_THRESHOLD", 30)
+        app.config["PROFILE_SAMPLE_RATE"] = toml_config[mode].get("PROFILE_SAMPLE_RATE", 0.0)
+        app.config["SCRUB_INTERVAL"] = toml_config[mode].get("SCRUB_INTERVAL", 0)
+        app.config["SCRUB_RATE_MB"] = toml_config[mode].get("SCRUB_RATE_MB", 20)
+        app.config["DISK_RESERVE"] = toml_config[mode].get("DISK_RESERVE", 0)
+        app.config["QUOTA"] = toml_config[mode].get("QUOTA", 0)
+        app.config["INGEST_CONCURRENCY"] = toml_config[mode].get("INGEST_CONCURRENCY", 0)
+        app.config["INGEST_QUEUE_SIZE"] = toml_config[mode].get("INGEST_QUEUE_SIZE", 8)
+        app.config["INGEST_QUEUE_TIMEOUT"] = toml_config[mode].get("INGEST_QUEUE_TIMEOUT", 30)
+        app.config["RATE_LIMIT_MB"] = toml_config[mode].get("RATE_LIMIT_MB", 0)
+        app.config["RATE_LIMIT_CLIENT_MB"] = toml_config[mode].get("RATE_LIMIT_CLIENT_MB", 0)
+
+        # Check that the profile sample rate is a fraction of the requests.
+        rate = app.config["PROFILE_SAMPLE_RATE"]
+        if not isinstance(rate, (int, float)) or not 0 <= rate <= 1:
+            print("Error: you need to set PROFILE_SAMPLE_RATE to a number from 0 to 1")
+            sys.exit(1)
+
+        # Check that the ingest limit settings is whole numbers, they are used as counts of lock files.
+        for key in ("INGEST_CONCURRENCY", "INGEST_QUEUE_SIZE"):
+            if not isinstance(app.config[key], int):
+                print("Error: you need to set " + key + " to a whole number")
+                sys.exit(1)
+
+        # Check that the scrub, disc space, ingest limit and rate limit settings are not negative.
+        for key in ("SCRUB_INTERVAL", "SCRUB_RATE_MB", "DISK_RESERVE", "QUOTA", "INGEST_CONCURRENCY",
+                    "INGEST_QUEUE_SIZE", "INGEST_QUEUE_TIMEOUT", "RATE_LIMIT_MB", "RATE_LIMIT_CLIENT_MB"):
+            if not isinstance(app.config[key], (int, float)) or app.config[key] < 0:
+                print("Error: you need to set " + key + " to a number that is 0 or more")
+                sys.exit(1)
+
+        app.config["STORAGE_MODE"] = toml_config[mode].get("STORAGE_MODE", "plain")
+
+        # Check that storage mode is known.
+        if app.config["STORAGE_MODE"] not in ("plain", "dedup"):
+            print("Error: you need to set STORAGE_MODE to plain/dedup")
+            sys.exit(1)
+
+        app.config["COMPRESSION"] = toml_config[mode].get("COMPRESSION", "none")
+        app.config["COMPRESSION_LEVEL"] = toml_config[mode].get("COMPRESSION_LEVEL", 3)
+        app.config["COMPRESSION_THREADS"] = toml_config[mode].get("COMPRESSION_THREADS", -1)
+        app.config["CHECKSUM_THREADS"] = toml_config[mode].get("CHECKSUM_THREADS", 0)
+
+        # Check that compression is known and that zstandard is installed if it is used.
+        from ddmail_backup_receiver.compression import is_zstd_available
+        if app.config["COMPRESSION"] not in ("none", "zstd"):
+            print("Error: you need to set COMPRESSION to none/zstd")
+            sys.exit(1)
+        if app.config["COMPRESSION"] == "zstd" and not is_zstd_available():
+            print("Error: COMPRESSION zstd needs the zstandard package, install ddmail_backup_receiver[zstd]")
+            sys.exit(1)
+
+        # Check that every client has a valid id and a password hash.
+        from ddmail_backup_receiver.clients import is_client_id_allowed
+        for client_id, client in app.config["CLIENTS"].items():
+            if not is_client_id_allowed(client_id) or "PASSWORD_HASH" not in client:
+                print("Error: client " + client_id + " needs a valid id and PASSWORD_HASH")
+                sys.exit(1)
+
+        # File and syslog handlers is written from a background thread, see log_queue.
+        slow_handlers = []
 
         # Configure logging to file.
         if toml_config[mode]["LOGGING"]["LOG_TO_FILE"] is True:
             file_handler = FileHandler(filename=toml_config[mode]["LOGGING"]["LOGFILE"])
             file_handler.setFormatter(logging.Formatter(log_format))
-            app.logger.addHandler(file_handler)
+            slow_handlers.append(file_handler)
 
         # Configure logging to syslog.
         if toml_config[mode]["LOGGING"]["LOG_TO_SYSLOG"] is True:
             syslog_handler = logging.handlers.SysLogHandler(address=toml_config[mode]["LOGGING"]["SYSLOG_SERVER"])
             syslog_handler.setFormatter(logging.Formatter(log_format))
-            app.logger.addHandler(syslog_handler)
+            slow_handlers.append(syslog_handler)
+
+        # Check that the log queue size is a positive number of records.
+        log_queue_size = toml_config[mode]["LOGGING"].get("LOG_QUEUE_SIZE", 10000)
+        if not isinstance(log_queue_size, int) or log_queue_size < 1:
+            print("Error: you need to set LOG_QUEUE_SIZE to a number that is 1 or more")
+            sys.exit(1)
 
+        # Configure the queue that file and syslog records is put in, so logging never waits for them.
+        if slow_handlers:
+            from ddmail_backup_receiver.log_queue import DroppingQueueHandler
+            app.logger.addHandler(DroppingQueueHandler(slow_handlers, log_queue_size))
 
         # Configure loglevel.
         if toml_config[mode]["LOGGING"]["LOGLEVEL"] == "ERROR":
@@ -116,8 +195,69 @@ def create_app(config_file=None, test_config=None):
     except OSError:
         pass
 
+    # Index of stored backups, rebuilt from the upload folder at startup.
+    from ddmail_backup_receiver import backup_index
+    app.config["BACKUP_INDEX"] = os.path.join(app.instance_path, "backup_index.sqlite")
+    if os.path.isdir(app.config["UPLOAD_FOLDER"]):
+        backup_index.rebuild_folder(app.config["BACKUP_INDEX"], app.config["UPLOAD_FOLDER"])
+        from ddmail_backup_receiver.clients import client_upload_folder
+        for client_id in app.config["CLIENTS"]:
+            folder = client_upload_folder(app.config["UPLOAD_FOLDER"], client_id)
+            if os.path.isdir(folder):
+                backup_index.rebuild_folder(app.config["BACKUP_INDEX"], folder)
+
+    # Background worker that removes old backups after uploads.
+    from ddmail_backup_receiver.retention import RetentionWorker
+    app.extensions["retention_worker"] = RetentionWorker(app)
+
+    # Cache of recently verified credentials, one per process.
+    from ddmail_backup_receiver.auth import VerifiedCache
+    app.extensions["auth_cache"] = VerifiedCache(
+        app.config["SECRET_KEY"],
+        app.config["AUTH_CACHE_SIZE"],
+        app.config["AUTH_CACHE_TTL"],
+    )
+
+    # Counters and histograms of all worker processes, served on /metrics.
+    from ddmail_backup_receiver import metrics
+    metrics.init_app(app)
+
+    # Stage timing of requests, slow request logging and sampled profiles.
+    from ddmail_backup_receiver import tracing
+    tracing.init_app(app)
+
+    # Disc space and quota reservations of uploads in progress.
+    from ddmail_backup_receiver import admission
+    admission.init_app(app)
+
+    # Limit of uploads saved at the same time by all worker processes.
+    from ddmail_backup_receiver import ingest_limit
+    ingest_limit.init_app(app)
+
+    # Bandwidth shaping of uploads per client and for all workers.
+    from ddmail_backup_receiver import shaping
+    shaping.init_app(app)
+
+    # Background verification of stored backups against their checksums.
+    from ddmail_backup_receiver import scrub
+    scrub.init_app(app)
+
     # Apply the blueprints to the app
     from ddmail_backup_receiver import application
     app.register_blueprint(application.bp)
+    from ddmail_backup_receiver import auth
+    app.register_blueprint(auth.bp)
+    from ddmail_backup_receiver import upload_session
+    app.register_blueprint(upload_session.bp)
+    from ddmail_backup_receiver import delta
+    app.register_blueprint(delta.bp)
+    from ddmail_backup_receiver import multipart
+    app.register_blueprint(multipart.bp)
+    from ddmail_backup_receiver import download
+    app.register_blueprint(download.bp)
+    from ddmail_backup_receiver import listing
+    app.register_blueprint(listing.bp)
+    app.register_blueprint(metrics.bp)
+    app.register_blueprint(scrub.bp)
 
     return app
@@ -0,0 +1,167 @@
+import os
+import json
+import uuid
+import fcntl
+import tempfile
+from contextlib import contextmanager
+from typing import Iterator, Optional, Tuple
+from flask import Flask, current_app, g
+from ddmail_backup_receiver import backup_index
+
+# Files in the instance folder with the space reserved by uploads in progress in all
+# worker processes and the lock that protects it.
+RESERVATIONS_NAME = "reservations.json"
+RESERVATIONS_LOCK_NAME = "reservations.lock"
+
+
+def reservations_path(app: Flask) -> str:
+    """Return the path of the file with the reservations of uploads in progress."""
+    return os.path.join(app.instance_path, RESERVATIONS_NAME)
+
+
+def is_process_alive(pid: int) -> bool:
+    """Return True if a process with pid exists."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def read_reservations(app: Flask) -> dict:
+    """Return the reservations of uploads in progress by id, the lock must be held.
+
+    Reservations of worker processes that no longer exist is left out, so a killed
+    worker do not keep its space reserved.
+    """
+    try:
+        with open(reservations_path(app), 'r') as f:
+            reservations = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return {key: value for key, value in reservations.items() if is_process_alive(value["pid"])}
+
+
+def write_reservations(app: Flask, reservations: dict) -> None:
+    """Replace the reservations of uploads in progress atomically, the lock must be held."""
+    fd, tmp_path = tempfile.mkstemp(dir=app.instance_path, prefix=".tmp-")
+    with os.fdopen(fd, 'w') as f:
+        json.dump(reservations, f)
+    os.replace(tmp_path, reservations_path(app))
+
+
+@contextmanager
+def reservations_lock(app: Flask) -> Iterator[None]:
+    """Hold the lock of the reservations, shared by all worker processes."""
+    with open(os.path.join(app.instance_path, RESERVATIONS_LOCK_NAME), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def free_bytes(folder: str) -> int:
+    """Return the bytes an unprivileged process can write to the filesystem of folder."""
+    st = os.statvfs(folder)
+    return st.f_bavail * st.f_frsize
+
+
+def pending_bytes(folder: str) -> int:
+    """Return the bytes of unfinished upload sessions and multipart uploads in the upload folder folder.
+
+    The data of an unfinished upload is on disc but not in the backup index, so it is
+    counted separately against the quota. Parts that is being received is counted by
+    their reservation.
+    """
+    from ddmail_backup_receiver.upload_session import SESSIONS_FOLDER_NAME
+    from ddmail_backup_receiver.multipart import MULTIPART_FOLDER_NAME
+
+    size = 0
+    for name in (SESSIONS_FOLDER_NAME, MULTIPART_FOLDER_NAME):
+        for dirpath, dirnames, filenames in os.walk(os.path.join(folder, name)):
+            for filename in filenames:
+                if filename != "data.part" and not filename.startswith("part-"):
+                    continue
+                try:
+                    size += os.path.getsize(os.path.join(dirpath, filename))
+                except FileNotFoundError:
+                    pass
+    return size
+
+
+def reserve(client: dict, size: int) -> Tuple[Optional[str], Optional[str]]:
+    """Reserve size bytes for an upload of client, if the disc and the quota of client has room.
+
+    The free space of the filesystem minus DISK_RESERVE and minus the space reserved by
+    other uploads in progress on the same filesystem must fit size. If the client has a
+    quota, the size of its indexed backups, its unfinished upload sessions and multipart
+    uploads and its uploads in progress plus size must fit the quota. Old backups is
+    removed after the upload, so a quota must fit one more backup than BACKUPS_TO_SAVE.
+
+    Args:
+        client (dict): The client from get_client.
+        size (int): Declared size of the upload, the Content-Length of the request, a
+                    part or a chunk.
+
+    Returns:
+        tuple: Id of the reservation and None, or None and an error message.
+    """
+    app = current_app._get_current_object()
+    folder = client["upload_folder"]
+    device = os.stat(folder).st_dev
+
+    with reservations_lock(app):
+        reservations = read_reservations(app)
+
+        reserved = sum(value["size"] for value in reservations.values() if value["device"] == device)
+        if size > free_bytes(folder) - app.config["DISK_RESERVE"] - reserved:
+            return None, "not enough disc space"
+
+        quota = client["quota"]
+        if quota:
+            db_path = app.config["BACKUP_INDEX"]
+            backup_index.ensure_folder(db_path, folder)
+            used = backup_index.folder_size(db_path, folder) + pending_bytes(folder)
+            used += sum(value["size"] for value in reservations.values() if value["folder"] == folder)
+            if used + size > quota:
+                return None, "quota exceeded"
+
+        reservation_id = uuid.uuid4().hex
+        reservations[reservation_id] = {"pid": os.getpid(), "device": device, "folder": folder, "size": size}
+        write_reservations(app, reservations)
+
+    g.setdefault("reservations", set()).add(reservation_id)
+    return reservation_id, None
+
+
+def check_size(client: dict, size: int) -> Optional[str]:
+    """Return an error message if size bytes do not fit the disc or the quota of client now, without reserving them.
+
+    Used for the declared size of upload sessions and multipart uploads when they are
+    opened, their chunks and parts is reserved when they are received.
+    """
+    reservation_id, error = reserve(client, size)
+    if error is None:
+        release(reservation_id)
+    return error
+
+
+def release(reservation_id: str) -> None:
+    """Remove a reservation when its upload is stored, the space is then used by the file."""
+    app = current_app._get_current_object()
+    with reservations_lock(app):
+        reservations = read_reservations(app)
+        reservations.pop(reservation_id, None)
+        write_reservations(app, reservations)
+    g.get("reservations", set()).discard(reservation_id)
+
+
+def release_request_reservations(exc: Optional[BaseException]) -> None:
+    """Remove the reservations of a request that was refused or failed before its upload was stored."""
+    for reservation_id in list(g.get("reservations", ())):
+        release(reservation_id)
+
+
+def init_app(app: Flask) -> None:
+    """Release the reservations of every request when it ends."""
+    app.teardown_request(release_request_reservations)
@@ -1,11 +1,21 @@
 import os
 import hashlib
-import glob
-from flask import Blueprint, current_app, request, make_response, Response
-from argon2 import PasswordHasher
-from argon2.exceptions import VerifyMismatchError
+import tempfile
+from typing import Optional, Tuple
+from flask import Blueprint, current_app, request, make_response, jsonify, Response
 from werkzeug.utils import secure_filename
 import ddmail_validators.validators as validators
+from ddmail_backup_receiver.auth import authenticate
+from ddmail_backup_receiver import backup_index
+from ddmail_backup_receiver import dedup
+from ddmail_backup_receiver import compression
+from ddmail_backup_receiver import checksums
+from ddmail_backup_receiver import metrics
+from ddmail_backup_receiver import admission
+from ddmail_backup_receiver.ingest_limit import acquire_ingest_slot
+from ddmail_backup_receiver.shaping import shape_request
+from ddmail_backup_receiver.tracing import mark_stage
+from ddmail_backup_receiver.retention import schedule_retention
 
 bp = Blueprint("application", __name__, url_prefix="/")
 
@@ -26,7 +36,7 @@ def sha256_of_file(file: str) -> str:
 
     sha256 = hashlib.sha256()
 
-    with open(file, 'rb') as f:
+    with metrics.timer("ddmail_sha256_duration_seconds"), open(file, 'rb') as f:
         while True:
             data = f.read(buf_size)
             if not data:
@@ -36,12 +46,315 @@ def sha256_of_file(file: str) -> str:
     return sha256.hexdigest()
 
 
+def copy_and_sha256(stream, out, buf_size: int = 65536, hasher=None) -> str:
+    """Copy a stream to an open file and calculate the SHA256 checksum of the copied data.
+
+    Args:
+        stream: Binary file-like object to read the data from.
+        out: Binary file object opened for writing to copy the data to.
+        buf_size (int, optional): Number of bytes to read and write per chunk.
+        hasher (optional): Hash object from checksums.new_hasher to use instead of SHA256.
+
+    Returns:
+        str: Hexadecimal representation of the SHA256 hash.
+    """
+    sha256 = hasher if hasher is not None else hashlib.sha256()
+
+    while True:
+        data = stream.read(buf_size)
+        if not data:
+            break
+        sha256.update(data)
+        out.write(data)
+
+    return sha256.hexdigest()
+
+
+def save_and_sha256(stream, full_path: str, buf_size: int = 65536, hasher=None) -> str:
+    """Save a stream to disc and calculate the SHA256 checksum while writing.
+
+    This function copies the stream to full_path in chunks and updates the SHA256
+    hash with every chunk, so the checksum is ready when the last byte is written
+    and the saved file do not need to be read from disc again.
+
+    Args:
+        stream: Binary file-like object to read the data from.
+        full_path (str): Path to the file to save the data to.
+        buf_size (int, optional): Number of bytes to read and write per chunk.
+        hasher (optional): Hash object from checksums.new_hasher to use instead of SHA256.
+
+    Returns:
+        str: Hexadecimal representation of the SHA256 hash.
+    """
+    with open(full_path, 'wb') as f:
+        return copy_and_sha256(stream, f, buf_size, hasher)
+
+
+def stored_name(filename: str) -> str:
+    """Return the name a backup uploaded as filename is stored as with the configured STORAGE_MODE and COMPRESSION."""
+    if current_app.config["STORAGE_MODE"] == "dedup":
+        return filename + dedup.MANIFEST_SUFFIX
+    if current_app.config["COMPRESSION"] == "zstd":
+        return filename + compression.ZSTD_SUFFIX
+    return filename
+
+
+def store_backup(stream, upload_folder: str, filename: str, buf_size: int = 65536,
+                 algorithm: str = checksums.DEFAULT_ALGORITHM, expected: Optional[str] = None) -> Tuple[str, str]:
+    """Store an uploaded backup in upload_folder with the configured STORAGE_MODE.
+
+    In plain mode the stream is saved as filename, or compressed as filename + ".zst"
+    if COMPRESSION is zstd. In dedup mode the stream is split into content-defined
+    chunks, chunks that are not already in the chunk store of UPLOAD_FOLDER is written
+    and a manifest is saved as filename + MANIFEST_SUFFIX. The checksum is always
+    taken over the uploaded bytes.
+
+    The backup is written to a temporary file in upload_folder and moved in place
+    when the whole stream is stored and its checksum is equal to expected. A stream
+    that fails or do not match is removed, so an upload cut off by a dropped
+    connection never replaces a stored backup with the same name.
+
+    Args:
+        stream: Binary file-like object to read the data from.
+        upload_folder (str): Folder where the backup is stored.
+        filename (str): Secure file name of the backup.
+        buf_size (int, optional): Number of bytes to read from the stream at a time.
+        algorithm (str, optional): Checksum algorithm, see checksums.available_algorithms.
+        expected (Optional[str], optional): Checksum the data must have to be stored, None
+                                            stores it without a check.
+
+    Returns:
+        tuple: Name of the stored file in upload_folder and the checksum of the data as hex.
+    """
+    name = stored_name(filename)
+    full_path = os.path.join(upload_folder, name)
+    hasher = checksums.new_hasher(algorithm, current_app.config["CHECKSUM_THREADS"])
+    store = dedup.chunk_store_folder(current_app.config["UPLOAD_FOLDER"])
+    is_dedup = current_app.config["STORAGE_MODE"] == "dedup"
+
+    fd, tmp_path = tempfile.mkstemp(dir=upload_folder, prefix=".tmp-")
+    os.close(fd)
+
+    try:
+        if is_dedup:
+            with metrics.timer("ddmail_save_duration_seconds", storage="dedup"):
+                sha256 = dedup.save_dedup(
+                    stream,
+                    store,
+                    current_app.config["BACKUP_INDEX"],
+                    tmp_path,
+                    max(buf_size, 1048576),
+                    hasher,
+                )
+        elif current_app.config["COMPRESSION"] == "zstd":
+            with metrics.timer("ddmail_save_duration_seconds", storage="zstd"):
+                sha256 = compression.save_zstd_and_sha256(
+                    stream,
+                    tmp_path,
+                    current_app.config["COMPRESSION_LEVEL"],
+                    current_app.config["COMPRESSION_THREADS"],
+                    max(buf_size, 1048576),
+                    hasher,
+                )
+        else:
+            with metrics.timer("ddmail_save_duration_seconds", storage="plain"):
+                sha256 = save_and_sha256(stream, tmp_path, buf_size, hasher)
+
+        if expected is not None and sha256 != expected:
+            remove_temporary_backup(tmp_path, is_dedup)
+            return name, sha256
+
+        # A replace that fails, like a directory with the same name, also removes the temporary file.
+        if is_dedup:
+            dedup.replace_manifest(store, current_app.config["BACKUP_INDEX"], tmp_path, full_path)
+        else:
+            os.replace(tmp_path, full_path)
+    except BaseException:
+        remove_temporary_backup(tmp_path, is_dedup)
+        raise
+
+    return name, sha256
+
+
+def remove_temporary_backup(tmp_path: str, is_dedup: bool) -> None:
+    """Remove a backup that was not moved in place by store_backup, and the chunks only its manifest use."""
+    if is_dedup:
+        dedup.remove_manifest(dedup.chunk_store_folder(current_app.config["UPLOAD_FOLDER"]),
+                              current_app.config["BACKUP_INDEX"], tmp_path)
+        return
+
+    try:
+        os.remove(tmp_path)
+    except FileNotFoundError:
+        pass
+
+
+def open_stored_backup(upload_folder: str, name: str):
+    """Open a stored backup for reading its original bytes.
+
+    Plain files is opened as they are, compressed files is decompressed and manifests
+    is read from the chunk store, so the caller do not need to know how the backup
+    was stored.
+
+    Args:
+        upload_folder (str): Folder where the backup is stored.
+        name (str): Name of the stored backup.
+
+    Returns:
+        Binary file-like object with the uploaded data of the backup.
+    """
+    full_path = os.path.join(upload_folder, name)
+    if name.endswith(dedup.MANIFEST_SUFFIX):
+        return dedup.open_backup(dedup.chunk_store_folder(current_app.config["UPLOAD_FOLDER"]), full_path)
+    return compression.open_backup(full_path)
+
+
+def remove_stored_backup(upload_folder: str, name: str) -> None:
+    """Remove a stored backup from disc and from the backup index.
+
+    Removing a manifest also removes the chunks that no other manifest use.
+
+    Args:
+        upload_folder (str): Folder where the backup is stored.
+        name (str): Name of the stored backup.
+
+    Returns:
+        None
+    """
+    db_path = current_app.config["BACKUP_INDEX"]
+    full_path = os.path.join(upload_folder, name)
+
+    if name.endswith(dedup.MANIFEST_SUFFIX):
+        removed_chunks = dedup.remove_manifest(
+            dedup.chunk_store_folder(current_app.config["UPLOAD_FOLDER"]),
+            db_path,
+            full_path,
+        )
+        current_app.logger.debug("removed %s unused chunks", removed_chunks)
+    else:
+        try:
+            os.remove(full_path)
+        except FileNotFoundError:
+            pass
+
+    backup_index.remove_backup(db_path, upload_folder, name)
+
+
+def validate_backups_to_save(backups_to_save) -> Optional[str]:
+    """Validate the BACKUPS_TO_SAVE configuration value.
+
+    Args:
+        backups_to_save: The configured number of backups to save.
+
+    Returns:
+        Optional[str]: Error message if the value is not valid, otherwise None.
+    """
+    # Check if number of backups to save is set.
+    if backups_to_save is None:
+        return "number of backups to save is not set"
+
+    # Check if backups_to_save is an integer.
+    if not isinstance(backups_to_save, int):
+        return "number of backups to save must be an integer"
+
+    # Check if backups_to_save is a positive integer.
+    if backups_to_save <= 0:
+        return "number of backups to save must be a positive integer"
+
+    return None
+
+
+def check_upload_headers(require_metadata: bool) -> Tuple[Optional[dict], Optional[str], int]:
+    """Check client, credentials, filename, checksum and size from request headers without reading the body.
+
+    Nothing in this function touches the request body, so an upload that is refused
+    here costs no bandwidth or disc.
+
+    Args:
+        require_metadata (bool): If True X-Filename and X-Sha256 must be set.
+
+    Returns:
+        tuple: The client, error message and HTTP status code. The client is None and the
+               error message is set if a check failed.
+    """
+    filename = request.headers.get('X-Filename')
+    sha256_from_header = request.headers.get('X-Sha256')
+
+    # Check if filename and sha256 checksum is None.
+    if require_metadata and filename is None:
+        return None, "filename is none", 400
+    if require_metadata and sha256_from_header is None:
+        return None, "sha256_from_form is none", 400
+
+    # Validate filename and sha256 if they are set.
+    if filename is not None and not validators.is_filename_allowed(filename.strip()):
+        return None, "filename validation failed", 400
+    if sha256_from_header is not None and not validators.is_sha256_allowed(sha256_from_header.strip()):
+        return None, "sha256 checksum validation failed", 400
+    algorithm = request.headers.get('X-Checksum-Algorithm', checksums.DEFAULT_ALGORITHM).strip()
+    if algorithm not in checksums.available_algorithms():
+        return None, "checksum algorithm is not supported", 400
+
+    # Check the declared size of the body.
+    if request.content_length is None:
+        return None, "content length is none", 411
+    max_content_length = current_app.config.get("MAX_CONTENT_LENGTH")
+    if max_content_length is not None and request.content_length > max_content_length:
+        return None, "content length is too large", 413
+
+    # Check client and if password or upload token is valid and correct.
+    client, error = authenticate(
+        request.headers.get('X-Client'),
+        request.headers.get('X-Password'),
+        request.headers.get('X-Token'),
+    )
+    if error is not None:
+        return None, error, 401
+
+    return client, None, 200
+
+
+def early_error_response(error: str, status: int) -> Response:
+    """Log error and return it with status, closing the connection so the unread body is not drained.
+
+    Args:
+        error (str): Error message.
+        status (int): HTTP status code.
+
+    Returns:
+        Response: Flask response with the error message.
+    """
+    current_app.logger.error(error)
+    response = make_response("error: " + error, status)
+    response.headers["Connection"] = "close"
+    return response
+
+
+def busy_response(retry_after: int) -> Response:
+    """Return 503 with Retry-After for an upload that is refused because too many uploads is saved.
+
+    Args:
+        retry_after (int): Seconds the client should wait before it sends the upload again.
+
+    Returns:
+        Response: Flask response with the error message.
+    """
+    response = early_error_response("server is busy", 503)
+    response.headers["Retry-After"] = str(retry_after)
+    return response
+
+
 def delete_old_backups(backup_folder: str, backups_to_save: int) -> None:
     """Remove old backups/files that is older then backups_to_save number of files.
 
     This function will remove old backups/files that is older then backups_to_save number of files.
     It will also log the number of backups removed and if no backups are removed.
 
+    The backups to remove is taken from the backup index, so only the removed files are
+    touched on disc. The folder is scanned once per process to reconcile the index.
+    Removing a manifest of a deduplicated backup also removes the chunks that no other
+    manifest use.
+
     Args:
         backup_folder (str): folder where backups is stored that will be removed.
         backups_to_save (int): number of backups to save.
@@ -49,33 +362,27 @@ def delete_old_backups(backup_folder: str, backups_to_save: int) -> None:
     Returns:
         None
     """
-    # Get list of files in the backup_folder folder.
-    list_of_files = filter(
-            os.path.isfile,
-            glob.glob(backup_folder + '/*')
-            )
+    with metrics.timer("ddmail_retention_duration_seconds"):
+        db_path = current_app.config["BACKUP_INDEX"]
+        backup_index.ensure_folder(db_path, backup_folder)
 
-    # Sort list of files based on last modification time in ascending order.
-    list_of_files = sorted(list_of_files, key=os.path.getmtime)
+        # Get the backups that is older then the newest backups_to_save backups.
+        list_of_files = backup_index.backups_to_remove(db_path, backup_folder, backups_to_save)
 
-    current_app.logger.debug("list_of_files: %s", list_of_files)
+        current_app.logger.debug("list_of_files to remove: %s", list_of_files)
 
-    # If we have less or equal of the int backups_to_save backups then exit.
-    if len(list_of_files) <= backups_to_save:
-        current_app.logger.info("too few backups for removing old backups")
-        return
+        # If we have less or equal of the int backups_to_save backups then exit.
+        if not list_of_files:
+            current_app.logger.info("too few backups for removing old backups")
+            return
 
-    list_of_files.reverse()
-    count = 0
+        # Only save backups_to_save number of backups, remove other.
+        for file in list_of_files:
+            full_path = os.path.join(backup_folder, file)
+            remove_stored_backup(backup_folder, file)
+            metrics.inc("ddmail_pruned_backups_total")
+            current_app.logger.info("removing: " + full_path)
 
-    # Only save backups_to_save number of backups, remove other.
-    for file in list_of_files:
-        count = count + 1
-        if count <= backups_to_save:
-            continue
-        else:
-            os.remove(file)
-            current_app.logger.info("removing: " + backup_folder + "/" + file)
 
 @bp.route("/receive_backup", methods=["POST"])
 def receive_backup() -> Response:
@@ -90,11 +397,26 @@ def receive_backup() -> Response:
     Returns:
         Response: Flask response with appropriate message and status code
 
+    Request Headers (optional):
+        X-Client (str): Client id, checked before the body is read
+        X-Password (str): Authentication password, checked before the body is read
+        X-Token (str): Upload token from /auth, used instead of X-Password
+        X-Filename (str): Name to save the file as, validated before the body is read
+        X-Sha256 (str): Expected SHA256 checksum, validated before the body is read
+        X-Checksum-Algorithm (str): Checksum algorithm, validated before the body is read
+
+        When X-Password or X-Token is set a refused upload gets a 4xx or 507 status,
+        see receive_backup_stream, and the form password and token are not needed.
+        Disc space and quota is then also checked before the body is read.
+
     Request Form Parameters:
         file (FileStorage): The backup file to be uploaded
         filename (str): Name to save the file as
         password (str): Authentication password for the request
-        sha256 (str): Expected SHA256 checksum of the file
+        token (str): Upload token from /auth, used instead of password
+        client (str, optional): Client id, the backup is stored in the client folder
+        sha256 (str): Expected SHA256 checksum of the file, or checksum with checksum_algorithm
+        checksum_algorithm (str, optional): sha256, sha256-tree or blake3, see /checksum_algorithms
 
     Error Responses:
         "error: file is not in request.files": If file parameter is missing
@@ -104,9 +426,18 @@ def receive_backup() -> Response:
         "error: sha256_from_form is none": If sha256 parameter is missing
         "error: filename validation failed": If filename fails validation
         "error: sha256 checksum validation failed": If sha256 fails validation
+        "error: checksum algorithm is not supported": If checksum_algorithm is not available
         "error: password validation failed": If password fails validation
         "error: wrong password": If authentication password is incorrect
+        "error: client validation failed": If client fails validation
+        "error: client do not exist": If client is not configured in CLIENTS
+        "error: wrong token": If the upload token is not correctly signed or for another client
+        "error: token is expired": If the upload token is older than UPLOAD_TOKEN_TTL
         "error: upload folder [path] do not exist": If upload directory doesn't exist
+        "error: not enough disc space": If the upload do not fit the free disc space, see admission
+        "error: quota exceeded": If the upload do not fit the quota of the client
+        503 "error: server is busy": If INGEST_CONCURRENCY uploads is saved and the wait
+            queue is full or the wait timed out, with Retry-After, also for form clients
         "error: sha256 checksum do not match": If file checksum doesn't match provided value
         "error: number of backups to save is not set": If BACKUPS_TO_SAVE configuration is missing
         "error: number of backups to save must be an integer": If BACKUPS_TO_SAVE is not an integer
@@ -116,10 +447,55 @@ def receive_backup() -> Response:
         "done": Operation completed successfully
 
     Configuration:
+        CLIENTS: Clients with their own PASSWORD_HASH, BACKUPS_TO_SAVE and subfolder
+                 of UPLOAD_FOLDER/.clients. Without client the top level settings is used.
         BACKUPS_TO_SAVE: Controls how many recent backups to retain. Older backups beyond
                         this number will be automatically deleted after a successful upload.
+        RETENTION_SYNC: If true old backups are deleted before the response is returned,
+                        otherwise they are deleted by a background worker.
+        STORAGE_MODE: "plain" stores the file as is, "dedup" stores it as a manifest of
+                      deduplicated chunks named filename + ".manifest".
+        COMPRESSION: "zstd" compresses plain backups while they are written, the file
+                     is named filename + ".zst".
+        CHECKSUM_THREADS: Threads used to calculate sha256-tree and blake3 checksums, 0 is
+                          one per CPU.
+        SLOW_REQUEST_THRESHOLD: Uploads that take at least this many seconds are logged
+                                with the time of every stage, see tracing.
+        DISK_RESERVE: Bytes to keep free on the disc of UPLOAD_FOLDER.
+        QUOTA: Max bytes of backups per client, CLIENTS can set their own. 0 is no quota.
+        INGEST_CONCURRENCY: Max uploads saved at the same time by all workers, 0 is no limit.
+        INGEST_QUEUE_SIZE: Uploads that can wait for a slot, others get 503 at once.
+        INGEST_QUEUE_TIMEOUT: Max seconds an upload waits in the queue.
+        RATE_LIMIT_MB: MB per second all uploads is read at, shared fairly between clients.
+        RATE_LIMIT_CLIENT_MB: MB per second of every client, CLIENTS can set RATE_LIMIT_MB.
+                              Form clients is limited per address until they are known.
     """
-    # Check if post data contains file.
+    # Clients that send credentials in headers are checked before the body is read.
+    client = None
+    reservation_id = None
+    if 'X-Password' in request.headers or 'X-Token' in request.headers:
+        client, error, status = check_upload_headers(require_metadata=False)
+        if error is not None:
+            return early_error_response(error, status)
+    mark_stage("auth")
+
+    # Wait for an ingest slot before the body is read, if INGEST_CONCURRENCY is set.
+    retry_after = acquire_ingest_slot()
+    if retry_after is not None:
+        return busy_response(retry_after)
+    mark_stage("queue")
+
+    # Reserve disc space and quota for the upload before the body is read.
+    if client is not None and os.path.isdir(client["upload_folder"]):
+        reservation_id, error = admission.reserve(client, request.content_length)
+        if error is not None:
+            return early_error_response(error, 507)
+        mark_stage("validation")
+
+    # Read the body at the rate of the client, if RATE_LIMIT_MB or a client limit is set.
+    shape_request(client)
+
+    # Check if post data contains file, this reads the request body.
     if 'file' not in request.files:
         current_app.logger.error("file is not in request.files")
         return make_response("error: file is not in request.files", 200)
@@ -128,7 +504,10 @@ def receive_backup() -> Response:
     file = request.files['file']
     filename = request.form.get('filename')
     password = request.form.get('password')
+    token = request.form.get('token')
     sha256_from_form = request.form.get('sha256')
+    algorithm = request.form.get('checksum_algorithm', request.headers.get('X-Checksum-Algorithm'))
+    mark_stage("receive")
 
     # Check if file is None.
     if file is None:
@@ -140,8 +519,8 @@ def receive_backup() -> Response:
         current_app.logger.error("filename is None")
         return make_response("error: filename is none", 200)
 
-    # Check if password is None.
-    if password is None:
+    # Check if password is None, an upload token can be used instead of password.
+    if password is None and token is None and client is None:
         current_app.logger.error("receive_backup() password is None")
         return make_response("error: password is none", 200)
 
@@ -152,7 +531,6 @@ def receive_backup() -> Response:
 
     # Remove whitespace character.
     filename = filename.strip()
-    password = password.strip()
     sha256_from_form = sha256_from_form.strip()
 
     # Validate filename.
@@ -165,58 +543,183 @@ def receive_backup() -> Response:
         current_app.logger.error("sha256 checksum validation failed")
         return make_response("error: sha256 checksum validation failed", 200)
 
-    # Validate password.
-    if not validators.is_password_allowed(password):
-        current_app.logger.error("password validation failed")
-        return make_response("error: password validation failed", 200)
-
-    # Check if password is correct.
-    ph = PasswordHasher()
-    try:
-        if not ph.verify(current_app.config["PASSWORD_HASH"], password):
-            current_app.logger.error("wrong password")
-            return make_response("error: wrong password1", 200)
-    except VerifyMismatchError:
-        current_app.logger.error("wrong password")
-        return make_response("error: wrong password", 200)
+    # Validate checksum algorithm, sha256 if the client did not choose one.
+    algorithm = (algorithm or checksums.DEFAULT_ALGORITHM).strip()
+    if algorithm not in checksums.available_algorithms():
+        current_app.logger.error("checksum algorithm is not supported")
+        return make_response("error: checksum algorithm is not supported", 200)
+    mark_stage("validation")
+
+    # Check client and if password or upload token is valid and correct.
+    if client is None:
+        client, error = authenticate(request.form.get('client'), password, token)
+        if error is not None:
+            current_app.logger.error(error)
+            return make_response("error: " + error, 200)
+    mark_stage("auth")
 
     # Set folder where uploaded files are stored.
-    upload_folder = current_app.config["UPLOAD_FOLDER"]
+    upload_folder = client["upload_folder"]
 
     # Check if upload folder exist.
     if not os.path.isdir(upload_folder):
         current_app.logger.error("upload folder " + upload_folder + " do not exist")
         return make_response("error: upload folder " + upload_folder  + " do not exist", 200)
 
-    # Save file to disc.
-    full_path = upload_folder + "/" + secure_filename(filename)
-    file.save(full_path)
-
-    # Take sha256 checksum of file on disc and compare with checksum from form.
-    sha256_from_file = sha256_of_file(full_path)
+    # Reserve disc space and quota for clients that sent credentials in the form.
+    if reservation_id is None:
+        reservation_id, error = admission.reserve(client, request.content_length or 0)
+        if error is not None:
+            current_app.logger.error(error)
+            return make_response("error: " + error, 200)
+    mark_stage("validation")
+
+    # Save file to disc and take sha256 checksum of the data while it is written.
+    # The file is only stored if the checksum match.
+    name, sha256_from_file = store_backup(file.stream, upload_folder, secure_filename(filename), algorithm=algorithm,
+                                          expected=sha256_from_form)
+    admission.release(reservation_id)
+    mark_stage("save")
+
+    # Compare sha256 checksum of saved file with checksum from form.
     if sha256_from_form != sha256_from_file:
         current_app.logger.error("sha256 checksum do not match")
         return make_response("error: sha256 checksum do not match", 200)
 
-    # Check if number of backups to save is set.
-    if current_app.config["BACKUPS_TO_SAVE"] is None:
-        current_app.logger.error("number of backups to save is not set")
-        return make_response("error: number of backups to save is not set", 200)
+    backup_index.add_backup(current_app.config["BACKUP_INDEX"], upload_folder, name,
+                            checksums.index_checksum(algorithm, sha256_from_file))
+    mark_stage("index")
 
-    backups_to_save = current_app.config["BACKUPS_TO_SAVE"]
+    # Check that number of backups to save is configured correctly.
+    backups_to_save = client["backups_to_save"]
+    error = validate_backups_to_save(backups_to_save)
+    if error is not None:
+        current_app.logger.error(error)
+        return make_response("error: " + error, 200)
+    mark_stage("validation")
 
-    # Check if backups_to_save is an integer.
-    if not isinstance(backups_to_save, int):
-        current_app.logger.error("number of backups to save must be an integer")
-        return make_response("error: number of backups to save must be an integer", 200)
+    # Delete old backups, in the background unless RETENTION_SYNC is set.
+    schedule_retention(upload_folder, backups_to_save)
+    mark_stage("retention")
 
-    # Check if backups_to_save is a positive integer.
-    if backups_to_save <= 0:
-        current_app.logger.error("number of backups to save must be a positive integer")
-        return make_response("error: number of backups to save must be a positive integer", 200)
+    current_app.logger.info("done")
+    return make_response("done", 200)
+
+
+@bp.route("/receive_backup_stream", methods=["POST"])
+def receive_backup_stream() -> Response:
+    """
+    Receive a backup file sent as a raw application/octet-stream request body.
 
-    # Delete old backups.
-    delete_old_backups(upload_folder, backups_to_save)
+    This is an alternative to receive_backup that skips multipart form parsing.
+    Werkzeug spools multipart uploads to a temporary file before the view runs, so
+    every byte is written twice. Here the request body is streamed from request.stream
+    straight to its final location while the SHA256 checksum is calculated.
+
+    Credentials, filename, sha256 and size are checked from the headers before the
+    body is read. A refused upload gets a 4xx status and the connection is closed,
+    so a client that sent "Expect: 100-continue" can stop before sending the body.
+
+    Returns:
+        Response: Flask response with appropriate message and status code
+
+    Request Headers:
+        Content-Length (int): Size of the body, required
+        X-Client (str, optional): Client id, the backup is stored in the client folder
+        X-Filename (str): Name to save the file as
+        X-Password (str): Authentication password for the request
+        X-Token (str): Upload token from /auth, used instead of X-Password
+        X-Sha256 (str): Expected SHA256 checksum of the file, or checksum with X-Checksum-Algorithm
+        X-Checksum-Algorithm (str, optional): sha256, sha256-tree or blake3, see /checksum_algorithms
+
+    Error Responses:
+        400: Missing or invalid X-Filename or X-Sha256, unsupported X-Checksum-Algorithm or
+             sha256 checksum do not match
+        401: Unknown client or missing, invalid or wrong password or upload token
+        411: Content-Length is missing
+        413: Content-Length is larger than MAX_CONTENT_LENGTH
+        500: Upload folder do not exist or BACKUPS_TO_SAVE is not configured correctly
+        503: INGEST_CONCURRENCY uploads is saved and the wait queue is full or the wait
+             timed out, Retry-After is set to when the upload can be sent again
+        507: The upload do not fit the free disc space minus DISK_RESERVE and the space
+             reserved by other uploads, or the quota of the client
+
+    Success Response:
+        "done": Operation completed successfully
+    """
+    # Check credentials and metadata before the request body is read.
+    client, error, status = check_upload_headers(require_metadata=True)
+    if error is not None:
+        return early_error_response(error, status)
+    mark_stage("auth")
+
+    filename = request.headers.get('X-Filename').strip()
+    sha256_from_header = request.headers.get('X-Sha256').strip()
+    algorithm = request.headers.get('X-Checksum-Algorithm', checksums.DEFAULT_ALGORITHM).strip()
+
+    # Set folder where uploaded files are stored.
+    upload_folder = client["upload_folder"]
+
+    # Check if upload folder exist.
+    if not os.path.isdir(upload_folder):
+        return early_error_response("upload folder " + upload_folder + " do not exist", 500)
+
+    # Check that number of backups to save is configured correctly.
+    backups_to_save = client["backups_to_save"]
+    error = validate_backups_to_save(backups_to_save)
+    if error is not None:
+        return early_error_response(error, 500)
+
+    mark_stage("validation")
+
+    # Wait for an ingest slot, if INGEST_CONCURRENCY is set.
+    retry_after = acquire_ingest_slot()
+    if retry_after is not None:
+        return busy_response(retry_after)
+    mark_stage("queue")
+
+    # Reserve disc space and quota for the upload.
+    reservation_id, error = admission.reserve(client, request.content_length)
+    if error is not None:
+        return early_error_response(error, 507)
+    mark_stage("validation")
+
+    # Read the body at the rate of the client, if RATE_LIMIT_MB or a client limit is set.
+    shape_request(client)
+
+    # Stream request body to disc and take sha256 checksum of the data while it is written.
+    # The file is only stored if the checksum match, a body that was cut off do not.
+    name, sha256_from_file = store_backup(request.stream, upload_folder, secure_filename(filename), 1048576,
+                                          algorithm, sha256_from_header)
+    admission.release(reservation_id)
+    mark_stage("save")
+
+    # Compare sha256 checksum of saved file with checksum from header.
+    if sha256_from_header != sha256_from_file:
+        current_app.logger.error("sha256 checksum do not match")
+        return make_response("error: sha256 checksum do not match", 400)
+
+    backup_index.add_backup(current_app.config["BACKUP_INDEX"], upload_folder, name,
+                            checksums.index_checksum(algorithm, sha256_from_file))
+    mark_stage("index")
+
+    # Delete old backups, in the background unless RETENTION_SYNC is set.
+    schedule_retention(upload_folder, backups_to_save)
+    mark_stage("retention")
 
     current_app.logger.info("done")
     return make_response("done", 200)
+
+
+@bp.route("/checksum_algorithms", methods=["GET"])
+def checksum_algorithms() -> Response:
+    """Return the checksum algorithms an upload can use, so a client can choose one before it hashes the file.
+
+    sha256 is a plain SHA-256 of the file. sha256-tree is the root of a Merkle tree of
+    SHA-256 hashes over 1 MiB leaves, see checksums.TreeSha256, which is calculated on
+    several cores. blake3 is available if the blake3 package is installed.
+
+    Success Response:
+        JSON with the default algorithm and the list of available algorithms.
+    """
+    return jsonify({"default": checksums.DEFAULT_ALGORITHM, "algorithms": checksums.available_algorithms()})
@@ -0,0 +1,247 @@
+import hmac
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+from flask import Blueprint, current_app, request, make_response, jsonify, Response
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+import ddmail_validators.validators as validators
+from ddmail_backup_receiver.clients import get_client
+from ddmail_backup_receiver import metrics
+
+bp = Blueprint("auth", __name__, url_prefix="/")
+
+# Salt that separates upload tokens from other data signed with SECRET_KEY.
+UPLOAD_TOKEN_SALT = "ddmail_backup_receiver upload token"
+# One password hasher per process, it is thread safe and holds no per request state.
+PASSWORD_HASHER = PasswordHasher()
+
+
+class VerifiedCache:
+    """Bounded cache of recently verified credentials with a time to live.
+
+    Keys are keyed digests of the password hash and the password, the plaintext
+    password is never stored. Only successful verifications are cached, so wrong
+    passwords always pay the full Argon2 cost. When the cache is full the least
+    recently used entry is evicted.
+    """
+
+    def __init__(self, secret_key: str, max_size: int, ttl: float):
+        """Create a cache holding at most max_size entries for ttl seconds each.
+
+        Args:
+            secret_key (str): Key used to derive cache keys from credentials.
+            max_size (int): Max number of cached credentials.
+            ttl (float): Seconds a successful verification is valid. 0 disables the cache.
+        """
+        self.secret_key = secret_key.encode('utf-8')
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, password_hash: str, password: str) -> bytes:
+        """Return the cache key for a password hash and password."""
+        msg = password_hash.encode('utf-8') + b"\0" + password.encode('utf-8')
+        return hmac.new(self.secret_key, msg, hashlib.sha256).digest()
+
+    def contains(self, key: bytes) -> bool:
+        """Return True if key has been verified within the last ttl seconds."""
+        if self.ttl <= 0:
+            return False
+
+        now = time.monotonic()
+        with self.lock:
+            expires = self.entries.get(key)
+            if expires is None:
+                return False
+            if expires < now:
+                del self.entries[key]
+                return False
+            self.entries.move_to_end(key)
+            return True
+
+    def add(self, key: bytes) -> None:
+        """Add a successfully verified key and evict the least recently used entries if full."""
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+
+        with self.lock:
+            self.entries[key] = time.monotonic() + self.ttl
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+def verify_password(password: str, password_hash: Optional[str] = None) -> bool:
+    """Check a password against a password hash, by default the configured PASSWORD_HASH.
+
+    Successful verifications are cached in the app VerifiedCache for AUTH_CACHE_TTL
+    seconds, so repeated requests from the same sender do not pay the Argon2 cost.
+
+    Args:
+        password (str): Password to check.
+        password_hash (Optional[str]): Argon2 hash to check against, PASSWORD_HASH if None.
+
+    Returns:
+        bool: True if the password is correct, otherwise False.
+    """
+    if password_hash is None:
+        password_hash = current_app.config["PASSWORD_HASH"]
+    cache = current_app.extensions["auth_cache"]
+
+    key = cache.key(password_hash, password)
+    if cache.contains(key):
+        metrics.inc("ddmail_password_cache_hits_total")
+        return True
+
+    try:
+        with metrics.timer("ddmail_password_verify_duration_seconds"):
+            PASSWORD_HASHER.verify(password_hash, password)
+    except VerifyMismatchError:
+        return False
+
+    cache.add(key)
+    return True
+
+
+def check_password(password: Optional[str], password_hash: Optional[str] = None) -> Optional[str]:
+    """Check that password is set, valid and correct.
+
+    Args:
+        password (Optional[str]): Password from the request.
+        password_hash (Optional[str]): Argon2 hash to check against, PASSWORD_HASH if None.
+
+    Returns:
+        Optional[str]: Error message if the check failed, otherwise None.
+    """
+    if password is None:
+        return "password is none"
+
+    password = password.strip()
+
+    if not validators.is_password_allowed(password):
+        return "password validation failed"
+
+    if not verify_password(password, password_hash):
+        return "wrong password"
+
+    return None
+
+
+def token_serializer() -> URLSafeTimedSerializer:
+    """Return the serializer used to sign and verify upload tokens with SECRET_KEY."""
+    return URLSafeTimedSerializer(current_app.config["SECRET_KEY"], salt=UPLOAD_TOKEN_SALT)
+
+
+def create_upload_token(client_id: Optional[str] = None) -> str:
+    """Create a signed upload token for a client that is valid for UPLOAD_TOKEN_TTL seconds.
+
+    Args:
+        client_id (Optional[str]): Client the token is valid for, None for the default client.
+
+    Returns:
+        str: The signed upload token.
+    """
+    return token_serializer().dumps({"scope": "upload", "client": client_id})
+
+
+def check_upload_token(token: str, client_id: Optional[str] = None) -> Optional[str]:
+    """Check that an upload token is correctly signed, not expired and made for the client.
+
+    Checking a token is a HMAC verification and costs microseconds, no Argon2.
+
+    Args:
+        token (str): Upload token from the request.
+        client_id (Optional[str]): Client of the request, None for the default client.
+
+    Returns:
+        Optional[str]: Error message if the check failed, otherwise None.
+    """
+    try:
+        data = token_serializer().loads(token.strip(), max_age=current_app.config["UPLOAD_TOKEN_TTL"])
+    except SignatureExpired:
+        return "token is expired"
+    except BadSignature:
+        return "wrong token"
+
+    if not isinstance(data, dict) or data.get("scope") != "upload" or data.get("client") != client_id:
+        return "wrong token"
+
+    return None
+
+
+def check_credentials(password: Optional[str], token: Optional[str], client: dict) -> Optional[str]:
+    """Check an upload token if one is given, otherwise check the password of the client.
+
+    Args:
+        password (Optional[str]): Password from the request.
+        token (Optional[str]): Upload token from the request.
+        client (dict): Client of the request from get_client.
+
+    Returns:
+        Optional[str]: Error message if the check failed, otherwise None.
+    """
+    if token is not None:
+        return check_upload_token(token, client["id"])
+
+    return check_password(password, client["password_hash"])
+
+
+def authenticate(client_id: Optional[str], password: Optional[str],
+                 token: Optional[str]) -> Tuple[Optional[dict], Optional[str]]:
+    """Look up the client of the request and check its password or upload token.
+
+    Args:
+        client_id (Optional[str]): Client id from the request, None for the default client.
+        password (Optional[str]): Password from the request.
+        token (Optional[str]): Upload token from the request.
+
+    Returns:
+        tuple: The client as a dict and None, or None and an error message.
+    """
+    client, error = get_client(client_id)
+    if error is not None:
+        return None, error
+
+    error = check_credentials(password, token, client)
+    if error is not None:
+        return None, error
+
+    return client, None
+
+
+@bp.route("/auth", methods=["POST"])
+def auth() -> Response:
+    """Verify the password once and return a short lived signed upload token.
+
+    The token can be used instead of the password on the upload endpoints until it
+    expires, so the Argon2 verification is only done once per batch of uploads.
+
+    Request Form Parameters:
+        password (str): Authentication password for the request
+        client (str, optional): Client id, the token is only valid for this client
+
+    Error Responses:
+        "error: client validation failed": If client fails validation
+        "error: client do not exist": If client is not configured in CLIENTS
+        "error: password is none": If password parameter is missing
+        "error: password validation failed": If password fails validation
+        "error: wrong password": If authentication password is incorrect
+
+    Success Response:
+        JSON with token and expires_in seconds.
+    """
+    client, error = authenticate(request.form.get('client'), request.form.get('password'), None)
+    if error is not None:
+        current_app.logger.error(error)
+        return make_response("error: " + error, 200)
+
+    current_app.logger.info("created upload token")
+    return jsonify({
+        "token": create_upload_token(client["id"]),
+        "expires_in": current_app.config["UPLOAD_TOKEN_TTL"],
+    })
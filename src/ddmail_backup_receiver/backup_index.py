@@ -0,0 +1,395 @@
+import os
+import sqlite3
+import tempfile
+import threading
+from typing import List, Optional, Tuple
+
+# Folders that have been reconciled with the disc by this process, (db_path, folder).
+_rebuilt_folders = set()
+_rebuilt_folders_lock = threading.Lock()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    folder TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    sha256 TEXT,
+    PRIMARY KEY (folder, name)
+);
+CREATE INDEX IF NOT EXISTS backups_folder_mtime ON backups (folder, mtime);
+CREATE TABLE IF NOT EXISTS chunks (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    refcount INTEGER NOT NULL
+);
+"""
+
+# Columns backups can be sorted by in page_backups.
+SORT_COLUMNS = ("name", "size", "mtime")
+
+# Folder in every backup folder with a checksum sidecar per backup with a known checksum.
+SIDECAR_FOLDER_NAME = ".checksums"
+
+
+def connect(db_path: str) -> sqlite3.Connection:
+    """Open the backup index database and create the tables if they do not exist.
+
+    Args:
+        db_path (str): Path to the SQLite database file.
+
+    Returns:
+        sqlite3.Connection: Connection to the backup index.
+    """
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def folder_key(folder: str) -> str:
+    """Return the normalized folder path used as key in the index."""
+    return os.path.abspath(folder)
+
+
+def sidecar_folder(folder: str) -> str:
+    """Return the folder with the checksum sidecars of the backups in folder."""
+    return os.path.join(folder, SIDECAR_FOLDER_NAME)
+
+
+def sidecar_path(folder: str, name: str) -> str:
+    """Return the path of the checksum sidecar of the backup name in folder."""
+    return os.path.join(sidecar_folder(folder), name)
+
+
+def write_sidecar(folder: str, name: str, sha256: str) -> None:
+    """Save the checksum of a backup in its sidecar, replacing the sidecar atomically.
+
+    The sidecar is saved as SIDECAR_FOLDER_NAME/name in folder and has one line in
+    the format of sha256sum, the checksum as stored in the index and the name of the
+    backup. Sidecars of plain sha256 backups can be checked in folder with
+    sha256sum -c .checksums/name. The checksum is always of the uploaded data, also
+    when the backup is stored compressed or as a manifest. The modification time of
+    the sidecar is set to the one of the backup, so a sidecar of an earlier file with
+    the same name can be told apart.
+
+    Args:
+        folder (str): Folder where the backup is stored.
+        name (str): File name of the backup.
+        sha256 (str): Checksum of the backup, see checksums.index_checksum.
+
+    Returns:
+        None
+    """
+    st = os.stat(os.path.join(folder, name))
+    os.makedirs(sidecar_folder(folder), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=sidecar_folder(folder), prefix=".tmp-")
+    with os.fdopen(fd, 'w') as f:
+        f.write(sha256 + "  " + name + "\n")
+    os.utime(tmp_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.replace(tmp_path, sidecar_path(folder, name))
+
+
+def read_sidecar(folder: str, name: str) -> Optional[str]:
+    """Return the checksum from the sidecar of a backup or None if it has no sidecar.
+
+    A sidecar with another modification time than the backup belongs to an earlier
+    file with the same name and is not used.
+
+    Args:
+        folder (str): Folder where the backup is stored.
+        name (str): File name of the backup.
+
+    Returns:
+        Optional[str]: Checksum of the backup, see checksums.index_checksum.
+    """
+    path = sidecar_path(folder, name)
+    try:
+        if os.stat(path).st_mtime_ns != os.stat(os.path.join(folder, name)).st_mtime_ns:
+            return None
+        with open(path, 'r') as f:
+            line = f.readline()
+    except FileNotFoundError:
+        return None
+
+    checksum, _, sidecar_name = line.rstrip("\n").partition("  ")
+    if sidecar_name != name or not checksum:
+        return None
+    return checksum
+
+
+def remove_sidecar(folder: str, name: str) -> None:
+    """Remove the sidecar of a backup if it has one."""
+    try:
+        os.remove(sidecar_path(folder, name))
+    except FileNotFoundError:
+        pass
+
+
+def add_backup(db_path: str, folder: str, name: str, sha256: Optional[str]) -> None:
+    """Add or replace a stored backup in the index.
+
+    Size and modification time is taken from the file on disc. A known checksum is
+    also saved in the sidecar of the backup, so it survives a lost index.
+
+    Args:
+        db_path (str): Path to the SQLite database file.
+        folder (str): Folder where the backup is stored.
+        name (str): File name of the backup.
+        sha256 (Optional[str]): SHA256 checksum of the backup if known.
+
+    Returns:
+        None
+    """
+    st = os.stat(os.path.join(folder, name))
+    if sha256 is None:
+        remove_sidecar(folder, name)
+    else:
+        write_sidecar(folder, name, sha256)
+
+    conn = connect(db_path)
+    try:
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO backups (folder, name, size, mtime, sha256) VALUES (?, ?, ?, ?, ?)",
+                (folder_key(folder), name, st.st_size, st.st_mtime, sha256)
+            )
+    finally:
+        conn.close()
+
+
+def remove_backup(db_path: str, folder: str, name: str) -> None:
+    """Remove a backup and its sidecar from the index.
+
+    Args:
+        db_path (str): Path to the SQLite database file.
+        folder (str): Folder where the backup was stored.
+        name (str): File name of the backup.
+
+    Returns:
+        None
+    """
+    conn = connect(db_path)
+    try:
+        with conn:
+            conn.execute("DELETE FROM backups WHERE folder = ? AND name = ?", (folder_key(folder), name))
+    finally:
+        conn.close()
+
+    remove_sidecar(folder, name)
+
+
+def get_backup(db_path: str, folder: str, name: str) -> Optional[dict]:
+    """Return name, size, mtime and sha256 of a backup or None if it is not in the index.
+
+    Args:
+        db_path (str): Path to the SQLite database file.
+        folder (str): Folder where the backup is stored.
+        name (str): File name of the backup.
+
+    Returns:
+        Optional[dict]: The indexed backup.
+    """
+    conn = connect(db_path)
+    try:
+        row = conn.execute(
+            "SELECT name, size, mtime, sha256 FROM backups WHERE folder = ? AND name = ?",
+            (folder_key(folder), name)
+        ).fetchone()
+    finally:
+        conn.close()
+
+    if row is None:
+        return None
+    return {"name": row[0], "size": row[1], "mtime": row[2], "sha256": row[3]}
+
+
+def rebuild_folder(db_path: str, folder: str) -> None:
+    """Reconcile the index of folder with the files on disc.
+
+    Only the directory is scanned, no backup is read. Files that are gone are removed
+    from the index and their sidecars are removed, new files are added with the
+    checksum from their sidecar and the sha256 of a file is kept as long as its size
+    and modification time is unchanged.
+
+    Args:
+        db_path (str): Path to the SQLite database file.
+        folder (str): Folder where backups are stored.
+
+    Returns:
+        None
+    """
+    key = folder_key(folder)
+    on_disc = {}
+    for entry in os.scandir(folder):
+        if entry.is_file() and not entry.name.startswith("."):
+            st = entry.stat()
+            on_disc[entry.name] = (st.st_size, st.st_mtime)
+
+    sidecars = set()
+    if os.path.isdir(sidecar_folder(folder)):
+        sidecars = {entry.name for entry in os.scandir(sidecar_folder(folder)) if not entry.name.startswith(".")}
+
+    for name in sidecars - on_disc.keys():
+        remove_sidecar(folder, name)
+
+    conn = connect(db_path)
+    try:
+        with conn:
+            indexed = {
+                row[0]: (row[1], row[2])
+                for row in conn.execute("SELECT name, size, mtime FROM backups WHERE folder = ?", (key,))
+            }
+            for name in indexed.keys() - on_disc.keys():
+                conn.execute("DELETE FROM backups WHERE folder = ? AND name = ?", (key, name))
+            for name, (size, mtime) in on_disc.items():
+                if indexed.get(name) != (size, mtime):
+                    sha256 = read_sidecar(folder, name) if name in sidecars else None
+                    conn.execute(
+                        "INSERT OR REPLACE INTO backups (folder, name, size, mtime, sha256) VALUES (?, ?, ?, ?, ?)",
+                        (key, name, size, mtime, sha256)
+                    )
+    finally:
+        conn.close()
+
+    with _rebuilt_folders_lock:
+        _rebuilt_folders.add((db_path, key))
+
+
+def ensure_folder(db_path: str, folder: str) -> None:
+    """Rebuild the index of folder if it has not been rebuilt by this process yet.
+
+    Args:
+        db_path (str): Path to the SQLite database file.
+        folder (str): Folder where backups are stored.
+
+    Returns:
+        None
+    """
+    with _rebuilt_folders_lock:
+        if (db_path, folder_key(folder)) in _rebuilt_folders:
+            return
+
+    rebuild_folder(db_path, folder)
+
+
+def backups_to_remove(db_path: str, folder: str, backups_to_save: int) -> List[str]:
+    """Return the names of the backups that is older then the newest backups_to_save backups.
+
+    Args:
+        db_path (str): Path to the SQLite database file.
+        folder (str): Folder where backups are stored.
+        backups_to_save (int): Number of backups to save.
+
+    Returns:
+        List[str]: Names of the backups to remove, newest first.
+    """
+    conn = connect(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT name FROM backups WHERE folder = ? ORDER BY mtime DESC, name DESC LIMIT -1 OFFSET ?",
+            (folder_key(folder), backups_to_save)
+        ).fetchall()
+    finally:
+        conn.close()
+
+    return [row[0] for row in rows]
+
+
+def latest_backup(db_path: str, folder: str) -> Optional[dict]:
+    """Return name, size, mtime and sha256 of the newest backup in folder or None if it has no backups.
+
+    Args:
+        db_path (str): Path to the SQLite database file.
+        folder (str): Folder where backups are stored.
+
+    Returns:
+        Optional[dict]: The newest indexed backup.
+    """
+    conn = connect(db_path)
+    try:
+        row = conn.execute(
+            "SELECT name, size, mtime, sha256 FROM backups WHERE folder = ? ORDER BY mtime DESC, name DESC LIMIT 1",
+            (folder_key(folder),)
+        ).fetchone()
+    finally:
+        conn.close()
+
+    if row is None:
+        return None
+    return {"name": row[0], "size": row[1], "mtime": row[2], "sha256": row[3]}
+
+
+def folder_size(db_path: str, folder: str) -> int:
+    """Return the total size in bytes of the backups in folder.
+
+    Args:
+        db_path (str): Path to the SQLite database file.
+        folder (str): Folder where backups are stored.
+
+    Returns:
+        int: Sum of the sizes of the indexed backups.
+    """
+    conn = connect(db_path)
+    try:
+        row = conn.execute("SELECT COALESCE(SUM(size), 0) FROM backups WHERE folder = ?",
+                           (folder_key(folder),)).fetchone()
+    finally:
+        conn.close()
+
+    return row[0]
+
+
+def list_backups(db_path: str, folder: str) -> List[dict]:
+    """Return name, size, mtime and sha256 of every backup in folder, oldest first.
+
+    Args:
+        db_path (str): Path to the SQLite database file.
+        folder (str): Folder where backups are stored.
+
+    Returns:
+        List[dict]: The indexed backups.
+    """
+    conn = connect(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT name, size, mtime, sha256 FROM backups WHERE folder = ? ORDER BY mtime, name",
+            (folder_key(folder),)
+        ).fetchall()
+    finally:
+        conn.close()
+
+    return [{"name": row[0], "size": row[1], "mtime": row[2], "sha256": row[3]} for row in rows]
+
+
+def page_backups(db_path: str, folder: str, sort: str, descending: bool, limit: int,
+                 offset: int) -> Tuple[List[dict], int]:
+    """Return one page of the backups in folder and the number of backups in folder.
+
+    Args:
+        db_path (str): Path to the SQLite database file.
+        folder (str): Folder where backups are stored.
+        sort (str): Column to sort by, one of SORT_COLUMNS. Ties is sorted by name.
+        descending (bool): Sort with the largest value first.
+        limit (int): Max number of backups to return.
+        offset (int): Number of backups to skip.
+
+    Returns:
+        tuple: Name, size, mtime and sha256 of the backups on the page, and the total number of backups.
+    """
+    if sort not in SORT_COLUMNS:
+        raise ValueError("can not sort backups by " + sort)
+    direction = "DESC" if descending else "ASC"
+
+    conn = connect(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT name, size, mtime, sha256 FROM backups WHERE folder = ? ORDER BY " + sort + " " + direction +
+            ", name " + direction + " LIMIT ? OFFSET ?",
+            (folder_key(folder), limit, offset)
+        ).fetchall()
+        total = conn.execute("SELECT COUNT(*) FROM backups WHERE folder = ?", (folder_key(folder),)).fetchone()[0]
+    finally:
+        conn.close()
+
+    return [{"name": row[0], "size": row[1], "mtime": row[2], "sha256": row[3]} for row in rows], total
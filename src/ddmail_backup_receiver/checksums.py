@@ -0,0 +1,179 @@
+import os
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+# Algorithm used when the client do not ask for another, and the only one older clients know.
+DEFAULT_ALGORITHM = "sha256"
+
+# Size of the leaves of the sha256-tree Merkle tree.
+LEAF_SIZE = 1048576
+
+# Prefixes that separate leaf and node hashes in the sha256-tree Merkle tree.
+LEAF_PREFIX = b"\x00"
+NODE_PREFIX = b"\x01"
+
+
+def leaf_digest(data) -> bytes:
+    """Return the sha256-tree hash of one leaf of data."""
+    h = hashlib.sha256(LEAF_PREFIX)
+    h.update(data)
+    return h.digest()
+
+
+def merkle_root(leaves: List[bytes]) -> bytes:
+    """Return the root of the Merkle tree over the leaf hashes.
+
+    Every level hashes pairs of nodes as SHA256(0x01 || left || right). The last node
+    of a level with an odd number of nodes is moved up to the next level unchanged.
+    """
+    level = leaves
+    while len(level) > 1:
+        next_level = [hashlib.sha256(NODE_PREFIX + level[i] + level[i + 1]).digest()
+                      for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            next_level.append(level[-1])
+        level = next_level
+    return level[0]
+
+
+class TreeSha256:
+    """SHA-256 Merkle tree over LEAF_SIZE leaves, with the leaves hashed in parallel.
+
+    The data is split into leaves of LEAF_SIZE bytes, the last leaf can be shorter and
+    empty data is one empty leaf. A leaf is hashed as SHA256(0x00 || leaf) and the
+    hashes is combined with merkle_root. hashlib releases the GIL while it hashes, so
+    the leaves is hashed on several cores by a thread pool while the caller reads the
+    next part of the stream. At most two leaves per thread is queued, so memory use is
+    bounded.
+
+    It has the update and hexdigest methods of hashlib objects.
+    """
+
+    name = "sha256-tree"
+
+    def __init__(self, threads: int = 0):
+        """Hash leaves with threads threads, 0 is one per CPU."""
+        self.threads = threads or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(self.threads) if self.threads > 1 else None
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.leaves = []
+        self.root = None
+
+    def add_leaf(self, data) -> None:
+        """Hash a full or last leaf."""
+        if self.executor is None:
+            self.leaves.append(leaf_digest(data))
+            return
+
+        self.pending.append(self.executor.submit(leaf_digest, data))
+        while len(self.pending) > self.threads * 2:
+            self.leaves.append(self.pending.popleft().result())
+
+    def update(self, data) -> None:
+        """Add data to the hash."""
+        # Slices of bytes can be hashed without a copy, other buffers can change after update.
+        view = memoryview(data if isinstance(data, bytes) else bytes(data))
+        if self.buffer:
+            needed = LEAF_SIZE - len(self.buffer)
+            self.buffer += view[:needed]
+            view = view[needed:]
+            if len(self.buffer) < LEAF_SIZE:
+                return
+            self.add_leaf(bytes(self.buffer))
+            self.buffer = bytearray()
+
+        while len(view) >= LEAF_SIZE:
+            self.add_leaf(view[:LEAF_SIZE])
+            view = view[LEAF_SIZE:]
+        self.buffer += view
+
+    def digest(self) -> bytes:
+        """Return the Merkle root, no more data can be added after this."""
+        if self.root is None:
+            if self.buffer or not (self.leaves or self.pending):
+                self.add_leaf(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.pending:
+                self.leaves.append(self.pending.popleft().result())
+            if self.executor is not None:
+                self.executor.shutdown()
+            self.root = merkle_root(self.leaves)
+        return self.root
+
+    def hexdigest(self) -> str:
+        """Return the Merkle root as hex."""
+        return self.digest().hex()
+
+
+def is_blake3_available() -> bool:
+    """Return True if the optional blake3 package is installed."""
+    return blake3 is not None
+
+
+def available_algorithms() -> List[str]:
+    """Return the checksum algorithms that can be used, the default first."""
+    algorithms = [DEFAULT_ALGORITHM, TreeSha256.name]
+    if is_blake3_available():
+        algorithms.append("blake3")
+    return algorithms
+
+
+def new_hasher(algorithm: str = DEFAULT_ALGORITHM, threads: int = 0):
+    """Return a hash object for algorithm.
+
+    Args:
+        algorithm (str, optional): sha256, sha256-tree or blake3, see available_algorithms.
+        threads (int, optional): Threads used by sha256-tree and blake3, 0 is one per CPU.
+
+    Returns:
+        Hash object with update and hexdigest.
+    """
+    if algorithm == DEFAULT_ALGORITHM:
+        return hashlib.sha256()
+    if algorithm == TreeSha256.name:
+        return TreeSha256(threads)
+    if algorithm == "blake3" and is_blake3_available():
+        return blake3.blake3(max_threads=threads or blake3.blake3.AUTO)
+    raise ValueError("checksum algorithm " + algorithm + " is not available")
+
+
+def checksum_of_file(path: str, algorithm: str = DEFAULT_ALGORITHM, threads: int = 0,
+                     buf_size: int = 1048576) -> str:
+    """Return the checksum of a file as hex with algorithm, see new_hasher."""
+    hasher = new_hasher(algorithm, threads)
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(buf_size)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+def index_checksum(algorithm: str, checksum: str) -> str:
+    """Return the checksum as stored in the backup index and manifests.
+
+    SHA256 checksums is stored as hex like before other algorithms existed, other
+    checksums is stored as algorithm:hex.
+    """
+    if algorithm == DEFAULT_ALGORITHM:
+        return checksum
+    return algorithm + ":" + checksum
+
+
+def split_checksum(value: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+    """Return the algorithm and hex checksum of a checksum from index_checksum, or None and None."""
+    if value is None:
+        return None, None
+    if ":" in value:
+        algorithm, checksum = value.split(":", 1)
+        return algorithm, checksum
+    return DEFAULT_ALGORITHM, value
@@ -0,0 +1,76 @@
+import os
+import re
+from typing import Optional, Tuple
+from flask import current_app
+
+# Name of the hidden folder inside UPLOAD_FOLDER where the folders of clients are stored.
+# The default client stores its backups directly in UPLOAD_FOLDER, so client folders must
+# not share names with backups.
+CLIENTS_FOLDER_NAME = ".clients"
+
+
+def is_client_id_allowed(client_id: str) -> bool:
+    """Validate a client id, only A-Z, a-z, 0-9, - and _ is allowed and max 64 chars.
+
+    Args:
+        client_id (str): Client id to validate.
+
+    Returns:
+        bool: True if the client id is valid, otherwise False.
+    """
+    return re.fullmatch(r"[a-zA-Z0-9][a-zA-Z0-9_-]{0,63}", client_id) is not None
+
+
+def client_upload_folder(upload_folder: str, client_id: str) -> str:
+    """Return the folder where backups of client_id is stored inside upload_folder."""
+    return os.path.join(upload_folder, CLIENTS_FOLDER_NAME, client_id)
+
+
+def get_client(client_id: Optional[str]) -> Tuple[Optional[dict], Optional[str]]:
+    """Return password hash, upload folder, number of backups to save, quota and rate limit of a client.
+
+    Every client configured in CLIENTS has its own subfolder in UPLOAD_FOLDER/.clients and its own
+    retention, so pruning only looks at the backups of one client. Without a client id
+    the default client is returned, it uses PASSWORD_HASH, UPLOAD_FOLDER, BACKUPS_TO_SAVE, QUOTA
+    and RATE_LIMIT_CLIENT_MB.
+    The folder of a client is created if UPLOAD_FOLDER exist.
+
+    Args:
+        client_id (Optional[str]): Client id from the request.
+
+    Returns:
+        tuple: The client as a dict and None, or None and an error message.
+    """
+    upload_folder = current_app.config["UPLOAD_FOLDER"]
+
+    if client_id is None:
+        return {
+            "id": None,
+            "password_hash": current_app.config["PASSWORD_HASH"],
+            "upload_folder": upload_folder,
+            "backups_to_save": current_app.config["BACKUPS_TO_SAVE"],
+            "quota": current_app.config["QUOTA"],
+            "rate_limit": current_app.config["RATE_LIMIT_CLIENT_MB"],
+        }, None
+
+    client_id = client_id.strip()
+
+    if not is_client_id_allowed(client_id):
+        return None, "client validation failed"
+
+    clients = current_app.config["CLIENTS"]
+    if client_id not in clients:
+        return None, "client do not exist"
+
+    folder = client_upload_folder(upload_folder, client_id)
+    if os.path.isdir(upload_folder) and not os.path.isdir(folder):
+        os.makedirs(folder, exist_ok=True)
+
+    return {
+        "id": client_id,
+        "password_hash": clients[client_id]["PASSWORD_HASH"],
+        "upload_folder": folder,
+        "backups_to_save": clients[client_id].get("BACKUPS_TO_SAVE", current_app.config["BACKUPS_TO_SAVE"]),
+        "quota": clients[client_id].get("QUOTA", current_app.config["QUOTA"]),
+        "rate_limit": clients[client_id].get("RATE_LIMIT_MB", current_app.config["RATE_LIMIT_CLIENT_MB"]),
+    }, None
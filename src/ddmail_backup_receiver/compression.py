@@ -0,0 +1,64 @@
+import hashlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Suffix of backups stored compressed with zstd.
+ZSTD_SUFFIX = ".zst"
+
+
+def is_zstd_available() -> bool:
+    """Return True if the optional zstandard package is installed."""
+    return zstandard is not None
+
+
+def save_zstd_and_sha256(stream, full_path: str, level: int = 3, threads: int = -1, buf_size: int = 1048576,
+                         hasher=None) -> str:
+    """Compress a stream with zstd to disc and calculate the SHA256 checksum of the uncompressed data.
+
+    The checksum is taken over the bytes read from the stream, so it can be compared
+    with the checksum the client calculated over the original file. The compression
+    is done by zstd worker threads while the next part of the stream is read.
+
+    Args:
+        stream: Binary file-like object to read the data from.
+        full_path (str): Path to the file to save the compressed data to.
+        level (int, optional): zstd compression level.
+        threads (int, optional): Number of zstd worker threads, 0 compress in the calling
+                                 thread and -1 use one thread per CPU.
+        buf_size (int, optional): Number of bytes to read and compress per chunk.
+        hasher (optional): Hash object from checksums.new_hasher to use instead of SHA256.
+
+    Returns:
+        str: Hexadecimal representation of the SHA256 hash of the uncompressed data.
+    """
+    sha256 = hasher if hasher is not None else hashlib.sha256()
+    cctx = zstandard.ZstdCompressor(level=level, threads=threads)
+
+    with open(full_path, 'wb') as f:
+        with cctx.stream_writer(f, closefd=False) as compressor:
+            while True:
+                data = stream.read(buf_size)
+                if not data:
+                    break
+                sha256.update(data)
+                compressor.write(data)
+
+    return sha256.hexdigest()
+
+
+def open_backup(full_path: str):
+    """Open a stored backup for reading its original bytes, decompressing it if it is compressed.
+
+    Args:
+        full_path (str): Path to the stored backup.
+
+    Returns:
+        Binary file-like object with the uncompressed data of the backup.
+    """
+    if full_path.endswith(ZSTD_SUFFIX):
+        return zstandard.ZstdDecompressor().stream_reader(open(full_path, 'rb'), closefd=True)
+
+    return open(full_path, 'rb')
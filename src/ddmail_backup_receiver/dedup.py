@@ -0,0 +1,383 @@
+import io
+import os
+import json
+import fcntl
+import hashlib
+import tempfile
+import contextlib
+from collections import Counter
+from typing import Iterator, List, Tuple
+from ddmail_backup_receiver import backup_index
+from ddmail_backup_receiver import checksums
+
+# Name of the hidden folder inside UPLOAD_FOLDER where chunks are stored. All clients
+# share the same chunk store, so data that is the same for several clients is stored once.
+CHUNKS_FOLDER_NAME = ".chunks"
+
+# Suffix of the manifest that is stored in the upload folder instead of the backup.
+MANIFEST_SUFFIX = ".manifest"
+
+# Chunk size limits in bytes, the average chunk size is about 384 KiB.
+MIN_CHUNK_SIZE = 131072
+MAX_CHUNK_SIZE = 2097152
+
+# Number of bytes translated and searched for a boundary at a time.
+SCAN_SIZE = 65536
+
+# Number of bytes of chunks that is added to the store in one transaction.
+BATCH_SIZE = 8388608
+
+# Every byte is mapped to 3 bits by a fixed gear table and a chunk ends where the
+# bits of the last 6 bytes is equal to a fixed 18 bit pattern. This is a gear
+# rolling hash over a 6 byte window with an 18 bit mask, but written as a
+# bytes.translate and bytes.find so the scan is done in C. Both tables is derived
+# from fixed seeds so chunk boundaries is the same in every process and version.
+_GEAR_TABLE = bytes(0x41 + (b & 0x07) for b in hashlib.shake_256(b"ddmail gear table").digest(256))
+_BOUNDARY = bytes(0x41 + (b & 0x07) for b in hashlib.shake_256(b"ddmail boundary").digest(6))
+
+
+def chunk_store_folder(upload_folder: str) -> str:
+    """Return the folder where chunks are stored for UPLOAD_FOLDER upload_folder."""
+    return os.path.join(upload_folder, CHUNKS_FOLDER_NAME)
+
+
+def chunk_path(store: str, digest: str) -> str:
+    """Return the path of the chunk with SHA256 checksum digest in store."""
+    return os.path.join(store, digest[:2], digest)
+
+
+@contextlib.contextmanager
+def store_lock(store: str, operation: int):
+    """Hold a cross process flock on store, LOCK_SH to add chunks and LOCK_EX to remove chunks."""
+    with open(os.path.join(store, "lock"), 'w') as lock:
+        fcntl.flock(lock, operation)
+        yield
+
+
+@contextlib.contextmanager
+def manifest_lock(store: str):
+    """Hold a cross process flock while a manifest is replaced or removed and its chunks is released.
+
+    Without it two uploads of the same name could both read the same old manifest
+    and release its chunks twice, which removes chunks other manifests still use.
+    """
+    if not os.path.isdir(store):
+        # No chunks is stored yet, so a manifest has no chunks to release.
+        yield
+        return
+
+    with open(os.path.join(store, "manifests.lock"), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def find_chunk_end(buf: bytearray, eof: bool) -> int:
+    """Return the length of the first chunk in buf.
+
+    Args:
+        buf (bytearray): Data not yet split into chunks, at least MAX_CHUNK_SIZE bytes unless eof.
+        eof (bool): True if buf holds the last data of the stream.
+
+    Returns:
+        int: Number of bytes from the start of buf that make up the next chunk.
+    """
+    if len(buf) <= MIN_CHUNK_SIZE:
+        return len(buf)
+
+    # Search SCAN_SIZE bytes at a time, most chunks end long before MAX_CHUNK_SIZE.
+    start = MIN_CHUNK_SIZE - len(_BOUNDARY)
+    end = min(len(buf), MAX_CHUNK_SIZE)
+    while True:
+        stop = min(start + SCAN_SIZE, end)
+        i = buf[start:stop].translate(_GEAR_TABLE).find(_BOUNDARY)
+        if i != -1:
+            return start + i + len(_BOUNDARY)
+        if stop == end:
+            return end
+        start = stop - len(_BOUNDARY) + 1
+
+
+def iter_chunks(stream, read_size: int = 1048576) -> Iterator[bytes]:
+    """Split a stream into content-defined chunks.
+
+    A boundary only depends on the bytes just before it, so data inserted or removed
+    in a backup only changes the chunks around the change and the rest of the
+    chunks is the same as in the previous backup.
+
+    Args:
+        stream: Binary file-like object to read the data from.
+        read_size (int, optional): Number of bytes to read from the stream at a time.
+
+    Returns:
+        Iterator[bytes]: The chunks in stream order.
+    """
+    buf = bytearray()
+    eof = False
+
+    while True:
+        while not eof and len(buf) < MAX_CHUNK_SIZE:
+            data = stream.read(read_size)
+            if not data:
+                eof = True
+            buf += data
+
+        if not buf:
+            return
+
+        end = find_chunk_end(buf, eof)
+        with memoryview(buf) as view:
+            chunk = bytes(view[:end])
+        del buf[:end]
+        yield chunk
+
+
+def add_chunks(conn, store: str, chunks: List[Tuple[str, bytes]]) -> None:
+    """Add a reference to every chunk and write the chunks that is not already in store.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the backup index.
+        store (str): Folder where chunks are stored.
+        chunks (List[Tuple[str, bytes]]): SHA256 checksum and data of the chunks.
+
+    Returns:
+        None
+    """
+    with store_lock(store, fcntl.LOCK_SH):
+        with conn:
+            conn.executemany(
+                "INSERT INTO chunks (digest, size, refcount) VALUES (?, ?, 1) "
+                "ON CONFLICT (digest) DO UPDATE SET refcount = refcount + 1",
+                [(digest, len(data)) for digest, data in chunks]
+            )
+
+        for digest, data in chunks:
+            path = chunk_path(store, digest)
+            if os.path.exists(path):
+                continue
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+
+def release_chunks(conn, store: str, digests: List[str]) -> int:
+    """Remove one reference per digest and remove chunks that are no longer referenced.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the backup index.
+        store (str): Folder where chunks are stored.
+        digests (List[str]): SHA256 checksums of the chunks, once per reference.
+
+    Returns:
+        int: Number of chunks removed from store.
+    """
+    if not digests:
+        return 0
+
+    counts = Counter(digests)
+    unused = []
+
+    with store_lock(store, fcntl.LOCK_EX):
+        with conn:
+            for digest, count in counts.items():
+                conn.execute("UPDATE chunks SET refcount = refcount - ? WHERE digest = ?", (count, digest))
+                row = conn.execute("SELECT refcount FROM chunks WHERE digest = ?", (digest,)).fetchone()
+                if row is not None and row[0] <= 0:
+                    unused.append(digest)
+            conn.executemany("DELETE FROM chunks WHERE digest = ?", [(digest,) for digest in unused])
+
+        for digest in unused:
+            try:
+                os.remove(chunk_path(store, digest))
+            except FileNotFoundError:
+                pass
+
+    return len(unused)
+
+
+def read_manifest(manifest_path: str) -> dict:
+    """Read a manifest, a dict with size, sha256 and the chunks as [digest, size] pairs."""
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def save_dedup(stream, store: str, db_path: str, manifest_path: str, read_size: int = 1048576,
+               hasher=None) -> str:
+    """Store a stream as chunks in store and write its manifest to manifest_path.
+
+    Only chunks that are not already in store is written. manifest_path is a new
+    file, see replace_manifest to move it over a stored manifest. If the stream fails
+    the chunks added so far is released again.
+
+    Args:
+        stream: Binary file-like object to read the data from.
+        store (str): Folder where chunks are stored.
+        db_path (str): Path to the backup index where chunk references are counted.
+        manifest_path (str): Path to write the manifest to.
+        read_size (int, optional): Number of bytes to read from the stream at a time.
+        hasher (optional): Hash object from checksums.new_hasher to use instead of SHA256,
+                           the manifest has the checksum as in checksums.index_checksum.
+
+    Returns:
+        str: Hexadecimal representation of the SHA256 hash of the whole stream.
+    """
+    os.makedirs(store, exist_ok=True)
+    sha256 = hasher if hasher is not None else hashlib.sha256()
+    chunks = []
+    size = 0
+
+    conn = backup_index.connect(db_path)
+    try:
+        try:
+            # Chunks is added in batches to keep the number of transactions and locks down.
+            batch = []
+            batch_size = 0
+            for data in iter_chunks(stream, read_size):
+                sha256.update(data)
+                batch.append((hashlib.sha256(data).hexdigest(), data))
+                batch_size += len(data)
+                if batch_size >= BATCH_SIZE:
+                    add_chunks(conn, store, batch)
+                    chunks.extend([digest, len(data)] for digest, data in batch)
+                    batch = []
+                    batch_size = 0
+                size += len(data)
+            add_chunks(conn, store, batch)
+            chunks.extend([digest, len(data)] for digest, data in batch)
+
+            manifest = {
+                "version": 1,
+                "size": size,
+                "sha256": checksums.index_checksum(sha256.name, sha256.hexdigest()),
+                "chunks": chunks,
+            }
+            with open(manifest_path, 'w') as f:
+                json.dump(manifest, f)
+        except BaseException:
+            release_chunks(conn, store, [chunk[0] for chunk in chunks])
+            raise
+    finally:
+        conn.close()
+
+    return sha256.hexdigest()
+
+
+def replace_manifest(store: str, db_path: str, new_path: str, manifest_path: str) -> int:
+    """Move the manifest new_path to manifest_path and release the chunks of the manifest it replaces.
+
+    Args:
+        store (str): Folder where chunks are stored.
+        db_path (str): Path to the backup index where chunk references are counted.
+        new_path (str): Path to the new manifest from save_dedup.
+        manifest_path (str): Path the manifest is stored as.
+
+    Returns:
+        int: Number of chunks removed from store.
+    """
+    with manifest_lock(store):
+        try:
+            old_chunks = [chunk[0] for chunk in read_manifest(manifest_path)["chunks"]]
+        except FileNotFoundError:
+            old_chunks = []
+        except (ValueError, KeyError, TypeError):
+            # Not a manifest, a file uploaded with the manifest suffix in plain mode.
+            old_chunks = []
+
+        os.replace(new_path, manifest_path)
+
+        conn = backup_index.connect(db_path)
+        try:
+            return release_chunks(conn, store, old_chunks)
+        finally:
+            conn.close()
+
+
+def remove_manifest(store: str, db_path: str, manifest_path: str) -> int:
+    """Remove a manifest and release its chunks.
+
+    The manifest is removed first, so a crash before the chunks is released leaves
+    unused chunks behind and never a manifest with missing chunks.
+
+    Args:
+        store (str): Folder where chunks are stored.
+        db_path (str): Path to the backup index where chunk references are counted.
+        manifest_path (str): Path to the manifest.
+
+    Returns:
+        int: Number of chunks removed from store.
+    """
+    with manifest_lock(store):
+        try:
+            chunks = [chunk[0] for chunk in read_manifest(manifest_path)["chunks"]]
+        except FileNotFoundError:
+            return 0
+        except (ValueError, KeyError, TypeError):
+            # Not a manifest, a file uploaded with the manifest suffix in plain mode.
+            chunks = []
+
+        os.remove(manifest_path)
+
+        conn = backup_index.connect(db_path)
+        try:
+            return release_chunks(conn, store, chunks)
+        finally:
+            conn.close()
+
+
+def iter_backup(store: str, manifest_path: str) -> Iterator[bytes]:
+    """Read back the backup of a manifest chunk by chunk.
+
+    Args:
+        store (str): Folder where chunks are stored.
+        manifest_path (str): Path to the manifest.
+
+    Returns:
+        Iterator[bytes]: The data of the backup in order.
+    """
+    for digest, size in read_manifest(manifest_path)["chunks"]:
+        with open(chunk_path(store, digest), 'rb') as f:
+            yield f.read()
+
+
+class ManifestReader(io.RawIOBase):
+    """Read only file object with the data of a manifest, read from the chunk store chunk by chunk."""
+
+    def __init__(self, store: str, manifest_path: str):
+        """Open the backup of manifest_path in store."""
+        super().__init__()
+        self.chunks = iter_backup(store, manifest_path)
+        self.chunk = b""
+        self.pos = 0
+
+    def readable(self) -> bool:
+        """Return True, the backup can be read."""
+        return True
+
+    def readinto(self, b) -> int:
+        """Read up to len(b) bytes into b and return the number of bytes read, 0 at the end."""
+        while self.pos == len(self.chunk):
+            self.chunk = next(self.chunks, None)
+            self.pos = 0
+            if self.chunk is None:
+                self.chunk = b""
+                return 0
+
+        n = min(len(b), len(self.chunk) - self.pos)
+        b[:n] = self.chunk[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+
+def open_backup(store: str, manifest_path: str):
+    """Open the backup of a manifest for reading.
+
+    Args:
+        store (str): Folder where chunks are stored.
+        manifest_path (str): Path to the manifest.
+
+    Returns:
+        Binary file-like object with the data of the backup.
+    """
+    return io.BufferedReader(ManifestReader(store, manifest_path), 1048576)
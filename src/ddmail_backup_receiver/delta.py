@@ -0,0 +1,341 @@
+import os
+import math
+import zlib
+import shutil
+import struct
+import hashlib
+import tempfile
+from flask import Blueprint, current_app, request, make_response, jsonify, Response
+from werkzeug.utils import secure_filename
+import ddmail_validators.validators as validators
+from ddmail_backup_receiver.application import (
+    busy_response,
+    check_upload_headers,
+    early_error_response,
+    open_stored_backup,
+    store_backup,
+    validate_backups_to_save,
+)
+from ddmail_backup_receiver.auth import authenticate
+from ddmail_backup_receiver import admission
+from ddmail_backup_receiver import backup_index
+from ddmail_backup_receiver import checksums
+from ddmail_backup_receiver import compression
+from ddmail_backup_receiver import dedup
+from ddmail_backup_receiver.ingest_limit import acquire_ingest_slot
+from ddmail_backup_receiver.retention import schedule_retention
+from ddmail_backup_receiver.shaping import shape_request
+
+bp = Blueprint("delta", __name__, url_prefix="/delta")
+
+# Limits of the block size of the signatures, in bytes.
+MIN_BLOCK_SIZE = 2048
+MAX_BLOCK_SIZE = 131072
+
+# Instructions of a delta. A copy is followed by offset in the basis (8 bytes) and
+# length (4 bytes), a literal by length (4 bytes) and the data. Numbers is big endian.
+OP_COPY = b"C"
+OP_LITERAL = b"L"
+COPY_HEADER = struct.Struct(">QI")
+LITERAL_HEADER = struct.Struct(">I")
+
+
+class DeltaError(Exception):
+    """Raised when a delta is truncated, has an unknown instruction or copies from outside the basis."""
+
+
+def default_block_size(size: int) -> int:
+    """Return a block size of about the square root of size, like rsync, within the block size limits."""
+    block_size = int(math.sqrt(size)) // 1024 * 1024
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block_size))
+
+
+def block_signatures(stream, block_size: int) -> dict:
+    """Calculate the signatures of every block of a stream.
+
+    The weak hash is Adler-32 as in zlib.adler32, which a client can roll one byte at
+    a time to find blocks at any offset. The strong hash is a 128 bit BLAKE2b digest
+    used to confirm a match of the weak hash. The last block can be shorter.
+
+    Args:
+        stream: Binary file-like object to read the data from.
+        block_size (int): Size of the blocks in bytes.
+
+    Returns:
+        dict: Size and SHA256 checksum of the stream and the signatures as [weak, strong] pairs.
+    """
+    sha256 = hashlib.sha256()
+    signatures = []
+    size = 0
+
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            break
+        # A file object may return less then block_size before the end.
+        while len(block) < block_size:
+            data = stream.read(block_size - len(block))
+            if not data:
+                break
+            block += data
+        sha256.update(block)
+        signatures.append([zlib.adler32(block), hashlib.blake2b(block, digest_size=16).hexdigest()])
+        size += len(block)
+
+    return {"size": size, "sha256": sha256.hexdigest(), "signatures": signatures}
+
+
+def open_basis(upload_folder: str, name: str):
+    """Open a stored backup for reading with seek.
+
+    Plain files is opened directly, a rebuilt file with the same name is written to a
+    temporary file by store_backup and replaces it when it is done, so the open basis
+    do not change while it is read. Compressed and deduplicated backups can not be
+    read at random offsets, so they are copied to an anonymous temporary file in
+    upload_folder first.
+
+    Args:
+        upload_folder (str): Folder where the backup is stored.
+        name (str): Name of the stored backup.
+
+    Returns:
+        Binary file object of the original data of the backup.
+    """
+    if not name.endswith(compression.ZSTD_SUFFIX) and not name.endswith(dedup.MANIFEST_SUFFIX):
+        return open(os.path.join(upload_folder, name), 'rb')
+
+    basis = tempfile.TemporaryFile(dir=upload_folder)
+    with open_stored_backup(upload_folder, name) as f:
+        shutil.copyfileobj(f, basis, 1048576)
+    basis.seek(0)
+    return basis
+
+
+class DeltaReader:
+    """Read only file-like object with the file rebuilt from a delta and its basis.
+
+    The delta is read from stream as it is needed, so the rebuilt file can be passed
+    to store_backup like any other upload stream.
+    """
+
+    def __init__(self, stream, basis):
+        """Rebuild from the delta in stream and the seekable basis file object."""
+        self.stream = stream
+        self.basis = basis
+        self.basis_size = os.fstat(basis.fileno()).st_size
+        self.op = None
+        self.remaining = 0
+
+    def read_exact(self, size: int) -> bytes:
+        """Read exactly size bytes of the delta, raise DeltaError if the delta ends before."""
+        data = b""
+        while len(data) < size:
+            part = self.stream.read(size - len(data))
+            if not part:
+                raise DeltaError("delta is truncated")
+            data += part
+        return data
+
+    def next_op(self) -> bool:
+        """Read the next instruction of the delta, return False at the end of the delta."""
+        op = self.stream.read(1)
+        if not op:
+            return False
+
+        if op == OP_COPY:
+            offset, length = COPY_HEADER.unpack(self.read_exact(COPY_HEADER.size))
+            if offset + length > self.basis_size:
+                raise DeltaError("delta copy is outside of basis")
+            self.basis.seek(offset)
+        elif op == OP_LITERAL:
+            length = LITERAL_HEADER.unpack(self.read_exact(LITERAL_HEADER.size))[0]
+        else:
+            raise DeltaError("delta instruction is unknown")
+
+        self.op = op
+        self.remaining = length
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        """Read up to size bytes of the rebuilt file, all of it if size is negative."""
+        parts = []
+        wanted = size if size >= 0 else math.inf
+
+        while wanted > 0:
+            if self.remaining == 0:
+                if not self.next_op():
+                    break
+                continue
+
+            n = min(wanted, self.remaining)
+            if self.op == OP_COPY:
+                data = self.basis.read(n)
+            else:
+                data = self.stream.read(n)
+            if not data:
+                raise DeltaError("delta is truncated")
+
+            parts.append(data)
+            self.remaining -= len(data)
+            wanted -= len(data)
+
+        return b"".join(parts)
+
+
+@bp.route("/signatures", methods=["POST"])
+def signatures() -> Response:
+    """Return the block signatures of the newest backup, to create a delta upload against.
+
+    Request Form Parameters:
+        password (str): Authentication password for the request
+        token (str): Upload token from /auth, used instead of password
+        client (str, optional): Client id, the newest backup of the client is used
+        block_size (int, optional): Block size in bytes, default is about the square
+                                    root of the backup size
+
+    Error Responses:
+        "error: block_size validation failed": If block_size is not a number within the limits
+        "error: no backup to create a delta against": If the upload folder has no backups
+        Errors from authentication as in receive_backup.
+
+    Success Response:
+        JSON with name, size, sha256 and block_size of the backup, the weak and strong hash
+        algorithms and the signatures as a list of [adler32, blake2b] pairs, one per block.
+    """
+    client, error = authenticate(request.form.get('client'), request.form.get('password'), request.form.get('token'))
+    if error is not None:
+        current_app.logger.error(error)
+        return make_response("error: " + error, 200)
+
+    block_size = request.form.get('block_size')
+    if block_size is not None:
+        block_size = block_size.strip()
+        if not block_size.isdigit() or not MIN_BLOCK_SIZE <= int(block_size) <= MAX_BLOCK_SIZE:
+            current_app.logger.error("block_size validation failed")
+            return make_response("error: block_size validation failed", 200)
+        block_size = int(block_size)
+
+    upload_folder = client["upload_folder"]
+    db_path = current_app.config["BACKUP_INDEX"]
+    backup_index.ensure_folder(db_path, upload_folder)
+    backup = backup_index.latest_backup(db_path, upload_folder)
+    if backup is None:
+        current_app.logger.error("no backup to create a delta against")
+        return make_response("error: no backup to create a delta against", 200)
+
+    if block_size is None:
+        block_size = default_block_size(backup["size"])
+
+    with open_stored_backup(upload_folder, backup["name"]) as f:
+        result = block_signatures(f, block_size)
+
+    current_app.logger.info("created signatures of " + backup["name"])
+    return jsonify({
+        "name": backup["name"],
+        "size": result["size"],
+        "sha256": result["sha256"],
+        "block_size": block_size,
+        "weak": "adler32",
+        "strong": "blake2b-128",
+        "signatures": result["signatures"],
+    })
+
+
+@bp.route("/upload", methods=["POST"])
+def upload_delta() -> Response:
+    """Receive a backup as a delta against a stored backup.
+
+    The request body is a sequence of copy and literal instructions, see OP_COPY and
+    OP_LITERAL. The full file is rebuilt from the basis while it is stored, checked
+    against X-Sha256 like receive_backup_stream and old backups are removed.
+
+    Request Headers:
+        Content-Length (int): Size of the delta, required
+        X-Client (str, optional): Client id, the backup is stored in the client folder
+        X-Filename (str): Name to save the rebuilt file as
+        X-Password (str): Authentication password for the request
+        X-Token (str): Upload token from /auth, used instead of X-Password
+        X-Sha256 (str): Expected SHA256 checksum of the rebuilt file, or checksum with X-Checksum-Algorithm
+        X-Checksum-Algorithm (str, optional): Checksum algorithm, see /checksum_algorithms
+        X-Basis (str): Name of the stored backup the delta was created against, from /delta/signatures
+
+    Error Responses:
+        400: Missing or invalid headers, invalid delta or sha256 checksum do not match
+        401: Unknown client or missing, invalid or wrong password or upload token
+        409: The basis do not exist, create a new delta from new signatures
+        411: Content-Length is missing
+        413: Content-Length is larger than MAX_CONTENT_LENGTH
+        500: Upload folder do not exist or BACKUPS_TO_SAVE is not configured correctly
+        503: INGEST_CONCURRENCY uploads is saved and the wait queue is full or the wait
+             timed out, Retry-After is set to when the upload can be sent again
+        507: The rebuilt file do not fit the free disc space or the quota of the client, see admission
+
+    Success Response:
+        "done": Operation completed successfully
+    """
+    # Check credentials and metadata before the request body is read.
+    client, error, status = check_upload_headers(require_metadata=True)
+    if error is not None:
+        return early_error_response(error, status)
+
+    basis_name = request.headers.get('X-Basis')
+    if basis_name is None:
+        return early_error_response("basis is none", 400)
+    basis_name = basis_name.strip()
+    if not validators.is_filename_allowed(basis_name):
+        return early_error_response("basis validation failed", 400)
+
+    filename = secure_filename(request.headers.get('X-Filename').strip())
+    sha256_from_header = request.headers.get('X-Sha256').strip()
+    algorithm = request.headers.get('X-Checksum-Algorithm', checksums.DEFAULT_ALGORITHM).strip()
+    upload_folder = client["upload_folder"]
+
+    if not os.path.isdir(upload_folder):
+        return early_error_response("upload folder " + upload_folder + " do not exist", 500)
+
+    backups_to_save = client["backups_to_save"]
+    error = validate_backups_to_save(backups_to_save)
+    if error is not None:
+        return early_error_response(error, 500)
+
+    if not os.path.isfile(os.path.join(upload_folder, basis_name)):
+        return early_error_response("basis do not exist", 409)
+
+    # Wait for an ingest slot before the delta is read, if INGEST_CONCURRENCY is set.
+    retry_after = acquire_ingest_slot()
+    if retry_after is not None:
+        return busy_response(retry_after)
+
+    # Reserve disc space and quota for the rebuilt file, which is stored like the basis
+    # and is about the size of the basis on disc plus the new data in the delta.
+    reservation_id, error = admission.reserve(
+        client, os.path.getsize(os.path.join(upload_folder, basis_name)) + request.content_length)
+    if error is not None:
+        return early_error_response(error, 507)
+
+    # Read the delta at the rate of the client, if RATE_LIMIT_MB or a client limit is set.
+    shape_request(client)
+
+    # Rebuild the file from the delta and the basis while it is stored, it is only stored if the checksum match.
+    # An invalid delta is removed by store_backup and never replaces a stored backup.
+    with open_basis(upload_folder, basis_name) as basis:
+        try:
+            name, sha256_from_file = store_backup(DeltaReader(request.stream, basis), upload_folder, filename, 1048576,
+                                                  algorithm, sha256_from_header)
+        except DeltaError as e:
+            return early_error_response(str(e), 400)
+    admission.release(reservation_id)
+
+    # Compare sha256 checksum of the rebuilt file with checksum from header.
+    if sha256_from_header != sha256_from_file:
+        current_app.logger.error("sha256 checksum do not match")
+        return make_response("error: sha256 checksum do not match", 400)
+
+    backup_index.add_backup(current_app.config["BACKUP_INDEX"], upload_folder, name,
+                            checksums.index_checksum(algorithm, sha256_from_file))
+
+    # Delete old backups, in the background unless RETENTION_SYNC is set.
+    schedule_retention(upload_folder, backups_to_save)
+
+    current_app.logger.info("done")
+    return make_response("done", 200)
@@ -0,0 +1,144 @@
+import os
+from typing import Optional
+from flask import Blueprint, current_app, request, make_response, Response
+from gunicorn.http.wsgi import FileWrapper as GunicornFileWrapper
+from werkzeug.utils import send_file
+import ddmail_validators.validators as validators
+from ddmail_backup_receiver.application import open_stored_backup
+from ddmail_backup_receiver.auth import authenticate
+from ddmail_backup_receiver import backup_index
+from ddmail_backup_receiver import compression
+from ddmail_backup_receiver import dedup
+
+bp = Blueprint("download", __name__, url_prefix="/download")
+
+
+class DownloadResponse(Response):
+    """Response that keeps Range requests of a file zero-copy under gunicorn.
+
+    Werkzeug serves a range by wrapping the file in an iterator, so the WSGI server
+    can no longer use sendfile. The file wrapper of gunicorn sends Content-Length
+    bytes with sendfile from the current offset of the file, so for a range it is
+    enough to seek the file to the start of the range.
+
+    _wrap_range_response is not public in Werkzeug, so werkzeug is pinned in
+    pyproject.toml and the tests check that it still exist.
+    """
+
+    def _wrap_range_response(self, start: int, length: int) -> None:
+        """Seek the file to start if gunicorn sends it, otherwise wrap it as Werkzeug does."""
+        if self.status_code == 206 and isinstance(self.response, GunicornFileWrapper):
+            self.response.filelike.seek(start)
+            return
+
+        super()._wrap_range_response(start, length)
+
+
+def find_stored_backup(upload_folder: str, filename: str) -> Optional[str]:
+    """Return the name filename is stored as in upload_folder, plain, compressed or as a manifest.
+
+    Args:
+        upload_folder (str): Folder where backups are stored.
+        filename (str): Name the backup was uploaded as, or the stored name.
+
+    Returns:
+        Optional[str]: Name of the stored backup or None if it do not exist.
+    """
+    for name in (filename, filename + compression.ZSTD_SUFFIX, filename + dedup.MANIFEST_SUFFIX):
+        if os.path.isfile(os.path.join(upload_folder, name)):
+            return name
+    return None
+
+
+def original_name(name: str) -> str:
+    """Return the name a stored backup was uploaded as."""
+    for suffix in (compression.ZSTD_SUFFIX, dedup.MANIFEST_SUFFIX):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def iter_file(f, buf_size: int = 1048576):
+    """Yield the data of an open file and close it at the end."""
+    try:
+        while True:
+            data = f.read(buf_size)
+            if not data:
+                break
+            yield data
+    finally:
+        f.close()
+
+
+@bp.route("/<filename>", methods=["GET"])
+def download(filename: str) -> Response:
+    """Download a stored backup to restore it.
+
+    Plain backups is sent with sendfile through the WSGI file wrapper and support
+    Range requests, so an interrupted restore can be resumed. Compressed and
+    deduplicated backups is decompressed or read from the chunk store while they are
+    sent and do not support Range requests. The data is always the uploaded data.
+
+    The ETag is the SHA256 checksum from the backup index, so the file is not read to
+    create it and a client can verify the restored file with it. If-None-Match,
+    If-Modified-Since and If-Range is supported.
+
+    Request Headers:
+        X-Client (str, optional): Client id, the backup is read from the client folder
+        X-Password (str): Authentication password for the request
+        X-Token (str): Upload token from /auth, used instead of X-Password
+        Range (str, optional): Byte range to send
+
+    Error Responses:
+        400: Filename validation failed
+        401: Unknown client or missing, invalid or wrong password or upload token
+        404: The backup do not exist
+        416: The range can not be satisfied
+
+    Success Response:
+        200 or 206 with the data of the backup, or 304 if it is not modified.
+    """
+    client, error = authenticate(
+        request.headers.get('X-Client'),
+        request.headers.get('X-Password'),
+        request.headers.get('X-Token'),
+    )
+    if error is not None:
+        current_app.logger.error(error)
+        return make_response("error: " + error, 401)
+
+    if not validators.is_filename_allowed(filename):
+        current_app.logger.error("filename validation failed")
+        return make_response("error: filename validation failed", 400)
+
+    upload_folder = client["upload_folder"]
+    name = find_stored_backup(upload_folder, filename)
+    if name is None:
+        current_app.logger.error("backup " + filename + " do not exist")
+        return make_response("error: backup do not exist", 404)
+
+    # The checksum is only known if the backup was uploaded through the application.
+    backup = backup_index.get_backup(current_app.config["BACKUP_INDEX"], upload_folder, name)
+    sha256 = backup["sha256"] if backup is not None else None
+    full_path = os.path.join(upload_folder, name)
+
+    current_app.logger.info("sending " + full_path)
+
+    if name == original_name(name):
+        return send_file(
+            full_path,
+            request.environ,
+            mimetype="application/octet-stream",
+            as_attachment=True,
+            download_name=name,
+            conditional=True,
+            etag=sha256 if sha256 is not None else False,
+            response_class=DownloadResponse,
+        )
+
+    response = Response(iter_file(open_stored_backup(upload_folder, name)), mimetype="application/octet-stream")
+    response.headers["Content-Disposition"] = "attachment; filename=" + original_name(name)
+    response.last_modified = os.path.getmtime(full_path)
+    if sha256 is not None:
+        response.set_etag(sha256)
+    return response.make_conditional(request)
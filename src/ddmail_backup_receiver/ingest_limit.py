@@ -0,0 +1,162 @@
+import os
+import math
+import time
+import fcntl
+import random
+import threading
+from typing import Optional, Tuple
+from flask import Flask, current_app, g
+from ddmail_backup_receiver import metrics
+
+# Folder in the instance folder with the lock files of the ingest slots and queue places.
+INGEST_FOLDER_NAME = "ingest"
+
+# Seconds between tries to get an ingest slot while an upload waits in the queue.
+POLL_INTERVAL = 0.05
+
+# Retry-After in seconds before the duration of an ingest is known, and the bounds of it.
+DEFAULT_RETRY_AFTER = 10
+MAX_RETRY_AFTER = 3600
+
+# Weight of the latest ingest in the moving average of ingest durations.
+DURATION_WEIGHT = 0.2
+
+
+def try_lock(path: str):
+    """Open path and take an exclusive lock on it without waiting, return the file or None if it is locked."""
+    f = open(path, 'w')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+    return f
+
+
+class IngestLimiter:
+    """Limit the number of uploads that is saved at the same time by all worker processes.
+
+    Every ingest slot and every place in the wait queue is a lock file in the instance
+    folder, held with flock while it is used, so the limit is shared by all gunicorn
+    workers and a slot is freed by the kernel if a worker is killed. An upload that do
+    not get a slot takes a place in the queue and tries again until it gets a slot or
+    INGEST_QUEUE_TIMEOUT expires. An upload that do not get a place in the queue is
+    refused at once, so a worker is not held by a request that would wait too long.
+
+    Retry-After of a refused upload is the time the uploads ahead of it need with the
+    moving average of ingest durations in this process.
+    """
+
+    def __init__(self, folder: str, concurrency: int, queue_size: int, timeout: float):
+        """Create a limiter with concurrency slots and queue_size places in the queue in folder."""
+        self.folder = folder
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.average_duration = None
+        os.makedirs(folder, exist_ok=True)
+
+    def try_slot(self):
+        """Take a free ingest slot and return its file, or None if all slots is used."""
+        for i in random.sample(range(self.concurrency), self.concurrency):
+            f = try_lock(os.path.join(self.folder, "slot-" + str(i) + ".lock"))
+            if f is not None:
+                return f
+        return None
+
+    def try_queue(self):
+        """Take a free place in the wait queue and return its file, or None if the queue is full."""
+        for i in range(self.queue_size):
+            f = try_lock(os.path.join(self.folder, "queue-" + str(i) + ".lock"))
+            if f is not None:
+                return f
+        return None
+
+    def retry_after(self) -> int:
+        """Return the seconds a refused upload should wait before it is sent again."""
+        with self.lock:
+            duration = self.average_duration
+        if duration is None:
+            return DEFAULT_RETRY_AFTER
+        waiting = self.concurrency + self.queue_size + 1
+        return min(MAX_RETRY_AFTER, max(1, math.ceil(duration * waiting / self.concurrency)))
+
+    def acquire(self) -> Tuple[Optional[object], Optional[int]]:
+        """Take an ingest slot, waiting in the queue if all slots is used.
+
+        Returns:
+            tuple: The slot to pass to release and None, or None and the Retry-After in
+                   seconds if the queue is full or the wait timed out.
+        """
+        slot = self.try_slot()
+        if slot is not None:
+            return slot, None
+
+        place = self.try_queue()
+        if place is None:
+            return None, self.retry_after()
+
+        deadline = time.monotonic() + self.timeout
+        try:
+            while time.monotonic() < deadline:
+                time.sleep(POLL_INTERVAL)
+                slot = self.try_slot()
+                if slot is not None:
+                    return slot, None
+        finally:
+            place.close()
+
+        return None, self.retry_after()
+
+    def release(self, slot, duration: float) -> None:
+        """Free an ingest slot and add the time it was held to the moving average."""
+        slot.close()
+        with self.lock:
+            if self.average_duration is None:
+                self.average_duration = duration
+            else:
+                self.average_duration += DURATION_WEIGHT * (duration - self.average_duration)
+
+
+def acquire_ingest_slot() -> Optional[int]:
+    """Take an ingest slot for the current request, if INGEST_CONCURRENCY is set.
+
+    The slot is released when the request ends.
+
+    Returns:
+        Optional[int]: None if the upload can be saved, or the Retry-After in seconds
+                       if the server is busy and the upload should be refused.
+    """
+    limiter = current_app.extensions.get("ingest_limiter")
+    if limiter is None:
+        return None
+
+    with metrics.timer("ddmail_ingest_wait_seconds"):
+        slot, retry_after = limiter.acquire()
+    if slot is None:
+        metrics.inc("ddmail_ingest_rejected_total")
+        return retry_after
+
+    g.ingest_slot = (slot, time.monotonic())
+    return None
+
+
+def release_ingest_slot(exc: Optional[BaseException]) -> None:
+    """Release the ingest slot of the request when it ends."""
+    ingest_slot = g.pop("ingest_slot", None)
+    if ingest_slot is not None:
+        slot, start = ingest_slot
+        current_app.extensions["ingest_limiter"].release(slot, time.monotonic() - start)
+
+
+def init_app(app: Flask) -> None:
+    """Set up the ingest limiter of app if INGEST_CONCURRENCY is set."""
+    if app.config["INGEST_CONCURRENCY"] > 0:
+        app.extensions["ingest_limiter"] = IngestLimiter(
+            os.path.join(app.instance_path, INGEST_FOLDER_NAME),
+            app.config["INGEST_CONCURRENCY"],
+            app.config["INGEST_QUEUE_SIZE"],
+            app.config["INGEST_QUEUE_TIMEOUT"],
+        )
+    app.teardown_request(release_ingest_slot)
@@ -0,0 +1,116 @@
+import os
+import hashlib
+import json
+from flask import Blueprint, current_app, request, make_response, Response
+from ddmail_backup_receiver.auth import authenticate
+from ddmail_backup_receiver.download import original_name
+from ddmail_backup_receiver import backup_index
+from ddmail_backup_receiver import checksums
+
+bp = Blueprint("listing", __name__, url_prefix="/backups")
+
+# Number of backups per page if per_page is not set, and the max per_page.
+DEFAULT_PER_PAGE = 100
+MAX_PER_PAGE = 1000
+
+
+def parse_positive_int(value, default: int, maximum: int = None):
+    """Return value as an int from 1 to maximum, default if value is None, or None if it is not valid."""
+    if value is None:
+        return default
+    if not value.isdigit() or int(value) < 1 or (maximum is not None and int(value) > maximum):
+        return None
+    return int(value)
+
+
+def backup_json(backup: dict) -> dict:
+    """Return a backup from the index as it is shown in the listing."""
+    algorithm, checksum = checksums.split_checksum(backup["sha256"])
+    return {
+        "name": backup["name"],
+        "filename": original_name(backup["name"]),
+        "size": backup["size"],
+        "uploaded": backup["mtime"],
+        "checksum": checksum,
+        "checksum_algorithm": algorithm,
+    }
+
+
+@bp.route("", methods=["GET"])
+def list_backups() -> Response:
+    """List the stored backups of a client with their size, upload time and checksum.
+
+    The listing is read from the backup index, which uploads and retention keep up to
+    date, so no folder is scanned and no backup is read. The response has an ETag
+    over its content, so dashboards that poll the listing get 304 while nothing has
+    changed.
+
+    Request Headers:
+        X-Client (str, optional): Client id, the backups of the client folder is listed
+        X-Password (str): Authentication password for the request
+        X-Token (str): Upload token from /auth, used instead of X-Password
+
+    Query Parameters:
+        page (int, optional): Page to return, from 1. Default is 1.
+        per_page (int, optional): Backups per page, max MAX_PER_PAGE. Default is DEFAULT_PER_PAGE.
+        sort (str, optional): name, size or uploaded. Default is uploaded.
+        order (str, optional): asc or desc. Default is desc, newest first.
+
+    Error Responses:
+        400: page, per_page, sort or order validation failed
+        401: Unknown client or missing, invalid or wrong password or upload token
+
+    Success Response:
+        JSON with backups, page, per_page, total, pages and latest, the newest backup.
+        Every backup has name, the stored file name, filename, the uploaded file name,
+        size, uploaded as seconds since the epoch, checksum and checksum_algorithm.
+    """
+    client, error = authenticate(
+        request.headers.get('X-Client'),
+        request.headers.get('X-Password'),
+        request.headers.get('X-Token'),
+    )
+    if error is not None:
+        current_app.logger.error(error)
+        return make_response("error: " + error, 401)
+
+    page = parse_positive_int(request.args.get('page'), 1)
+    if page is None:
+        return make_response("error: page validation failed", 400)
+    per_page = parse_positive_int(request.args.get('per_page'), DEFAULT_PER_PAGE, MAX_PER_PAGE)
+    if per_page is None:
+        return make_response("error: per_page validation failed", 400)
+    sort = request.args.get('sort', "uploaded")
+    if sort not in ("name", "size", "uploaded"):
+        return make_response("error: sort validation failed", 400)
+    order = request.args.get('order', "desc")
+    if order not in ("asc", "desc"):
+        return make_response("error: order validation failed", 400)
+
+    db_path = current_app.config["BACKUP_INDEX"]
+    upload_folder = client["upload_folder"]
+    if os.path.isdir(upload_folder):
+        backup_index.ensure_folder(db_path, upload_folder)
+
+    backups, total = backup_index.page_backups(
+        db_path,
+        upload_folder,
+        "mtime" if sort == "uploaded" else sort,
+        order == "desc",
+        per_page,
+        (page - 1) * per_page,
+    )
+    latest = backup_index.latest_backup(db_path, upload_folder)
+
+    body = json.dumps({
+        "backups": [backup_json(backup) for backup in backups],
+        "page": page,
+        "per_page": per_page,
+        "total": total,
+        "pages": (total + per_page - 1) // per_page,
+        "latest": backup_json(latest) if latest is not None else None,
+    })
+    response = Response(body, mimetype="application/json")
+    response.set_etag(hashlib.sha256(body.encode()).hexdigest())
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
@@ -0,0 +1,79 @@
+import os
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+from typing import List
+from ddmail_backup_receiver import metrics
+
+
+class BlockingStopQueueListener(logging.handlers.QueueListener):
+    """QueueListener that waits for room in a full queue for the sentinel when it is stopped."""
+
+    def enqueue_sentinel(self) -> None:
+        """Put the sentinel in the queue, the listener thread makes room for it."""
+        self.queue.put(self._sentinel)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Send log records to slow handlers from a background thread, dropping records when the queue is full.
+
+    FileHandler and SysLogHandler write on the thread that logs, so a slow disc or a
+    stalled /dev/log would stall the request that logs. Records is instead put in a
+    bounded queue and written by a QueueListener thread. When the queue is full the
+    record is dropped and counted in dropped and in ddmail_log_records_dropped_total,
+    so logging never waits.
+
+    The queue and the listener thread is created on the first record in each process,
+    so they also work in gunicorn workers that are forked after create_app.
+    """
+
+    def __init__(self, handlers: List[logging.Handler], queue_size: int = 10000):
+        """Create a handler that writes records to handlers with at most queue_size records waiting."""
+        super().__init__(queue.Queue(queue_size))
+        self.handlers = handlers
+        self.queue_size = queue_size
+        self.dropped = 0
+        self.listener = None
+        self.pid = None
+        self.start_lock = threading.Lock()
+        self.dropped_lock = threading.Lock()
+        # Write the records in the queue before the process exits.
+        atexit.register(self.stop)
+
+    def ensure_started(self) -> None:
+        """Start the listener thread in this process if it is not running."""
+        if self.pid == os.getpid():
+            return
+
+        with self.start_lock:
+            if self.pid != os.getpid():
+                # A queue inherited from the parent process can have its locks held.
+                self.queue = queue.Queue(self.queue_size)
+                self.listener = BlockingStopQueueListener(self.queue, *self.handlers, respect_handler_level=True)
+                self.listener.start()
+                self.pid = os.getpid()
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        """Put record in the queue, or drop and count it if the queue is full."""
+        self.ensure_started()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.dropped_lock:
+                self.dropped += 1
+            metrics.inc("ddmail_log_records_dropped_total")
+
+    def stop(self) -> None:
+        """Write the records in the queue and stop the listener thread of this process."""
+        with self.start_lock:
+            # A listener inherited from the parent process has no thread in this process.
+            if self.pid == os.getpid():
+                self.listener.stop()
+                self.pid = None
+
+    def close(self) -> None:
+        """Stop the listener thread and close the handler."""
+        self.stop()
+        super().close()
@@ -0,0 +1,343 @@
+import os
+import re
+import glob
+import json
+import mmap
+import time
+import bisect
+import struct
+import threading
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+from flask import Blueprint, Flask, current_app, g, has_app_context, make_response, request, Response
+
+bp = Blueprint("metrics", __name__)
+
+# Name of the folder in the instance folder where every process stores its values.
+METRICS_FOLDER_NAME = "metrics"
+
+# Upper bounds of the buckets of all histograms, in seconds.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0,
+           600.0, float("inf"))
+
+# Name, type and help text of every metric.
+METRICS = {
+    "ddmail_request_duration_seconds": ("histogram", "Time to handle a request, by endpoint."),
+    "ddmail_received_bytes_total": ("counter", "Bytes of request bodies read, by endpoint."),
+    "ddmail_errors_total": ("counter", "Requests that returned an error, by endpoint and error."),
+    "ddmail_save_duration_seconds": ("histogram", "Time to save and hash an upload, by storage."),
+    "ddmail_sha256_duration_seconds": ("histogram", "Time to hash a saved file with sha256_of_file."),
+    "ddmail_password_verify_duration_seconds": ("histogram", "Time of Argon2 password verifications."),
+    "ddmail_password_cache_hits_total": ("counter", "Password checks answered by the verified cache."),
+    "ddmail_retention_duration_seconds": ("histogram", "Time to remove old backups of a folder."),
+    "ddmail_pruned_backups_total": ("counter", "Old backups removed by retention."),
+    "ddmail_scrubbed_backups_total": ("counter", "Stored backups verified by the scrubber, by result."),
+    "ddmail_scrubbed_bytes_total": ("counter", "Bytes read by the scrubber."),
+    "ddmail_ingest_wait_seconds": ("histogram", "Time uploads waited for an ingest slot."),
+    "ddmail_ingest_rejected_total": ("counter", "Uploads refused with 503 because all ingest slots was used."),
+    "ddmail_log_records_dropped_total": ("counter", "Log records to file or syslog dropped because the log queue was full."),
+}
+
+HEADER = struct.Struct("<Q")
+KEY_LENGTH = struct.Struct("<I")
+VALUE = struct.Struct("<d")
+
+# Size the file of a process starts with, it is doubled when it is full.
+INITIAL_SIZE = 65536
+
+
+def sample_key(key: Tuple) -> bytes:
+    """Encode a sample key as stored in the values file."""
+    return json.dumps(key, separators=(",", ":")).encode('utf-8')
+
+
+class ValuesFile:
+    """Float values of one process in a memory mapped file.
+
+    Every process writes only its own file, so updating a value is a write to memory
+    without locks between processes or system calls. Other processes read the file to
+    sum the values of all processes, see read_values_file. An entry is the length of
+    the key, the key and padding to 8 bytes and the value. The header is the number of
+    bytes used, which is updated after a new entry is written.
+    """
+
+    def __init__(self, path: str):
+        """Open or create the values file at path."""
+        self.f = open(path, 'a+b')
+        if os.fstat(self.f.fileno()).st_size < INITIAL_SIZE:
+            self.f.truncate(INITIAL_SIZE)
+        self.map = mmap.mmap(self.f.fileno(), os.fstat(self.f.fileno()).st_size)
+        self.used = HEADER.unpack_from(self.map, 0)[0] or HEADER.size
+        self.positions = {}
+        for key, position in iter_entries(self.map, self.used):
+            self.positions[key] = position
+
+    def add_entry(self, key: bytes) -> int:
+        """Add an entry for key with value 0 and return the position of the value."""
+        padding = -(KEY_LENGTH.size + len(key)) % 8
+        size = KEY_LENGTH.size + len(key) + padding + VALUE.size
+        if self.used + size > len(self.map):
+            new_size = len(self.map)
+            while self.used + size > new_size:
+                new_size *= 2
+            self.map.close()
+            self.f.truncate(new_size)
+            self.map = mmap.mmap(self.f.fileno(), new_size)
+
+        start = self.used
+        KEY_LENGTH.pack_into(self.map, start, len(key))
+        self.map[start + KEY_LENGTH.size:start + KEY_LENGTH.size + len(key)] = key
+        position = start + size - VALUE.size
+        VALUE.pack_into(self.map, position, 0.0)
+        self.used += size
+        HEADER.pack_into(self.map, 0, self.used)
+        self.positions[key] = position
+        return position
+
+    def add(self, key: bytes, amount: float) -> None:
+        """Add amount to the value of key."""
+        position = self.positions.get(key)
+        if position is None:
+            position = self.add_entry(key)
+        VALUE.pack_into(self.map, position, VALUE.unpack_from(self.map, position)[0] + amount)
+
+
+def iter_entries(data, used: int):
+    """Yield the key and position of the value of every entry in the data of a values file."""
+    position = HEADER.size
+    while position < used:
+        length = KEY_LENGTH.unpack_from(data, position)[0]
+        key = bytes(data[position + KEY_LENGTH.size:position + KEY_LENGTH.size + length])
+        position += KEY_LENGTH.size + length + (-(KEY_LENGTH.size + length) % 8)
+        yield key, position
+        position += VALUE.size
+
+
+def read_values_file(path: str) -> Dict[bytes, float]:
+    """Return the values in the values file at path."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < HEADER.size:
+        return {}
+
+    used = min(HEADER.unpack_from(data, 0)[0], len(data))
+    return {key: VALUE.unpack_from(data, position)[0] for key, position in iter_entries(data, used)}
+
+
+class Metrics:
+    """Counters and histograms shared by all worker processes of the application.
+
+    Each process writes to a values file named after its process id in folder, the
+    file is opened again after a fork. Collecting sums the files of all processes,
+    also of processes that have exited, so counters never go backwards when gunicorn
+    restarts a worker.
+    """
+
+    def __init__(self, folder: str):
+        """Store the values of all processes in folder."""
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.values = None
+        self.pid = None
+        self.keys = {}
+
+    def add(self, key: Tuple, amount: float) -> None:
+        """Add amount to the sample key of this process."""
+        with self.lock:
+            if self.pid != os.getpid():
+                os.makedirs(self.folder, exist_ok=True)
+                self.values = ValuesFile(os.path.join(self.folder, str(os.getpid()) + ".db"))
+                self.pid = os.getpid()
+            encoded = self.keys.get(key)
+            if encoded is None:
+                encoded = self.keys[key] = sample_key(key)
+            self.values.add(encoded, amount)
+
+    def inc(self, name: str, amount: float = 1, **labels: str) -> None:
+        """Increase the counter name with labels by amount."""
+        self.add((name, "", tuple(sorted(labels.items()))), amount)
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        """Add value to the histogram name with labels."""
+        label_items = tuple(sorted(labels.items()))
+        self.add((name, "_bucket", label_items, bisect.bisect_left(BUCKETS, value)), 1)
+        self.add((name, "_sum", label_items), value)
+        self.add((name, "_count", label_items), 1)
+
+    def collect(self) -> Dict[bytes, float]:
+        """Return the values of all processes summed per sample."""
+        totals = {}
+        for path in glob.glob(os.path.join(self.folder, "*.db")):
+            for key, value in read_values_file(path).items():
+                totals[key] = totals.get(key, 0.0) + value
+        return totals
+
+    def exposition(self) -> str:
+        """Return all metrics in the Prometheus text format."""
+        samples = {}
+        for key, value in self.collect().items():
+            name, suffix, labels, *bucket = json.loads(key)
+            if name not in METRICS:
+                continue
+            label_items = tuple(tuple(item) for item in labels)
+            series = samples.setdefault(name, {}).setdefault(label_items, {"buckets": [0.0] * len(BUCKETS)})
+            if bucket:
+                series["buckets"][bucket[0]] += value
+            else:
+                series[suffix] = value
+
+        lines = []
+        for name, (metric_type, help_text) in METRICS.items():
+            lines.append("# HELP " + name + " " + help_text)
+            lines.append("# TYPE " + name + " " + metric_type)
+            for label_items, series in sorted(samples.get(name, {}).items()):
+                if metric_type == "counter":
+                    lines.append(name + format_labels(label_items) + " " + format_value(series.get("", 0.0)))
+                    continue
+                cumulative = 0.0
+                for bound, count in zip(BUCKETS, series["buckets"]):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(name + "_bucket" + format_labels(label_items + (("le", le),)) + " "
+                                 + format_value(cumulative))
+                lines.append(name + "_sum" + format_labels(label_items) + " " + format_value(series.get("_sum", 0.0)))
+                lines.append(name + "_count" + format_labels(label_items) + " "
+                             + format_value(series.get("_count", 0.0)))
+
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(label_items: Tuple) -> str:
+    """Format labels as {name="value",...}, escaped as in the Prometheus text format."""
+    if not label_items:
+        return ""
+    escaped = (name + '="' + value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+               for name, value in label_items)
+    return "{" + ",".join(escaped) + "}"
+
+
+def format_value(value: float) -> str:
+    """Format a sample value, whole numbers without decimals."""
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def inc(name: str, amount: float = 1, **labels: str) -> None:
+    """Increase a counter of the current app, do nothing outside of an app context."""
+    if has_app_context():
+        current_app.extensions["metrics"].inc(name, amount, **labels)
+
+
+def observe(name: str, value: float, **labels: str) -> None:
+    """Add value to a histogram of the current app, do nothing outside of an app context."""
+    if has_app_context():
+        current_app.extensions["metrics"].observe(name, value, **labels)
+
+
+@contextmanager
+def timer(name: str, **labels: str):
+    """Observe the seconds the with block takes in the histogram name."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def error_type(message: str) -> str:
+    """Return an error message without paths and numbers, so it can be used as a label."""
+    return re.sub(r"\b\d+\b", "N", re.sub(r" /\S*", "", message))
+
+
+def error_of_response(response: Response) -> Optional[str]:
+    """Return the error of a response, from a small "error: " body or else the HTTP status."""
+    if not response.is_streamed and not response.direct_passthrough and (response.content_length or 0) < 4096:
+        data = response.get_data()
+        if data.startswith(b"error: "):
+            return error_type(data[7:].decode('utf-8', 'replace'))
+    if response.status_code >= 400:
+        return str(response.status_code)
+    return None
+
+
+class CountingStream:
+    """WSGI input stream that counts the bytes read from it."""
+
+    def __init__(self, stream):
+        """Wrap stream and start counting at 0."""
+        self.stream = stream
+        self.size = 0
+
+    def read(self, size: int = -1) -> bytes:
+        """Read at most size bytes, or all if size is negative."""
+        data = self.stream.read(size)
+        self.size += len(data)
+        return data
+
+    def readline(self, size: int = -1) -> bytes:
+        """Read a line."""
+        data = self.stream.readline(size)
+        self.size += len(data)
+        return data
+
+    def __iter__(self):
+        """Iterate over the lines of the stream."""
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+
+def start_request() -> None:
+    """Remember when the request started and count the bytes of the body that is read.
+
+    Requests that is refused before the body is read do not count as received bytes.
+    """
+    g.metrics_start = time.perf_counter()
+    if "wsgi.input" in request.environ:
+        stream = CountingStream(request.environ["wsgi.input"])
+        request.environ["wsgi.input"] = stream
+        g.metrics_stream = stream
+
+
+def finish_request(response: Response) -> Response:
+    """Record duration, received bytes and errors of the request."""
+    start = g.pop("metrics_start", None)
+    if start is None or request.endpoint == "metrics.metrics":
+        return response
+
+    endpoint = request.endpoint or "none"
+    metrics = current_app.extensions["metrics"]
+    metrics.observe("ddmail_request_duration_seconds", time.perf_counter() - start, endpoint=endpoint)
+    stream = g.pop("metrics_stream", None)
+    if stream is not None and stream.size:
+        metrics.inc("ddmail_received_bytes_total", stream.size, endpoint=endpoint)
+    error = error_of_response(response)
+    if error is not None:
+        metrics.inc("ddmail_errors_total", endpoint=endpoint, error=error)
+    return response
+
+
+def init_app(app: Flask) -> None:
+    """Set up metrics of app, stored in the metrics folder in the instance folder."""
+    app.extensions["metrics"] = Metrics(os.path.join(app.instance_path, METRICS_FOLDER_NAME))
+    app.before_request(start_request)
+    app.after_request(finish_request)
+
+
+@bp.route("/metrics", methods=["GET"])
+def metrics() -> Response:
+    """Return the metrics of all worker processes in the Prometheus text format.
+
+    Error Responses:
+        404: METRICS is false in the configuration
+
+    Success Response:
+        The metrics as text/plain in the Prometheus exposition format version 0.0.4.
+    """
+    if not current_app.config["METRICS"]:
+        return make_response("error: metrics is disabled", 404)
+
+    response = make_response(current_app.extensions["metrics"].exposition(), 200)
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    return response
@@ -0,0 +1,416 @@
+import os
+import json
+import errno
+import fcntl
+import shutil
+import secrets
+import tempfile
+from typing import List, Optional, Tuple
+from flask import Blueprint, current_app, request, make_response, jsonify, Response
+from werkzeug.utils import secure_filename
+import ddmail_validators.validators as validators
+from ddmail_backup_receiver.application import (
+    busy_response,
+    check_upload_headers,
+    early_error_response,
+    save_and_sha256,
+    sha256_of_file,
+    store_backup,
+    validate_backups_to_save,
+)
+from ddmail_backup_receiver.auth import authenticate
+from ddmail_backup_receiver.upload_session import error_response, is_session_id_allowed, remove_stale_sessions
+from ddmail_backup_receiver import admission
+from ddmail_backup_receiver import backup_index
+from ddmail_backup_receiver import checksums
+from ddmail_backup_receiver.ingest_limit import acquire_ingest_slot
+from ddmail_backup_receiver.retention import schedule_retention
+from ddmail_backup_receiver.shaping import shape_request
+
+bp = Blueprint("multipart", __name__, url_prefix="/multipart")
+
+# Name of the hidden folder inside the upload folder where parts of unfinished uploads
+# are stored. It is in the same filesystem as the upload folder so the parts can be
+# joined with copy_file_range and the joined file renamed in place.
+MULTIPART_FOLDER_NAME = ".multipart_uploads"
+
+# Max number of parts of an upload, as in S3.
+MAX_PARTS = 10000
+
+
+def multipart_folder(upload_folder: str) -> str:
+    """Return the folder where multipart uploads are stored for upload_folder."""
+    return os.path.join(upload_folder, MULTIPART_FOLDER_NAME)
+
+
+def get_upload_folder(upload_id: Optional[str], client: dict) -> Tuple[Optional[str], Optional[str]]:
+    """Validate upload_id and return the folder of the multipart upload of client.
+
+    Args:
+        upload_id (Optional[str]): Upload id from the request.
+        client (dict): Client of the request from get_client.
+
+    Returns:
+        tuple: Path to the upload folder and None, or None and an error message.
+    """
+    if upload_id is None:
+        return None, "upload_id is none"
+
+    upload_id = upload_id.strip()
+
+    if not is_session_id_allowed(upload_id):
+        return None, "upload_id validation failed"
+
+    folder = os.path.join(multipart_folder(client["upload_folder"]), upload_id)
+    if not os.path.isdir(folder):
+        return None, "multipart upload do not exist"
+
+    return folder, None
+
+
+def part_path(folder: str, part_number: int) -> str:
+    """Return the path of part part_number in the multipart upload folder."""
+    return os.path.join(folder, "part-" + str(part_number))
+
+
+def copy_file(src, dst) -> None:
+    """Append the whole of the open file src to the open file dst.
+
+    The data is copied by the kernel with os.copy_file_range, which on filesystems
+    like btrfs and XFS shares the blocks with a reflink instead of copying them. If
+    copy_file_range is not available, or not supported between the files, the data is
+    copied with read and write.
+
+    Args:
+        src: Binary file object to copy from, at position 0.
+        dst: Binary file object to append to.
+
+    Returns:
+        None
+    """
+    remaining = os.fstat(src.fileno()).st_size
+
+    if hasattr(os, "copy_file_range"):
+        try:
+            while remaining > 0:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+
+    if remaining > 0:
+        shutil.copyfileobj(src, dst, 1048576)
+
+
+def join_parts(part_paths: List[str], full_path: str) -> None:
+    """Join the parts into one file at full_path, see copy_file.
+
+    Args:
+        part_paths (List[str]): Paths of the parts in order.
+        full_path (str): Path of the joined file.
+
+    Returns:
+        None
+    """
+    with open(full_path, 'wb') as out:
+        for path in part_paths:
+            with open(path, 'rb') as part:
+                copy_file(part, out)
+
+
+class PartsReader:
+    """Read only file-like object with the data of the parts in order."""
+
+    def __init__(self, part_paths: List[str]):
+        """Read the files in part_paths one after the other."""
+        self.part_paths = list(part_paths)
+        self.current = None
+
+    def read(self, size: int = -1) -> bytes:
+        """Read up to size bytes, all of the remaining data if size is negative."""
+        while True:
+            if self.current is None:
+                if not self.part_paths:
+                    return b""
+                self.current = open(self.part_paths.pop(0), 'rb')
+
+            data = self.current.read(size)
+            if data:
+                return data
+
+            self.current.close()
+            self.current = None
+
+    def close(self) -> None:
+        """Close the part that is read."""
+        if self.current is not None:
+            self.current.close()
+
+
+@bp.route("/create", methods=["POST"])
+def create_upload() -> Response:
+    """Start a multipart upload, the parts can then be sent in parallel to /multipart/part.
+
+    Request Form Parameters:
+        filename (str): Name to save the finished file as
+        password (str): Authentication password for the request
+        token (str): Upload token from /auth, used instead of password
+        client (str, optional): Client id, the upload is stored in the client folder
+        sha256 (str): Expected SHA256 checksum of the finished file
+        size (int, optional): Size of the finished file, checked against the free disc
+                              space and the quota of the client
+
+    Success Response:
+        JSON with upload_id.
+    """
+    filename = request.form.get('filename')
+    sha256_from_form = request.form.get('sha256')
+
+    client, error = authenticate(request.form.get('client'), request.form.get('password'), request.form.get('token'))
+    if error is not None:
+        return error_response(error)
+
+    if filename is None:
+        return error_response("filename is none")
+
+    if sha256_from_form is None:
+        return error_response("sha256_from_form is none")
+
+    filename = filename.strip()
+    sha256_from_form = sha256_from_form.strip()
+
+    if not validators.is_filename_allowed(filename):
+        return error_response("filename validation failed")
+
+    if not validators.is_sha256_allowed(sha256_from_form):
+        return error_response("sha256 checksum validation failed")
+
+    upload_folder = client["upload_folder"]
+    if not os.path.isdir(upload_folder):
+        return error_response("upload folder " + upload_folder + " do not exist")
+
+    folder = multipart_folder(upload_folder)
+    remove_stale_sessions(folder, current_app.config["UPLOAD_SESSION_MAX_AGE"])
+
+    # Check that the finished file fits the disc and the quota before any part is sent.
+    size = request.form.get('size')
+    if size is not None:
+        size = size.strip()
+        if not size.isdigit():
+            return error_response("size validation failed")
+        error = admission.check_size(client, int(size))
+        if error is not None:
+            return error_response(error)
+
+    upload_id = secrets.token_hex(16)
+    os.makedirs(os.path.join(folder, upload_id))
+
+    with open(os.path.join(folder, upload_id, "upload.json"), 'w') as f:
+        json.dump({"filename": filename, "sha256": sha256_from_form}, f)
+
+    current_app.logger.info("created multipart upload " + upload_id + " for " + filename)
+    return jsonify({"upload_id": upload_id})
+
+
+@bp.route("/part", methods=["POST"])
+def receive_part() -> Response:
+    """Receive one part of a multipart upload as a raw request body.
+
+    Parts can be sent in any order and at the same time over several connections.
+    Sending a part number again replaces the part.
+
+    Request Headers:
+        Content-Length (int): Size of the part, required
+        X-Client (str, optional): Client id of the upload
+        X-Password (str): Authentication password for the request
+        X-Token (str): Upload token from /auth, used instead of X-Password
+        X-Upload-Id (str): Id of the multipart upload
+        X-Part-Number (int): Number of the part, 1 to MAX_PARTS
+        X-Sha256 (str): Expected SHA256 checksum of the part, or checksum with X-Checksum-Algorithm
+        X-Checksum-Algorithm (str, optional): Checksum algorithm of the part, see /checksum_algorithms
+
+    Error Responses:
+        400: Missing or invalid headers or sha256 checksum do not match
+        401: Unknown client or missing, invalid or wrong password or upload token
+        404: The multipart upload do not exist
+        411: Content-Length is missing
+        413: Content-Length is larger than MAX_CONTENT_LENGTH
+        503: INGEST_CONCURRENCY uploads is saved and the wait queue is full or the wait
+             timed out, Retry-After is set to when the part can be sent again
+        507: The part do not fit the free disc space or the quota of the client, see admission
+
+    Success Response:
+        JSON with part_number and size.
+    """
+    # Check credentials and metadata before the request body is read.
+    client, error, status = check_upload_headers(require_metadata=False)
+    if error is not None:
+        return early_error_response(error, status)
+
+    sha256_from_header = request.headers.get('X-Sha256')
+    if sha256_from_header is None:
+        return early_error_response("sha256_from_form is none", 400)
+    sha256_from_header = sha256_from_header.strip()
+
+    part_number = request.headers.get('X-Part-Number', "").strip()
+    if not part_number.isdigit() or not 1 <= int(part_number) <= MAX_PARTS:
+        return early_error_response("part number validation failed", 400)
+    part_number = int(part_number)
+
+    folder, error = get_upload_folder(request.headers.get('X-Upload-Id'), client)
+    if error is not None:
+        return early_error_response(error, 404 if error == "multipart upload do not exist" else 400)
+
+    # Wait for an ingest slot before the part is read, if INGEST_CONCURRENCY is set.
+    retry_after = acquire_ingest_slot()
+    if retry_after is not None:
+        return busy_response(retry_after)
+
+    # Reserve disc space and quota for the part before it is read.
+    reservation_id, error = admission.reserve(client, request.content_length)
+    if error is not None:
+        return early_error_response(error, 507)
+
+    # Read the part at the rate of the client, if RATE_LIMIT_MB or a client limit is set.
+    shape_request(client)
+
+    # Write the part to a temporary file, so a damaged part never replaces a good one.
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".tmp-")
+    os.close(fd)
+    algorithm = request.headers.get('X-Checksum-Algorithm', checksums.DEFAULT_ALGORITHM).strip()
+    hasher = checksums.new_hasher(algorithm, current_app.config["CHECKSUM_THREADS"])
+    try:
+        sha256_from_part = save_and_sha256(request.stream, tmp_path, 1048576, hasher)
+    except BaseException:
+        # A client that disconnects or a failed read leaves no part behind.
+        os.remove(tmp_path)
+        raise
+    admission.release(reservation_id)
+
+    if sha256_from_part != sha256_from_header:
+        os.remove(tmp_path)
+        current_app.logger.error("sha256 checksum do not match")
+        return make_response("error: sha256 checksum do not match", 400)
+
+    os.replace(tmp_path, part_path(folder, part_number))
+    return jsonify({"part_number": part_number, "size": os.path.getsize(part_path(folder, part_number))})
+
+
+@bp.route("/complete", methods=["POST"])
+def complete_upload() -> Response:
+    """Join the parts of a multipart upload and store the backup.
+
+    Plain uncompressed backups is joined with copy_file_range in the filesystem of
+    the upload folder, other backups is read part by part with store_backup. The
+    result is verified against the SHA256 checksum given to /multipart/create and old
+    backups are removed.
+
+    Request Form Parameters:
+        password (str): Authentication password for the request
+        token (str): Upload token from /auth, used instead of password
+        client (str, optional): Client id of the upload
+        upload_id (str): Id of the multipart upload
+        parts (int): Number of parts, parts 1 to parts must have been received
+
+    Error Responses:
+        503 "error: server is busy": If INGEST_CONCURRENCY uploads is saved and the wait
+            queue is full or the wait timed out, with Retry-After
+
+    Success Response:
+        "done": Operation completed successfully
+    """
+    client, error = authenticate(request.form.get('client'), request.form.get('password'), request.form.get('token'))
+    if error is not None:
+        return error_response(error)
+
+    folder, error = get_upload_folder(request.form.get('upload_id'), client)
+    if error is not None:
+        return error_response(error)
+
+    parts = request.form.get('parts', "").strip()
+    if not parts.isdigit() or not 1 <= int(parts) <= MAX_PARTS:
+        return error_response("parts validation failed")
+    part_paths = [part_path(folder, i) for i in range(1, int(parts) + 1)]
+
+    backups_to_save = client["backups_to_save"]
+    error = validate_backups_to_save(backups_to_save)
+    if error is not None:
+        return error_response(error)
+
+    with open(os.path.join(folder, "upload.json"), 'r') as f:
+        upload = json.load(f)
+
+    upload_folder = client["upload_folder"]
+    db_path = current_app.config["BACKUP_INDEX"]
+    filename = secure_filename(upload["filename"])
+
+    # Wait for an ingest slot before the parts is joined and stored, if INGEST_CONCURRENCY is set.
+    retry_after = acquire_ingest_slot()
+    if retry_after is not None:
+        return busy_response(retry_after)
+
+    # Lock the upload so it is not completed twice at the same time.
+    with open(os.path.join(folder, "lock"), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        for path in part_paths:
+            if not os.path.isfile(path):
+                return error_response("part " + os.path.basename(path)[5:] + " is missing")
+
+        if current_app.config["STORAGE_MODE"] == "plain" and current_app.config["COMPRESSION"] == "none":
+            joined_path = os.path.join(folder, "joined")
+            join_parts(part_paths, joined_path)
+            if sha256_of_file(joined_path) != upload["sha256"]:
+                os.remove(joined_path)
+                return error_response("sha256 checksum do not match")
+            os.replace(joined_path, upload_folder + "/" + filename)
+            name = filename
+        else:
+            # The backup is only stored if the checksum match, so a stored backup with the same name is kept.
+            reader = PartsReader(part_paths)
+            try:
+                name, sha256_from_file = store_backup(reader, upload_folder, filename, 1048576,
+                                                      expected=upload["sha256"])
+            finally:
+                reader.close()
+            if sha256_from_file != upload["sha256"]:
+                return error_response("sha256 checksum do not match")
+
+        backup_index.add_backup(db_path, upload_folder, name, upload["sha256"])
+
+    shutil.rmtree(folder, ignore_errors=True)
+
+    # Delete old backups, in the background unless RETENTION_SYNC is set.
+    schedule_retention(upload_folder, backups_to_save)
+
+    current_app.logger.info("done")
+    return make_response("done", 200)
+
+
+@bp.route("/abort", methods=["POST"])
+def abort_upload() -> Response:
+    """Remove a multipart upload and its parts.
+
+    Request Form Parameters:
+        password (str): Authentication password for the request
+        token (str): Upload token from /auth, used instead of password
+        client (str, optional): Client id of the upload
+        upload_id (str): Id of the multipart upload
+
+    Success Response:
+        "done": Operation completed successfully
+    """
+    client, error = authenticate(request.form.get('client'), request.form.get('password'), request.form.get('token'))
+    if error is not None:
+        return error_response(error)
+
+    folder, error = get_upload_folder(request.form.get('upload_id'), client)
+    if error is not None:
+        return error_response(error)
+
+    shutil.rmtree(folder, ignore_errors=True)
+    current_app.logger.info("aborted multipart upload " + os.path.basename(folder))
+    return make_response("done", 200)
@@ -0,0 +1,115 @@
+import os
+import fcntl
+import hashlib
+import threading
+from flask import Flask, current_app
+
+
+def retention_lock_path(app: Flask, folder: str) -> str:
+    """Return the path of the lock file used to prune folder, shared by all worker processes."""
+    name = hashlib.sha256(os.path.abspath(folder).encode('utf-8')).hexdigest()[:32]
+    return os.path.join(app.instance_path, "retention-" + name + ".lock")
+
+
+def run_retention(app: Flask, folder: str, backups_to_save: int) -> None:
+    """Run delete_old_backups for folder while holding the cross process lock of the folder.
+
+    Args:
+        app (Flask): The application.
+        folder (str): Folder where backups are stored.
+        backups_to_save (int): Number of backups to save.
+
+    Returns:
+        None
+    """
+    # Imported here since application imports this module.
+    from ddmail_backup_receiver.application import delete_old_backups
+
+    with open(retention_lock_path(app, folder), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        delete_old_backups(folder, backups_to_save)
+
+
+class RetentionWorker:
+    """Background thread that removes old backups off the request path.
+
+    Prune requests are queued per folder, so several uploads to the same folder
+    before the worker gets to it result in one pass. The thread is started on the
+    first request in each process, so it is also started in gunicorn workers that
+    are forked after the application is created.
+    """
+
+    def __init__(self, app: Flask):
+        """Create a worker for app, the thread is started when the first prune is requested."""
+        self.app = app
+        self.pending = {}
+        self.busy = False
+        self.condition = threading.Condition()
+        self.thread = None
+        self.pid = None
+
+    def submit(self, folder: str, backups_to_save: int) -> None:
+        """Queue a prune of folder, merged with any prune of folder that is already queued.
+
+        Args:
+            folder (str): Folder where backups are stored.
+            backups_to_save (int): Number of backups to save.
+
+        Returns:
+            None
+        """
+        with self.condition:
+            self.pending[folder] = backups_to_save
+            if self.thread is None or self.pid != os.getpid() or not self.thread.is_alive():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.run, name="retention", daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    def wait_idle(self, timeout: float = None) -> bool:
+        """Wait until all queued prunes are done.
+
+        Args:
+            timeout (float, optional): Max seconds to wait.
+
+        Returns:
+            bool: True if the worker is idle, False if timeout expired.
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending and not self.busy, timeout)
+
+    def run(self) -> None:
+        """Prune queued folders until the process exits."""
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending)
+                folder, backups_to_save = self.pending.popitem()
+                self.busy = True
+
+            try:
+                with self.app.app_context():
+                    run_retention(self.app, folder, backups_to_save)
+            except Exception:
+                self.app.logger.exception("removing old backups in " + folder + " failed")
+            finally:
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
+
+
+def schedule_retention(folder: str, backups_to_save: int) -> None:
+    """Remove old backups in folder in the background, or now if RETENTION_SYNC is set.
+
+    Args:
+        folder (str): Folder where backups are stored.
+        backups_to_save (int): Number of backups to save.
+
+    Returns:
+        None
+    """
+    app = current_app._get_current_object()
+
+    if app.config["RETENTION_SYNC"]:
+        run_retention(app, folder, backups_to_save)
+    else:
+        app.extensions["retention_worker"].submit(folder, backups_to_save)
@@ -0,0 +1,291 @@
+import os
+import json
+import time
+import fcntl
+import tempfile
+import threading
+from typing import List, Optional
+from flask import Blueprint, Flask, current_app, request, make_response, jsonify, Response
+from ddmail_backup_receiver.auth import authenticate
+from ddmail_backup_receiver.application import open_stored_backup
+from ddmail_backup_receiver.clients import client_upload_folder
+from ddmail_backup_receiver import backup_index
+from ddmail_backup_receiver import checksums
+from ddmail_backup_receiver import compression
+from ddmail_backup_receiver import dedup
+from ddmail_backup_receiver import metrics
+
+bp = Blueprint("scrub", __name__, url_prefix="/scrub")
+
+# Files in the instance folder with the result of the last pass and the lock that
+# makes sure only one worker process scrubs at a time.
+SCRUB_STATUS_NAME = "scrub_status.json"
+SCRUB_LOCK_NAME = "scrub.lock"
+
+# Number of bytes read and hashed at a time.
+READ_SIZE = 1048576
+
+
+class Throttle:
+    """Keep reads below a rate by sleeping when they are ahead of it."""
+
+    def __init__(self, rate: float):
+        """Allow rate bytes per second, 0 is no limit."""
+        self.rate = rate
+        self.start = time.monotonic()
+        self.done = 0
+
+    def consume(self, size: int) -> None:
+        """Count size bytes as read and sleep until the rate allows them."""
+        self.done += size
+        if self.rate:
+            delay = self.done / self.rate - (time.monotonic() - self.start)
+            if delay > 0:
+                time.sleep(delay)
+
+
+def is_plain(name: str) -> bool:
+    """Return True if a stored backup is a plain file, not compressed or a manifest."""
+    return not name.endswith(compression.ZSTD_SUFFIX) and not name.endswith(dedup.MANIFEST_SUFFIX)
+
+
+def verify_backup(upload_folder: str, name: str, expected: str, throttle: Throttle) -> bool:
+    """Hash a stored backup again and compare it with the checksum from when it was uploaded.
+
+    This is the loop of sha256_of_file with the algorithm of the stored checksum. Plain
+    files is read with posix_fadvise, so the kernel reads ahead and the pages is dropped
+    from the page cache after they are hashed instead of pushing out pages that live
+    uploads and restores need. Compressed and deduplicated backups is read with
+    open_stored_backup.
+
+    Args:
+        upload_folder (str): Folder where the backup is stored.
+        name (str): Name of the stored backup.
+        expected (str): Checksum from the backup index, see checksums.index_checksum.
+        throttle (Throttle): Limits how fast the backup is read.
+
+    Returns:
+        bool: True if the checksum match.
+    """
+    algorithm, checksum = checksums.split_checksum(expected)
+    hasher = checksums.new_hasher(algorithm, 1)
+
+    if is_plain(name):
+        f = open(os.path.join(upload_folder, name), 'rb')
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    else:
+        f = open_stored_backup(upload_folder, name)
+
+    with f:
+        offset = 0
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            hasher.update(data)
+            if is_plain(name):
+                os.posix_fadvise(f.fileno(), offset, len(data), os.POSIX_FADV_DONTNEED)
+            offset += len(data)
+            metrics.inc("ddmail_scrubbed_bytes_total", len(data))
+            throttle.consume(len(data))
+
+    return hasher.hexdigest() == checksum
+
+
+def is_replaced(db_path: str, folder: str, backup: dict) -> bool:
+    """Return True if backup is removed or uploaded again since it was listed.
+
+    Args:
+        db_path (str): Path to the backup index.
+        folder (str): Folder where the backup is stored.
+        backup (dict): The backup from list_backups.
+
+    Returns:
+        bool: True if the index no longer has the backup with the same mtime and checksum.
+    """
+    current = backup_index.get_backup(db_path, folder, backup["name"])
+    return current is None or current["mtime"] != backup["mtime"] or current["sha256"] != backup["sha256"]
+
+
+def scrub_folders(app: Flask) -> List[str]:
+    """Return UPLOAD_FOLDER and the folders of all clients that exist."""
+    folders = [app.config["UPLOAD_FOLDER"]]
+    folders += [client_upload_folder(app.config["UPLOAD_FOLDER"], client_id) for client_id in app.config["CLIENTS"]]
+    return [folder for folder in folders if os.path.isdir(folder)]
+
+
+def status_path(app: Flask) -> str:
+    """Return the path of the file with the result of the last scrub pass."""
+    return os.path.join(app.instance_path, SCRUB_STATUS_NAME)
+
+
+def read_status(app: Flask) -> Optional[dict]:
+    """Return the result of the last scrub pass or None if no pass has finished."""
+    try:
+        with open(status_path(app), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_status(app: Flask, status: dict) -> None:
+    """Replace the result of the last scrub pass atomically."""
+    fd, tmp_path = tempfile.mkstemp(dir=app.instance_path, prefix=".tmp-")
+    with os.fdopen(fd, 'w') as f:
+        json.dump(status, f)
+    os.replace(tmp_path, status_path(app))
+
+
+def run_scrub(app: Flask) -> Optional[dict]:
+    """Verify every backup with a checksum in the index, if no other process is scrubbing.
+
+    Must be called in an app context. Backups that are removed by retention or uploaded
+    again while the pass runs is skipped. The result is saved in the instance folder, see read_status.
+
+    Args:
+        app (Flask): The application.
+
+    Returns:
+        Optional[dict]: The result of the pass, or None if another process holds the lock.
+    """
+    db_path = app.config["BACKUP_INDEX"]
+    throttle = Throttle(app.config["SCRUB_RATE_MB"] * 1024 * 1024)
+
+    with open(os.path.join(app.instance_path, SCRUB_LOCK_NAME), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+
+        status = {"started": time.time(), "finished": None, "verified": 0, "bytes": 0, "unverifiable": 0,
+                  "failed": []}
+        for folder in scrub_folders(app):
+            backup_index.ensure_folder(db_path, folder)
+            for backup in backup_index.list_backups(db_path, folder):
+                if backup["sha256"] is None:
+                    status["unverifiable"] += 1
+                    continue
+
+                bytes_before = throttle.done
+                try:
+                    ok = verify_backup(folder, backup["name"], backup["sha256"], throttle)
+                    error = None if ok else "checksum do not match"
+                except FileNotFoundError:
+                    if backup_index.get_backup(db_path, folder, backup["name"]) is None:
+                        continue
+                    error = "backup is missing"
+                except (OSError, ValueError) as e:
+                    error = str(e)
+                status["bytes"] += throttle.done - bytes_before
+
+                # A backup uploaded again during the pass was verified against the old checksum.
+                if error == "checksum do not match" and is_replaced(db_path, folder, backup):
+                    continue
+
+                if error is None:
+                    status["verified"] += 1
+                    metrics.inc("ddmail_scrubbed_backups_total", result="ok")
+                else:
+                    full_path = os.path.join(folder, backup["name"])
+                    status["failed"].append({"path": full_path, "error": error})
+                    metrics.inc("ddmail_scrubbed_backups_total", result="failed")
+                    app.logger.error("scrub of " + full_path + " failed: " + error)
+
+        status["finished"] = time.time()
+        write_status(app, status)
+
+    app.logger.info("scrub verified %s backups, %s failed", status["verified"], len(status["failed"]))
+    return status
+
+
+class ScrubWorker:
+    """Background thread that runs a scrub pass every SCRUB_INTERVAL seconds.
+
+    The thread is started on the first request in each process, like RetentionWorker.
+    All processes share the status file and lock in the instance folder, so one pass
+    is run per interval by whichever process gets the lock first.
+    """
+
+    def __init__(self, app: Flask):
+        """Create a worker for app, the thread is started by ensure_started."""
+        self.app = app
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def ensure_started(self) -> None:
+        """Start the thread in this process if it is not running."""
+        with self.lock:
+            if self.thread is None or self.pid != os.getpid() or not self.thread.is_alive():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.run, name="scrub", daemon=True)
+                self.thread.start()
+
+    def seconds_until_due(self) -> float:
+        """Return the seconds until the next pass should start."""
+        status = read_status(self.app)
+        if status is None or status["finished"] is None:
+            return 0
+        return status["finished"] + self.app.config["SCRUB_INTERVAL"] - time.time()
+
+    def run(self) -> None:
+        """Run scrub passes until the process exits."""
+        while True:
+            wait = self.seconds_until_due()
+            if wait > 0:
+                time.sleep(min(wait, 3600))
+                continue
+
+            try:
+                with self.app.app_context():
+                    status = run_scrub(self.app)
+            except Exception:
+                self.app.logger.exception("scrub failed")
+                status = None
+
+            # Another process is scrubbing or the pass failed, check again later.
+            if status is None:
+                time.sleep(300)
+
+
+def start_scrub_worker() -> None:
+    """Start the scrub worker of this process if SCRUB_INTERVAL is set."""
+    if current_app.config["SCRUB_INTERVAL"] > 0:
+        current_app.extensions["scrub_worker"].ensure_started()
+
+
+def init_app(app: Flask) -> None:
+    """Set up the scrub worker of app."""
+    app.extensions["scrub_worker"] = ScrubWorker(app)
+    app.before_request(start_scrub_worker)
+
+
+@bp.route("/status", methods=["GET"])
+def scrub_status() -> Response:
+    """Return the result of the last scrub pass for monitoring.
+
+    Only the default client from PASSWORD_HASH can read the status, since it covers the
+    backups of all clients.
+
+    Request Headers:
+        X-Password (str): Authentication password for the request
+        X-Token (str): Upload token from /auth, used instead of X-Password
+
+    Error Responses:
+        401: Missing, invalid or wrong password or upload token
+
+    Success Response:
+        JSON with started, finished, verified, bytes, unverifiable and failed, a list of
+        path and error of the backups that failed, or null fields if no pass has finished.
+    """
+    client, error = authenticate(None, request.headers.get('X-Password'), request.headers.get('X-Token'))
+    if error is not None:
+        current_app.logger.error(error)
+        return make_response("error: " + error, 401)
+
+    status = read_status(current_app._get_current_object())
+    if status is None:
+        status = {"started": None, "finished": None, "verified": None, "bytes": None, "unverifiable": None,
+                  "failed": None}
+    status["interval"] = current_app.config["SCRUB_INTERVAL"]
+    return jsonify(status)
@@ -0,0 +1,309 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import tempfile
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+from flask import Flask, current_app, g, request
+
+# Files in the instance folder with the uploads that is read by all worker processes
+# and the lock that protects it.
+STREAMS_NAME = "shaping.json"
+STREAMS_LOCK_NAME = "shaping.lock"
+
+# Seconds between updates of the rate of an upload from the shared file.
+UPDATE_INTERVAL = 0.25
+
+# Seconds after which an upload that has not updated its rate is not counted.
+STALE_SECONDS = 10
+
+# Seconds of data at the rate of an upload that can be read at once after a pause.
+BURST_SECONDS = 0.25
+
+# Max bytes read from the client at a time, so no read takes much more than its share.
+READ_SIZE = 65536
+
+# An upload that was not throttled is given this much more than it used, so it can
+# speed up again, and at least MIN_DEMAND bytes per second.
+DEMAND_HEADROOM = 1.25
+MIN_DEMAND = 65536
+
+MB = 1024 * 1024
+
+
+class TokenBucket:
+    """Token bucket that sleeps when more bytes is taken than the rate allows."""
+
+    def __init__(self, rate: float):
+        """Create a bucket for rate bytes per second with tokens for one read.
+
+        The bucket do not start full, so uploads that start together do not all get a
+        burst before their rates is shared.
+        """
+        self.rate = rate
+        self.tokens = READ_SIZE
+        self.updated = time.monotonic()
+
+    def capacity(self) -> float:
+        """Return the max number of tokens, BURST_SECONDS of the rate and at least one read."""
+        return max(self.rate * BURST_SECONDS, READ_SIZE)
+
+    def set_rate(self, rate: float) -> None:
+        """Change the rate, the tokens already in the bucket is kept."""
+        self.refill()
+        self.rate = rate
+        self.tokens = min(self.tokens, self.capacity())
+
+    def refill(self) -> None:
+        """Add the tokens for the time since the last refill."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity(), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, size: int) -> float:
+        """Take size tokens, sleep until the bucket is no longer negative and return the seconds slept."""
+        self.refill()
+        self.tokens -= size
+        if self.tokens >= 0:
+            return 0.0
+        delay = -self.tokens / self.rate
+        time.sleep(delay)
+        return delay
+
+
+def water_fill(total: float, demands: Dict[str, float]) -> Dict[str, float]:
+    """Share total between keys with max-min fairness.
+
+    Every key gets an equal share of total, but never more than its demand. What a key
+    do not use is shared equally between the keys that want more.
+
+    Args:
+        total (float): Bytes per second to share, inf is no limit.
+        demands (Dict[str, float]): Max bytes per second of every key, inf is no limit.
+
+    Returns:
+        Dict[str, float]: Bytes per second of every key.
+    """
+    shares = {}
+    remaining = total
+    keys = sorted(demands, key=lambda key: demands[key])
+    for i, key in enumerate(keys):
+        share = min(demands[key], remaining / (len(keys) - i))
+        shares[key] = share
+        # Without a limit nothing is used up, inf - inf would be nan.
+        if share != float("inf"):
+            remaining -= share
+    return shares
+
+
+def allocate(streams: dict, global_rate: float) -> Dict[str, float]:
+    """Return the rate of every upload, shared fairly between clients and then between the uploads of a client.
+
+    Args:
+        streams (dict): Uploads by id with client, the client limit as cap and the
+                        demand of the upload, in bytes per second.
+        global_rate (float): Bytes per second for all uploads, inf is no limit.
+
+    Returns:
+        Dict[str, float]: Bytes per second of every upload.
+    """
+    clients = {}
+    for stream_id, stream in streams.items():
+        clients.setdefault(stream["client"], {"cap": stream["cap"], "demands": {}})
+        clients[stream["client"]]["demands"][stream_id] = stream["demand"]
+
+    client_shares = water_fill(global_rate, {
+        client: min(value["cap"], sum(value["demands"].values())) for client, value in clients.items()
+    })
+
+    rates = {}
+    for client, value in clients.items():
+        rates.update(water_fill(client_shares[client], value["demands"]))
+    return rates
+
+
+def to_json_rate(rate: float) -> Optional[float]:
+    """Return a rate for the shared file, where no limit is null."""
+    return None if rate == float("inf") else rate
+
+
+def from_json_rate(rate: Optional[float]) -> float:
+    """Return a rate from the shared file, where no limit is null."""
+    return float("inf") if rate is None else rate
+
+
+class Shaper:
+    """Shares RATE_LIMIT_MB between the uploads that is read by all worker processes.
+
+    Every upload that is read has an entry in a file in the instance folder with its
+    client, the limit of the client and how fast it wants to be read, so the rates can
+    be shared by all gunicorn workers. An upload updates its entry every UPDATE_INTERVAL
+    and gets its new rate back. An upload that was not throttled is slower than its
+    share, for example because of the uplink of the client, and its demand is set to a
+    bit more than it used, so the rest is given to the other uploads.
+    """
+
+    def __init__(self, app: Flask):
+        """Create a shaper for app with the global limit RATE_LIMIT_MB."""
+        self.app = app
+        self.global_rate = app.config["RATE_LIMIT_MB"] * MB or float("inf")
+
+    @contextmanager
+    def lock(self) -> Iterator[dict]:
+        """Hold the lock of the shared file and yield the live uploads, which is written back after."""
+        path = os.path.join(self.app.instance_path, STREAMS_NAME)
+        with open(os.path.join(self.app.instance_path, STREAMS_LOCK_NAME), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(path, 'r') as f:
+                    streams = json.load(f)
+            except (OSError, ValueError):
+                streams = {}
+
+            now = time.time()
+            streams = {key: value for key, value in streams.items()
+                       if now - value["updated"] < STALE_SECONDS}
+            yield streams
+
+            fd, tmp_path = tempfile.mkstemp(dir=self.app.instance_path, prefix=".tmp-")
+            with os.fdopen(fd, 'w') as f:
+                json.dump(streams, f)
+            os.replace(tmp_path, path)
+
+    def update(self, stream_id: str, client: str, cap: float, demand: float) -> float:
+        """Save the demand of an upload and return its rate in bytes per second."""
+        with self.lock() as streams:
+            streams[stream_id] = {
+                "client": client,
+                "cap": to_json_rate(cap),
+                "demand": to_json_rate(demand),
+                "updated": time.time(),
+            }
+            rates = allocate({
+                key: {"client": value["client"], "cap": from_json_rate(value["cap"]),
+                      "demand": from_json_rate(value["demand"])}
+                for key, value in streams.items()
+            }, self.global_rate)
+        return rates[stream_id]
+
+    def remove(self, stream_id: str) -> None:
+        """Remove an upload that is read, its rate is shared by the others at their next update."""
+        with self.lock() as streams:
+            streams.pop(stream_id, None)
+
+
+class ShapedStream:
+    """WSGI input stream that is read at the rate the Shaper gives the upload.
+
+    The rate is applied to every read, so the upload is slowed down while it is read
+    and no more than READ_SIZE bytes is held at a time.
+    """
+
+    def __init__(self, stream, shaper: Shaper, client: str, cap: float):
+        """Wrap stream of an upload of client, which is limited to cap bytes per second."""
+        self.stream = stream
+        self.shaper = shaper
+        self.client = client
+        self.cap = cap
+        self.stream_id = uuid.uuid4().hex
+        self.bucket = TokenBucket(shaper.update(self.stream_id, client, cap, float("inf")))
+        self.interval_start = time.monotonic()
+        self.interval_bytes = 0
+        self.interval_slept = 0.0
+
+    def account(self, size: int) -> None:
+        """Take size bytes from the bucket and update the rate every UPDATE_INTERVAL."""
+        self.interval_slept += self.bucket.consume(size)
+        self.interval_bytes += size
+
+        elapsed = time.monotonic() - self.interval_start
+        if elapsed >= UPDATE_INTERVAL:
+            if self.interval_slept > 0:
+                demand = float("inf")
+            else:
+                demand = max(MIN_DEMAND, self.interval_bytes / elapsed * DEMAND_HEADROOM)
+            self.bucket.set_rate(self.shaper.update(self.stream_id, self.client, self.cap, demand))
+            self.interval_start = time.monotonic()
+            self.interval_bytes = 0
+            self.interval_slept = 0.0
+
+    def read(self, size: int = -1) -> bytes:
+        """Read at most size bytes, or all if size is negative, at the rate of the upload."""
+        if size is None or size < 0:
+            parts = []
+            while True:
+                data = self.read(READ_SIZE)
+                if not data:
+                    return b"".join(parts)
+                parts.append(data)
+
+        data = self.stream.read(min(size, READ_SIZE))
+        self.account(len(data))
+        return data
+
+    def readline(self, size: int = -1) -> bytes:
+        """Read a line at the rate of the upload."""
+        data = self.stream.readline(READ_SIZE if size is None or size < 0 else min(size, READ_SIZE))
+        self.account(len(data))
+        return data
+
+    def __iter__(self):
+        """Iterate over the lines of the stream."""
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def close(self) -> None:
+        """Stop counting the upload in the shared rates."""
+        self.shaper.remove(self.stream_id)
+
+
+def client_rate_limit(client: Optional[dict]) -> float:
+    """Return the limit of client in bytes per second, or of RATE_LIMIT_CLIENT_MB if the client is not known yet."""
+    if client is None:
+        rate = current_app.config["RATE_LIMIT_CLIENT_MB"]
+    else:
+        rate = client["rate_limit"]
+    return rate * MB or float("inf")
+
+
+def shape_request(client: Optional[dict]) -> None:
+    """Read the body of the current request at the rate of its client, if a rate limit is set.
+
+    Must be called before the body is read. Clients that send credentials in the form
+    is not known until the body is read, they share the limit of their address.
+
+    Args:
+        client (Optional[dict]): The client from get_client, or None if it is not known yet.
+
+    Returns:
+        None
+    """
+    shaper = current_app.extensions.get("shaper")
+    cap = client_rate_limit(client)
+    if shaper is None or (shaper.global_rate == float("inf") and cap == float("inf")):
+        return
+
+    key = "client:" + str(client["id"]) if client is not None else "address:" + str(request.remote_addr)
+    stream = ShapedStream(request.environ["wsgi.input"], shaper, key, cap)
+    request.environ["wsgi.input"] = stream
+    g.shaped_stream = stream
+
+
+def remove_shaped_stream(exc: Optional[BaseException]) -> None:
+    """Remove the upload of the request from the shared rates when the request ends."""
+    stream = g.pop("shaped_stream", None)
+    if stream is not None:
+        stream.close()
+
+
+def init_app(app: Flask) -> None:
+    """Set up bandwidth shaping of uploads for app if a rate limit is set."""
+    has_client_limit = any(client.get("RATE_LIMIT_MB") for client in app.config["CLIENTS"].values())
+    if app.config["RATE_LIMIT_MB"] or app.config["RATE_LIMIT_CLIENT_MB"] or has_client_limit:
+        app.extensions["shaper"] = Shaper(app)
+    app.teardown_request(remove_shaped_stream)
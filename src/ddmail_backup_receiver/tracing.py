@@ -0,0 +1,114 @@
+import os
+import json
+import time
+import random
+import cProfile
+from typing import Dict, Optional
+from flask import Flask, current_app, g, has_request_context, request, Response
+
+# Name of the folder in the instance folder where sampled profiles are saved.
+PROFILES_FOLDER_NAME = "profiles"
+
+
+class RequestTrace:
+    """Time spent in each stage of a request.
+
+    A view marks the end of a stage with mark, the time since the previous mark is
+    added to the stage. Marking the same stage again adds to it, so a stage can be
+    split over several parts of a view.
+    """
+
+    def __init__(self):
+        """Start the trace now."""
+        self.start = time.perf_counter()
+        self.last = self.start
+        self.stages = {}
+
+    def mark(self, stage: str) -> None:
+        """End stage now."""
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - self.last
+        self.last = now
+
+    def breakdown(self) -> Dict[str, float]:
+        """Return the seconds of every stage and of the rest of the request until now."""
+        now = time.perf_counter()
+        stages = dict(self.stages)
+        stages["other"] = stages.get("other", 0.0) + now - self.last
+        return stages
+
+
+def mark_stage(stage: str) -> None:
+    """End stage of the current request, do nothing outside of a request."""
+    if has_request_context():
+        trace = g.get("trace")
+        if trace is not None:
+            trace.mark(stage)
+
+
+def profile_path(instance_path: str) -> str:
+    """Return a new path in the profiles folder for a profile of the current request."""
+    folder = os.path.join(instance_path, PROFILES_FOLDER_NAME)
+    os.makedirs(folder, exist_ok=True)
+    name = time.strftime("%Y%m%d-%H%M%S") + "-" + (request.endpoint or "none") + "-" + str(os.getpid()) + "-"
+    name += format(random.getrandbits(32), "08x") + ".prof"
+    return os.path.join(folder, name)
+
+
+def start_trace() -> None:
+    """Start the trace of the request and the profiler if the request is sampled."""
+    g.trace = RequestTrace()
+
+    rate = current_app.config["PROFILE_SAMPLE_RATE"]
+    if rate > 0 and random.random() < rate:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already active in this thread.
+            return
+        g.profiler = profiler
+
+
+def finish_trace(response: Response) -> Response:
+    """Log the stages of a slow request."""
+    trace: Optional[RequestTrace] = g.pop("trace", None)
+    if trace is None:
+        return response
+
+    stages = trace.breakdown()
+    duration = sum(stages.values())
+    threshold = current_app.config["SLOW_REQUEST_THRESHOLD"]
+    if threshold is not False and duration >= threshold:
+        current_app.logger.warning("slow request %s", json.dumps({
+            "endpoint": request.endpoint,
+            "method": request.method,
+            "status": response.status_code,
+            "content_length": request.content_length,
+            "client": request.headers.get('X-Client'),
+            "duration": round(duration, 6),
+            "stages": {stage: round(seconds, 6) for stage, seconds in stages.items()},
+        }))
+
+    return response
+
+
+def save_profile(exc: Optional[BaseException]) -> None:
+    """Stop the profiler of a sampled request and save the profile when the request ends.
+
+    This is a teardown function, so the profiler is also stopped when the view raise
+    and after_request functions is not called.
+    """
+    profiler: Optional[cProfile.Profile] = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.disable()
+        path = profile_path(current_app.instance_path)
+        profiler.dump_stats(path)
+        current_app.logger.info("saved profile of request to " + path)
+
+
+def init_app(app: Flask) -> None:
+    """Trace the stages of the requests of app."""
+    app.before_request(start_trace)
+    app.after_request(finish_trace)
+    app.teardown_request(save_profile)
@@ -0,0 +1,440 @@
+import os
+import re
+import json
+import time
+import fcntl
+import shutil
+import secrets
+from typing import Optional, Tuple
+from flask import Blueprint, current_app, request, make_response, jsonify, Response
+from werkzeug.utils import secure_filename
+import ddmail_validators.validators as validators
+from ddmail_backup_receiver.application import (
+    busy_response,
+    check_upload_headers,
+    copy_and_sha256,
+    early_error_response,
+    sha256_of_file,
+    store_backup,
+    validate_backups_to_save,
+)
+from ddmail_backup_receiver.auth import authenticate
+from ddmail_backup_receiver import admission
+from ddmail_backup_receiver import backup_index
+from ddmail_backup_receiver.ingest_limit import acquire_ingest_slot
+from ddmail_backup_receiver.retention import schedule_retention
+from ddmail_backup_receiver.shaping import shape_request
+
+bp = Blueprint("upload_session", __name__, url_prefix="/upload_session")
+
+# Name of the hidden folder inside the upload folder where unfinished uploads are stored.
+# It is in the same filesystem as the upload folder so finished uploads can be renamed in place.
+SESSIONS_FOLDER_NAME = ".upload_sessions"
+
+
+def sessions_folder(upload_folder: str) -> str:
+    """Return the folder where upload sessions are stored for upload_folder.
+
+    Args:
+        upload_folder (str): Folder where finished backups are stored.
+
+    Returns:
+        str: Path to the upload sessions folder.
+    """
+    return os.path.join(upload_folder, SESSIONS_FOLDER_NAME)
+
+
+def is_session_id_allowed(session_id: str) -> bool:
+    """Validate a session id, only 32 lowercase hex chars is allowed.
+
+    Args:
+        session_id (str): Session id to validate.
+
+    Returns:
+        bool: True if the session id is valid, otherwise False.
+    """
+    return re.fullmatch(r"[0-9a-f]{32}", session_id) is not None
+
+
+def last_change(folder: str) -> float:
+    """Return the newest modification time of the files in folder.
+
+    Chunks is written into data.part and parts is written to new files, neither
+    change the modification time of the folder, so the files is checked. The lock
+    file is changed by every request that open it and is not counted.
+
+    Args:
+        folder (str): Folder of an upload session or multipart upload.
+
+    Returns:
+        float: Modification time in seconds since the epoch, of folder if it has no files.
+    """
+    mtimes = []
+    for entry in os.scandir(folder):
+        if entry.name == "lock":
+            continue
+        try:
+            mtimes.append(entry.stat().st_mtime)
+        except FileNotFoundError:
+            pass
+    return max(mtimes) if mtimes else os.stat(folder).st_mtime
+
+
+def remove_stale_sessions(folder: str, max_age: int) -> None:
+    """Remove upload sessions that have not been changed for max_age seconds.
+
+    A session is only removed while its lock can be taken, so a session that a
+    chunk is written to or that is finalized is never removed.
+
+    Args:
+        folder (str): Folder where upload sessions are stored.
+        max_age (int): Max age in seconds of an upload session.
+
+    Returns:
+        None
+    """
+    if not os.path.isdir(folder):
+        return
+
+    now = time.time()
+    for entry in os.scandir(folder):
+        if not entry.is_dir():
+            continue
+        try:
+            if now - last_change(entry.path) <= max_age:
+                continue
+
+            with open(os.path.join(entry.path, "lock"), 'w') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+
+                # Check again, a chunk could have been written before the lock was taken.
+                if time.time() - last_change(entry.path) <= max_age:
+                    continue
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except FileNotFoundError:
+            # Removed by another request at the same time.
+            continue
+        current_app.logger.info("removing stale upload session: " + entry.name)
+
+
+def get_session_folder(session_id: Optional[str], client: dict) -> Tuple[Optional[str], Optional[str]]:
+    """Validate session_id and return the folder of the upload session of client.
+
+    Args:
+        session_id (Optional[str]): Session id from the request.
+        client (dict): Client of the request from get_client.
+
+    Returns:
+        tuple: Path to the session folder and None, or None and an error message.
+    """
+    if session_id is None:
+        return None, "session_id is none"
+
+    session_id = session_id.strip()
+
+    if not is_session_id_allowed(session_id):
+        return None, "session_id validation failed"
+
+    session_folder = os.path.join(sessions_folder(client["upload_folder"]), session_id)
+    if not os.path.isdir(session_folder):
+        return None, "upload session do not exist"
+
+    return session_folder, None
+
+
+def error_response(error: str) -> Response:
+    """Log error and return it as a response in the same format as receive_backup."""
+    current_app.logger.error(error)
+    return make_response("error: " + error, 200)
+
+
+@bp.route("/open", methods=["POST"])
+def open_session() -> Response:
+    """Open a new resumable upload session.
+
+    Request Form Parameters:
+        filename (str): Name to save the finished file as
+        password (str): Authentication password for the request
+        token (str): Upload token from /auth, used instead of password
+        client (str, optional): Client id, the session is stored in the client folder
+        sha256 (str): Expected SHA256 checksum of the finished file
+        size (int, optional): Size of the finished file, checked against the free disc
+                              space and the quota of the client
+
+    Success Response:
+        JSON with session_id and the offset (0) to send the first chunk at.
+    """
+    filename = request.form.get('filename')
+    sha256_from_form = request.form.get('sha256')
+
+    client, error = authenticate(request.form.get('client'), request.form.get('password'), request.form.get('token'))
+    if error is not None:
+        return error_response(error)
+
+    if filename is None:
+        return error_response("filename is none")
+
+    if sha256_from_form is None:
+        return error_response("sha256_from_form is none")
+
+    filename = filename.strip()
+    sha256_from_form = sha256_from_form.strip()
+
+    if not validators.is_filename_allowed(filename):
+        return error_response("filename validation failed")
+
+    if not validators.is_sha256_allowed(sha256_from_form):
+        return error_response("sha256 checksum validation failed")
+
+    upload_folder = client["upload_folder"]
+    if not os.path.isdir(upload_folder):
+        return error_response("upload folder " + upload_folder + " do not exist")
+
+    folder = sessions_folder(upload_folder)
+    remove_stale_sessions(folder, current_app.config["UPLOAD_SESSION_MAX_AGE"])
+
+    # Check that the finished file fits the disc and the quota before any chunk is sent.
+    size = request.form.get('size')
+    if size is not None:
+        size = size.strip()
+        if not size.isdigit():
+            return error_response("size validation failed")
+        error = admission.check_size(client, int(size))
+        if error is not None:
+            return error_response(error)
+
+    session_id = secrets.token_hex(16)
+    session_folder = os.path.join(folder, session_id)
+    os.makedirs(session_folder)
+
+    with open(os.path.join(session_folder, "session.json"), 'w') as f:
+        json.dump({"filename": filename, "sha256": sha256_from_form}, f)
+    open(os.path.join(session_folder, "data.part"), 'wb').close()
+
+    current_app.logger.info("opened upload session " + session_id + " for " + filename)
+    return jsonify({"session_id": session_id, "offset": 0})
+
+
+@bp.route("/status", methods=["POST"])
+def session_status() -> Response:
+    """Return the number of bytes received so far, the offset to resume the upload from.
+
+    Request Form Parameters:
+        password (str): Authentication password for the request
+        token (str): Upload token from /auth, used instead of password
+        client (str, optional): Client id, the session is stored in the client folder
+        session_id (str): Id of the upload session
+
+    Success Response:
+        JSON with session_id and offset.
+    """
+    client, error = authenticate(request.form.get('client'), request.form.get('password'), request.form.get('token'))
+    if error is not None:
+        return error_response(error)
+
+    session_folder, error = get_session_folder(request.form.get('session_id'), client)
+    if error is not None:
+        return error_response(error)
+
+    offset = os.path.getsize(os.path.join(session_folder, "data.part"))
+    return jsonify({"session_id": os.path.basename(session_folder), "offset": offset})
+
+
+@bp.route("/chunk", methods=["POST"])
+def receive_chunk() -> Response:
+    """Receive one chunk of an upload session and write it at the given offset.
+
+    The chunk is verified against its own SHA256 checksum. A chunk that do not match
+    is discarded and the upload can be resumed from the same offset. Sending a chunk
+    at an offset before the end of the received data discards the data after offset.
+
+    Request Headers (optional):
+        X-Client (str): Client id, checked before the body is read
+        X-Password (str): Authentication password, checked before the body is read
+        X-Token (str): Upload token from /auth, used instead of X-Password
+
+        When X-Password or X-Token is set a refused chunk gets a 4xx or 507 status before
+        the body is read, see receive_backup_stream, and the form password and token are
+        not needed. Credentials in the form is only known when the whole chunk is received,
+        so disc space and quota of those chunks is checked after the body is read.
+
+    Request Form Parameters:
+        file (FileStorage): The chunk data
+        password (str): Authentication password for the request
+        token (str): Upload token from /auth, used instead of password
+        client (str, optional): Client id, the session is stored in the client folder
+        session_id (str): Id of the upload session
+        offset (int): Offset in the finished file where the chunk starts
+        sha256 (str): Expected SHA256 checksum of the chunk
+
+    Error Responses:
+        503 "error: server is busy": If INGEST_CONCURRENCY uploads is saved and the wait
+            queue is full or the wait timed out, with Retry-After, also for form clients
+
+    Success Response:
+        JSON with session_id and the offset to send the next chunk at.
+    """
+    # Clients that send credentials in headers are checked before the body is read.
+    client = None
+    reservation_id = None
+    if 'X-Password' in request.headers or 'X-Token' in request.headers:
+        client, error, status = check_upload_headers(require_metadata=False)
+        if error is not None:
+            return early_error_response(error, status)
+
+    # Wait for an ingest slot before the body is read, if INGEST_CONCURRENCY is set.
+    retry_after = acquire_ingest_slot()
+    if retry_after is not None:
+        return busy_response(retry_after)
+
+    # Reserve disc space and quota for the chunk before the body is read.
+    if client is not None:
+        reservation_id, error = admission.reserve(client, request.content_length)
+        if error is not None:
+            return early_error_response(error, 507)
+
+    # Read the chunk at the rate of the client, if RATE_LIMIT_MB or a client limit is set.
+    # Form clients is limited per address until they are known.
+    shape_request(client)
+
+    # Check client and credentials in the form, this reads the request body.
+    if client is None:
+        client, error = authenticate(request.form.get('client'), request.form.get('password'), request.form.get('token'))
+        if error is not None:
+            return error_response(error)
+
+    session_folder, error = get_session_folder(request.form.get('session_id'), client)
+    if error is not None:
+        return error_response(error)
+
+    if 'file' not in request.files:
+        return error_response("file is not in request.files")
+
+    offset = request.form.get('offset')
+    sha256_from_form = request.form.get('sha256')
+
+    if offset is None:
+        return error_response("offset is none")
+
+    if sha256_from_form is None:
+        return error_response("sha256_from_form is none")
+
+    offset = offset.strip()
+    sha256_from_form = sha256_from_form.strip()
+
+    if not offset.isdigit():
+        return error_response("offset validation failed")
+    offset = int(offset)
+
+    if not validators.is_sha256_allowed(sha256_from_form):
+        return error_response("sha256 checksum validation failed")
+
+    data_path = os.path.join(session_folder, "data.part")
+
+    # Reserve disc space and quota for a chunk from a form client.
+    if reservation_id is None:
+        reservation_id, error = admission.reserve(client, request.content_length or 0)
+        if error is not None:
+            return error_response(error)
+
+    # Lock the session so chunks of the same session is not written at the same time.
+    with open(os.path.join(session_folder, "lock"), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        # The session can have been removed as stale while the chunk was received.
+        if not os.path.isfile(data_path):
+            return error_response("upload session do not exist")
+
+        if offset > os.path.getsize(data_path):
+            return error_response("offset is after end of received data")
+
+        with open(data_path, 'r+b') as f:
+            f.truncate(offset)
+            f.seek(offset)
+            sha256_from_chunk = copy_and_sha256(request.files['file'].stream, f)
+
+            # Discard the chunk if it is damaged.
+            if sha256_from_chunk != sha256_from_form:
+                f.truncate(offset)
+                return error_response("sha256 checksum do not match")
+
+            new_offset = f.tell()
+        admission.release(reservation_id)
+
+    return jsonify({"session_id": os.path.basename(session_folder), "offset": new_offset})
+
+
+@bp.route("/finalize", methods=["POST"])
+def finalize_session() -> Response:
+    """Finish an upload session and store the backup.
+
+    The received data is verified against the SHA256 checksum given when the session
+    was opened, moved to the upload folder, or compressed or stored as chunks depending
+    on COMPRESSION and STORAGE_MODE, and old backups are removed.
+
+    Request Form Parameters:
+        password (str): Authentication password for the request
+        token (str): Upload token from /auth, used instead of password
+        client (str, optional): Client id, the session is stored in the client folder
+        session_id (str): Id of the upload session
+
+    Error Responses:
+        503 "error: server is busy": If INGEST_CONCURRENCY uploads is saved and the wait
+            queue is full or the wait timed out, with Retry-After
+
+    Success Response:
+        "done": Operation completed successfully
+    """
+    client, error = authenticate(request.form.get('client'), request.form.get('password'), request.form.get('token'))
+    if error is not None:
+        return error_response(error)
+
+    session_folder, error = get_session_folder(request.form.get('session_id'), client)
+    if error is not None:
+        return error_response(error)
+
+    backups_to_save = client["backups_to_save"]
+    error = validate_backups_to_save(backups_to_save)
+    if error is not None:
+        return error_response(error)
+
+    with open(os.path.join(session_folder, "session.json"), 'r') as f:
+        session = json.load(f)
+
+    upload_folder = client["upload_folder"]
+    data_path = os.path.join(session_folder, "data.part")
+
+    # Wait for an ingest slot before the session is hashed and stored, if INGEST_CONCURRENCY is set.
+    retry_after = acquire_ingest_slot()
+    if retry_after is not None:
+        return busy_response(retry_after)
+
+    with open(os.path.join(session_folder, "lock"), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        # The session can have been removed as stale before the lock was taken.
+        if not os.path.isfile(data_path):
+            return error_response("upload session do not exist")
+
+        if sha256_of_file(data_path) != session["sha256"]:
+            return error_response("sha256 checksum do not match")
+
+        # Uncompressed plain backups is renamed in place, other backups is stored with store_backup.
+        name = secure_filename(session["filename"])
+        if current_app.config["STORAGE_MODE"] == "plain" and current_app.config["COMPRESSION"] == "none":
+            os.replace(data_path, upload_folder + "/" + name)
+        else:
+            with open(data_path, 'rb') as f:
+                name = store_backup(f, upload_folder, name)[0]
+        backup_index.add_backup(current_app.config["BACKUP_INDEX"], upload_folder, name, session["sha256"])
+
+    shutil.rmtree(session_folder, ignore_errors=True)
+
+    # Delete old backups, in the background unless RETENTION_SYNC is set.
+    schedule_retention(upload_folder, backups_to_save)
+
+    current_app.logger.info("done")
+    return make_response("done", 200)
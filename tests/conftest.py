@@ -1,4 +1,7 @@
+import hashlib
 import os
+import shutil
+import tempfile
 import pytest
 from ddmail_backup_receiver import create_app
 
@@ -35,7 +38,7 @@ def password(request):
 def app(config_file):
     """Create and configure a new app instance for each test."""
     app = create_app(config_file = config_file)
-    app.config.update({"TESTING": True,})
+    app.config.update({"TESTING": True, "RETENTION_SYNC": True,})
 
     yield app
 
@@ -50,3 +53,30 @@ def client(app):
 def runner(app):
     """A test runner for the app's Click commands."""
     return app.test_cli_runner()
+
+
+@pytest.fixture
+def folder(app):
+    """Temporary upload folder that keeps 2 backups."""
+    folder = tempfile.mkdtemp()
+    app.config["UPLOAD_FOLDER"] = folder
+    app.config["BACKUPS_TO_SAVE"] = 2
+
+    yield folder
+
+    shutil.rmtree(folder)
+
+
+@pytest.fixture
+def upload_stream(client, password):
+    """Function that uploads data with receive_backup_stream.
+
+    The upload is sent with the test password unless headers has other credentials.
+    """
+    def upload(data, filename, **headers):
+        if "X-Password" not in headers and "X-Token" not in headers:
+            headers["X-Password"] = password
+        headers.update({"X-Filename": filename, "X-Sha256": hashlib.sha256(data).hexdigest()})
+        return client.post("/receive_backup_stream", data=data, headers=headers)
+
+    return upload
@@ -0,0 +1,147 @@
+import hashlib
+import os
+from io import BytesIO
+import pytest
+from argon2 import PasswordHasher
+from ddmail_backup_receiver import admission
+from ddmail_backup_receiver.clients import get_client
+
+# Password of the client used in the tests.
+CLIENT_PASSWORD = "clientpassword1234567890"
+
+
+@pytest.fixture
+def folder(app, folder):
+    """Temporary upload folder with the client mail1 and no reservations."""
+    app.config["DISK_RESERVE"] = 0
+    app.config["CLIENTS"] = {
+        "mail1": {"PASSWORD_HASH": PasswordHasher().hash(CLIENT_PASSWORD), "QUOTA": 100},
+    }
+    if os.path.exists(admission.reservations_path(app)):
+        os.remove(admission.reservations_path(app))
+
+    return folder
+
+
+def test_disc_space(app, client, password, folder, monkeypatch, upload_stream):
+    """Test that an upload that do not fit the free space minus the reserve is refused before it is written."""
+    monkeypatch.setattr(admission, "free_bytes", lambda folder: 1000)
+
+    app.config["DISK_RESERVE"] = 500
+    response = upload_stream(b"x" * 600, "backup.tar")
+    assert response.status_code == 507
+    assert response.data == b"error: not enough disc space"
+    assert not os.path.exists(os.path.join(folder, "backup.tar"))
+
+    response = client.post("/receive_backup", content_type='multipart/form-data', headers={"X-Password": password},
+                           data={"filename": "backup.tar", "file": (BytesIO(b"x" * 600), "backup.tar"),
+                                 "sha256": hashlib.sha256(b"x" * 600).hexdigest()})
+    assert response.status_code == 507
+
+    app.config["DISK_RESERVE"] = 0
+    assert upload_stream(b"x" * 600, "backup.tar").status_code == 200
+
+
+def test_reservations(app, folder, monkeypatch):
+    """Test that uploads in progress in any process is counted and dead processes is not."""
+    monkeypatch.setattr(admission, "free_bytes", lambda folder: 1000)
+
+    with app.test_request_context():
+        client, error = get_client(None)
+        first, error = admission.reserve(client, 600)
+        assert error is None
+        assert admission.reserve(client, 600) == (None, "not enough disc space")
+
+        admission.release(first)
+        second, error = admission.reserve(client, 600)
+        assert error is None
+
+        # A reservation of a worker that was killed.
+        with admission.reservations_lock(app):
+            reservations = admission.read_reservations(app)
+            reservations[second]["pid"] = 2 ** 22 + 1
+            admission.write_reservations(app, reservations)
+        third, error = admission.reserve(client, 600)
+        assert error is None
+
+    # The reservations of a request is released when it ends.
+    with admission.reservations_lock(app):
+        assert admission.read_reservations(app) == {}
+
+
+def test_quota(app, client, folder, upload_stream):
+    """Test that a client can not store more than its quota."""
+    headers = {"X-Client": "mail1", "X-Password": CLIENT_PASSWORD}
+    assert upload_stream(b"x" * 60, "backup1.tar", **headers).status_code == 200
+
+    response = upload_stream(b"x" * 60, "backup2.tar", **headers)
+    assert response.status_code == 507
+    assert response.data == b"error: quota exceeded"
+
+    assert upload_stream(b"x" * 40, "backup2.tar", **headers).status_code == 200
+
+
+def test_refused_request_releases_reservation(app, client, password, folder):
+    """Test that a reservation is released when the upload is refused after it was reserved."""
+    response = client.post("/receive_backup", content_type='multipart/form-data', headers={"X-Password": password},
+                           data={"file": (BytesIO(b"data"), "backup.tar"), "sha256": hashlib.sha256(b"data").hexdigest()})
+    assert response.data == b"error: filename is none"
+
+    with admission.reservations_lock(app):
+        assert admission.read_reservations(app) == {}
+
+
+def test_quota_multipart_and_sessions(app, client, folder):
+    """Test that multipart uploads and upload sessions is checked against the quota when they are opened and sent."""
+    credentials = {"client": "mail1", "password": CLIENT_PASSWORD, "filename": "backup.tar", "sha256": "1" * 64}
+    response = client.post("/multipart/create", data=dict(credentials, size="200"))
+    assert response.data == b"error: quota exceeded"
+    response = client.post("/upload_session/open", data=dict(credentials, size="200"))
+    assert response.data == b"error: quota exceeded"
+
+    upload_id = client.post("/multipart/create", data=dict(credentials, size="60")).get_json()["upload_id"]
+    for part_number, status in [(1, 200), (2, 507)]:
+        response = client.post("/multipart/part", data=b"x" * 60, headers={
+            "X-Client": "mail1",
+            "X-Password": CLIENT_PASSWORD,
+            "X-Upload-Id": upload_id,
+            "X-Part-Number": str(part_number),
+            "X-Sha256": hashlib.sha256(b"x" * 60).hexdigest(),
+        })
+        assert response.status_code == status
+
+    # The part that was received counts against the quota.
+    session_id = client.post("/upload_session/open", data=credentials).get_json()["session_id"]
+    response = client.post("/upload_session/chunk", content_type='multipart/form-data', data={
+        "client": "mail1",
+        "password": CLIENT_PASSWORD,
+        "session_id": session_id,
+        "offset": "0",
+        "sha256": hashlib.sha256(b"x" * 60).hexdigest(),
+        "file": (BytesIO(b"x" * 60), "chunk"),
+    })
+    assert response.data == b"error: quota exceeded"
+
+    # With credentials in headers the chunk is refused before the body is read.
+    response = client.post("/upload_session/chunk", content_type='multipart/form-data', headers={
+        "X-Client": "mail1",
+        "X-Password": CLIENT_PASSWORD,
+    }, data={
+        "session_id": session_id,
+        "offset": "0",
+        "sha256": hashlib.sha256(b"x" * 60).hexdigest(),
+        "file": (BytesIO(b"x" * 60), "chunk"),
+    })
+    assert response.status_code == 507
+    assert response.data == b"error: quota exceeded"
+
+
+def test_quota_delta(app, client, folder, upload_stream):
+    """Test that a delta upload reserves the size of the basis and the delta."""
+    headers = {"X-Client": "mail1", "X-Password": CLIENT_PASSWORD}
+    assert upload_stream(b"x" * 60, "backup1.tar", **headers).status_code == 200
+
+    response = client.post("/delta/upload", data=b"C" + bytes(16), headers=dict(
+        headers, **{"X-Filename": "backup2.tar", "X-Sha256": "1" * 64, "X-Basis": "backup1.tar"}))
+    assert response.status_code == 507
+    assert response.data == b"error: quota exceeded"
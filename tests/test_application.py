@@ -1,9 +1,12 @@
-from ddmail_backup_receiver.application import sha256_of_file, delete_old_backups
+from ddmail_backup_receiver.application import sha256_of_file, save_and_sha256, delete_old_backups, store_backup
+from ddmail_backup_receiver import backup_index
 from io import BytesIO
+import hashlib
 import os
 import shutil
 import tempfile
 import time
+import pytest
 from unittest.mock import MagicMock
 
 # Testfile used in many testcases.
@@ -16,6 +19,25 @@ TESTFILE_DATA = f.read()
 # Application settings used during testing.
 UPLOAD_FOLDER = "/opt/ddmail_backup_receiver/backups"
 
+class UnreadableStream:
+    """Request body of size bytes that fails the test if it is read."""
+
+    def __init__(self, size):
+        self.size = size
+        self.pos = 0
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=0):
+        self.pos = self.size if whence == 2 else pos
+
+    def read(self, *args):
+        raise AssertionError("request body was read")
+
+    readline = read
+
+
 # Create a binary test file for binary testing
 def create_binary_test_file():
     binary_file_path = "tests/binary_test_file.bin"
@@ -101,6 +123,59 @@ def test_sha256_of_large_file():
             os.remove(large_file_path)
 
 
+def test_save_and_sha256():
+    """Test that save_and_sha256 saves the stream and returns the SHA256 hash of the data.
+
+    Saves the test file data through save_and_sha256 and verifies that the returned
+    hash matches both the expected hash constant and sha256_of_file of the saved file.
+    """
+    temp_dir = tempfile.mkdtemp()
+    try:
+        full_path = os.path.join(temp_dir, TESTFILE_NAME)
+        checksum = save_and_sha256(BytesIO(bytes(TESTFILE_DATA, 'utf-8')), full_path)
+
+        assert checksum == SHA256
+        assert sha256_of_file(full_path) == SHA256
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_save_and_sha256_chunk_sizes():
+    """Test that save_and_sha256 gives the same result for any chunk size.
+
+    Streams data larger than the default buffer size with different chunk sizes and
+    verifies that the saved file and the returned hash are the same every time.
+    """
+    data = bytes(range(256)) * 1000
+    temp_dir = tempfile.mkdtemp()
+    try:
+        full_path = os.path.join(temp_dir, "large_file.bin")
+        for buf_size in [1, 7, 4096, 65536, 1048576]:
+            checksum = save_and_sha256(BytesIO(data), full_path, buf_size=buf_size)
+
+            assert checksum == sha256_of_file(full_path)
+            with open(full_path, 'rb') as f:
+                assert f.read() == data
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_save_and_sha256_empty_stream():
+    """Test that save_and_sha256 correctly handles an empty stream.
+
+    Verifies that an empty file is created and the known SHA256 hash for empty data is returned.
+    """
+    temp_dir = tempfile.mkdtemp()
+    try:
+        full_path = os.path.join(temp_dir, "empty_file.txt")
+        checksum = save_and_sha256(BytesIO(b""), full_path)
+
+        assert checksum == "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855"
+        assert os.path.getsize(full_path) == 0
+    finally:
+        shutil.rmtree(temp_dir)
+
+
 def test_receive_backup_no_password(client):
     """Test that receive_backup correctly handles missing password parameter.
 
@@ -576,6 +651,146 @@ def test_receive_backup_whitespace_trim(client, password):
             os.remove(empty_file_path)
 
 
+def test_receive_backup_stream(client, password):
+    """Test that receive_backup_stream correctly processes a valid raw body upload.
+
+    Sends the test file as an application/octet-stream body with filename, password
+    and SHA256 in headers and verifies that the file is saved and a success message returned.
+    """
+    # Create folder to save backups in if it do not exist.
+    if not os.path.exists(UPLOAD_FOLDER):
+        os.makedirs(UPLOAD_FOLDER)
+
+    response = client.post(
+        "/receive_backup_stream",
+        content_type='application/octet-stream',
+        data=bytes(TESTFILE_DATA, 'utf-8'),
+        headers={
+            "X-Filename": TESTFILE_NAME,
+            "X-Password": password,
+            "X-Sha256": SHA256
+            }
+        )
+
+    assert response.status_code == 200
+    assert b"done" in response.data
+    assert sha256_of_file(UPLOAD_FOLDER + "/" + TESTFILE_NAME) == SHA256
+
+
+def test_receive_backup_stream_wrong_checksum(client, password):
+    """Test that receive_backup_stream correctly validates the checksum of the body."""
+    # Create folder to save backups in if it do not exist.
+    if not os.path.exists(UPLOAD_FOLDER):
+        os.makedirs(UPLOAD_FOLDER)
+
+    response = client.post(
+        "/receive_backup_stream",
+        content_type='application/octet-stream',
+        data=bytes(TESTFILE_DATA, 'utf-8'),
+        headers={
+            "X-Filename": TESTFILE_NAME,
+            "X-Password": password,
+            "X-Sha256": "1b7632005be0f36c5d1663a6c5ec4d13315589d65e1ef8687fb4b9866f9bc4b0"
+            }
+        )
+
+    assert response.status_code == 400
+    assert b"error: sha256 checksum do not match" in response.data
+
+
+def test_receive_backup_stream_wrong_password(client):
+    """Test that receive_backup_stream refuses an incorrect password with 401 before reading the body."""
+    response = client.post(
+        "/receive_backup_stream",
+        content_type='application/octet-stream',
+        input_stream=UnreadableStream(10 * 1024 ** 3),
+        headers={
+            "X-Filename": TESTFILE_NAME,
+            "X-Password": "thisiswrongpassword12345",
+            "X-Sha256": SHA256,
+            "Expect": "100-continue"
+            }
+        )
+
+    assert response.status_code == 401
+    assert response.headers["Connection"] == "close"
+    assert b"error: wrong password" in response.data
+
+
+def test_receive_backup_stream_missing_headers(client, password):
+    """Test that receive_backup_stream correctly handles missing headers."""
+    response = client.post(
+        "/receive_backup_stream",
+        content_type='application/octet-stream',
+        input_stream=UnreadableStream(10),
+        headers={"X-Password": password, "X-Sha256": SHA256}
+        )
+    assert response.status_code == 400
+    assert b"error: filename is none" in response.data
+
+    response = client.post(
+        "/receive_backup_stream",
+        content_type='application/octet-stream',
+        input_stream=UnreadableStream(10),
+        headers={"X-Filename": TESTFILE_NAME, "X-Sha256": SHA256}
+        )
+    assert response.status_code == 401
+    assert b"error: password is none" in response.data
+
+
+def test_receive_backup_stream_content_length(app, client, password):
+    """Test that receive_backup_stream refuses missing and too large Content-Length before reading the body."""
+    headers = {"X-Filename": TESTFILE_NAME, "X-Password": password, "X-Sha256": SHA256}
+
+    response = client.post(
+        "/receive_backup_stream",
+        content_type='application/octet-stream',
+        input_stream=UnreadableStream(10),
+        headers=dict(headers, **{"Transfer-Encoding": "chunked"})
+        )
+    assert response.status_code == 411
+    assert b"error: content length is none" in response.data
+
+    app.config["MAX_CONTENT_LENGTH"] = 1024
+    response = client.post(
+        "/receive_backup_stream",
+        content_type='application/octet-stream',
+        input_stream=UnreadableStream(1025),
+        headers=headers
+        )
+    assert response.status_code == 413
+    assert b"error: content length is too large" in response.data
+
+
+def test_receive_backup_header_credentials(client, password):
+    """Test that receive_backup checks credentials from headers before the multipart body is read."""
+    response = client.post(
+        "/receive_backup",
+        content_type='multipart/form-data; boundary=x',
+        input_stream=UnreadableStream(10 * 1024 ** 3),
+        headers={"X-Password": "thisiswrongpassword12345"}
+        )
+    assert response.status_code == 401
+    assert b"error: wrong password" in response.data
+
+    # Create folder to save backups in if it do not exist.
+    if not os.path.exists(UPLOAD_FOLDER):
+        os.makedirs(UPLOAD_FOLDER)
+
+    response = client.post(
+        "/receive_backup",
+        content_type='multipart/form-data',
+        headers={"X-Password": password},
+        data={
+            "filename": TESTFILE_NAME,
+            "file": (BytesIO(bytes(TESTFILE_DATA, 'utf-8')), TESTFILE_NAME),
+            "sha256": SHA256
+            }
+        )
+    assert response.status_code == 200
+    assert b"done" in response.data
+
+
 def test_delete_old_backups_empty_folder(app):
     """Test that delete_old_backups correctly handles empty folders.
 
@@ -703,3 +918,61 @@ def test_receive_backup_cleanup(client):
 
     # Verify it's gone
     assert not os.path.exists(UPLOAD_FOLDER)
+
+
+def test_receive_backup_stream_cut_off(app, client, password, folder, upload_stream):
+    """Test that an upload that is cut off do not replace the stored backup with the same name."""
+    data = os.urandom(100000)
+    assert upload_stream(data, "b.tar").status_code == 200
+
+    # The client disconnects after 1000 of the 100000 bytes.
+    response = client.post("/receive_backup_stream", input_stream=BytesIO(data[:1000]), content_length=len(data),
+                           headers={
+        "X-Filename": "b.tar",
+        "X-Password": password,
+        "X-Sha256": hashlib.sha256(data).hexdigest(),
+    })
+    assert response.status_code == 400
+
+    assert sha256_of_file(os.path.join(folder, "b.tar")) == hashlib.sha256(data).hexdigest()
+    assert sorted(os.listdir(folder)) == [".checksums", "b.tar"]
+    backup = backup_index.get_backup(app.config["BACKUP_INDEX"], folder, "b.tar")
+    assert backup["size"] == len(data)
+    assert backup["sha256"] == hashlib.sha256(data).hexdigest()
+
+
+def test_receive_backup_wrong_checksum_not_stored(app, client, password, folder, upload_stream):
+    """Test that an upload with a wrong checksum is not stored or indexed and do not remove older backups."""
+    assert upload_stream(b"backup1", "backup1.tar").status_code == 200
+    assert upload_stream(b"backup2", "backup2.tar").status_code == 200
+
+    response = client.post("/receive_backup_stream", data=b"backup3", headers={
+        "X-Filename": "backup3.tar",
+        "X-Password": password,
+        "X-Sha256": hashlib.sha256(b"other").hexdigest(),
+    })
+    assert response.status_code == 400
+
+    response = client.post("/receive_backup", content_type='multipart/form-data', data={
+        "password": password,
+        "filename": "backup4.tar",
+        "file": (BytesIO(b"backup4"), "backup4.tar"),
+        "sha256": hashlib.sha256(b"other").hexdigest(),
+    })
+    assert b"error: sha256 checksum do not match" in response.data
+
+    assert sorted(os.listdir(folder)) == [".checksums", "backup1.tar", "backup2.tar"]
+    db_path = app.config["BACKUP_INDEX"]
+    assert [backup["name"] for backup in backup_index.list_backups(db_path, folder)] == ["backup1.tar", "backup2.tar"]
+    assert backup_index.latest_backup(db_path, folder)["name"] == "backup2.tar"
+
+
+def test_store_backup_failed_replace_removes_temporary_file(app, folder):
+    """Test that the temporary file is removed when it can not be moved in place."""
+    os.mkdir(os.path.join(folder, "backup.tar"))
+
+    with app.app_context():
+        with pytest.raises(IsADirectoryError):
+            store_backup(BytesIO(b"data"), folder, "backup.tar")
+
+    assert sorted(os.listdir(folder)) == ["backup.tar"]
@@ -0,0 +1,158 @@
+from io import BytesIO
+from unittest.mock import MagicMock, patch
+import hashlib
+import shutil
+import tempfile
+from ddmail_backup_receiver import auth
+from ddmail_backup_receiver.auth import VerifiedCache, verify_password, check_password, check_upload_token
+
+
+def test_verified_cache_add_and_contains():
+    """Test that VerifiedCache remembers added keys and do not store the plaintext password."""
+    cache = VerifiedCache("secret", 4, 60)
+    key = cache.key("hash", "password")
+
+    assert not cache.contains(key)
+    cache.add(key)
+    assert cache.contains(key)
+    assert b"password" not in key
+    assert cache.key("hash", "password") != VerifiedCache("other", 4, 60).key("hash", "password")
+
+
+def test_verified_cache_eviction():
+    """Test that VerifiedCache evicts the least recently used key when it is full."""
+    cache = VerifiedCache("secret", 2, 60)
+    keys = [cache.key("hash", str(i)) for i in range(3)]
+
+    cache.add(keys[0])
+    cache.add(keys[1])
+    # Use keys[0] so keys[1] becomes the least recently used.
+    assert cache.contains(keys[0])
+    cache.add(keys[2])
+
+    assert cache.contains(keys[0])
+    assert not cache.contains(keys[1])
+    assert cache.contains(keys[2])
+
+
+def test_verified_cache_ttl():
+    """Test that VerifiedCache entries expire after ttl seconds."""
+    cache = VerifiedCache("secret", 2, 10)
+    key = cache.key("hash", "password")
+
+    with patch("ddmail_backup_receiver.auth.time.monotonic", return_value=100.0):
+        cache.add(key)
+    with patch("ddmail_backup_receiver.auth.time.monotonic", return_value=105.0):
+        assert cache.contains(key)
+    with patch("ddmail_backup_receiver.auth.time.monotonic", return_value=111.0):
+        assert not cache.contains(key)
+    assert len(cache.entries) == 0
+
+
+def test_verified_cache_disabled():
+    """Test that VerifiedCache with ttl 0 never caches."""
+    cache = VerifiedCache("secret", 2, 0)
+    key = cache.key("hash", "password")
+
+    cache.add(key)
+    assert not cache.contains(key)
+
+
+def test_verify_password_cached(app, password):
+    """Test that verify_password only runs Argon2 once for a repeated correct password."""
+    with app.app_context():
+        hasher = MagicMock(wraps=auth.PASSWORD_HASHER)
+        with patch.object(auth, "PASSWORD_HASHER", hasher):
+            verify = hasher.verify
+            assert verify_password(password)
+            assert verify_password(password)
+            assert verify.call_count == 1
+
+
+def test_verify_password_wrong_password_not_cached(app):
+    """Test that verify_password runs Argon2 for every attempt with a wrong password."""
+    with app.app_context():
+        hasher = MagicMock(wraps=auth.PASSWORD_HASHER)
+        with patch.object(auth, "PASSWORD_HASHER", hasher):
+            verify = hasher.verify
+            assert not verify_password("thisiswrongpassword12345")
+            assert not verify_password("thisiswrongpassword12345")
+            assert verify.call_count == 2
+
+
+def test_check_password(app, password):
+    """Test that check_password returns the expected error messages."""
+    with app.app_context():
+        assert check_password(None) == "password is none"
+        assert check_password("password$password") == "password validation failed"
+        assert check_password("thisiswrongpassword12345") == "wrong password"
+        assert check_password("  " + password + "  ") is None
+
+
+def test_auth_token(client, password):
+    """Test that /auth returns an upload token for the correct password."""
+    response = client.post("/auth", data={"password": password})
+
+    assert response.status_code == 200
+    assert response.get_json()["token"]
+    assert response.get_json()["expires_in"] == 3600
+
+
+def test_auth_token_wrong_password(client):
+    """Test that /auth do not return an upload token for a wrong password."""
+    response = client.post("/auth", data={"password": "thisiswrongpassword12345"})
+
+    assert response.status_code == 200
+    assert b"error: wrong password" in response.data
+
+
+def test_check_upload_token(app, client, password):
+    """Test that check_upload_token accepts valid tokens and refuses tampered and expired tokens."""
+    token = client.post("/auth", data={"password": password}).get_json()["token"]
+
+    with app.app_context():
+        assert check_upload_token(token) is None
+        assert check_upload_token(token[:-2] + "xx") == "wrong token"
+        assert check_upload_token("notatoken") == "wrong token"
+
+        app.config["UPLOAD_TOKEN_TTL"] = -1
+        assert check_upload_token(token) == "token is expired"
+
+
+def test_receive_backup_with_token(app, client, password):
+    """Test that receive_backup accepts an upload token instead of the password."""
+    upload_folder = tempfile.mkdtemp()
+    app.config["UPLOAD_FOLDER"] = upload_folder
+    data = b"backup data"
+    try:
+        token = client.post("/auth", data={"password": password}).get_json()["token"]
+
+        hasher = MagicMock(wraps=auth.PASSWORD_HASHER)
+        with patch.object(auth, "PASSWORD_HASHER", hasher):
+            response = client.post(
+                "/receive_backup",
+                content_type='multipart/form-data',
+                data={
+                    "token": token,
+                    "filename": "backup.bin",
+                    "file": (BytesIO(data), "backup.bin"),
+                    "sha256": hashlib.sha256(data).hexdigest()
+                    }
+                )
+            assert hasher.verify.call_count == 0
+
+        assert b"done" in response.data
+
+        response = client.post(
+            "/receive_backup",
+            content_type='multipart/form-data',
+            data={
+                "token": token + "x",
+                "filename": "backup.bin",
+                "file": (BytesIO(data), "backup.bin"),
+                "sha256": hashlib.sha256(data).hexdigest()
+                }
+            )
+        assert b"error: wrong token" in response.data
+    finally:
+        shutil.rmtree(upload_folder)
@@ -0,0 +1,143 @@
+import os
+import shutil
+import tempfile
+from unittest.mock import MagicMock
+import pytest
+from ddmail_backup_receiver import backup_index
+from ddmail_backup_receiver.application import delete_old_backups
+
+SHA256 = "7b7632005be0f36c5d1663a6c5ec4d13315589d65e1ef8687fb4b9866f9bc4b0"
+
+
+@pytest.fixture
+def folder():
+    """Temporary backup folder."""
+    folder = tempfile.mkdtemp()
+
+    yield folder
+
+    shutil.rmtree(folder)
+
+
+def create_file(folder, name, mtime):
+    """Create a file in folder with the given modification time."""
+    path = os.path.join(folder, name)
+    with open(path, 'w') as f:
+        f.write(name)
+    os.utime(path, (mtime, mtime))
+
+
+def test_add_get_remove_backup(folder):
+    """Test that add_backup, get_backup and remove_backup keep the index in sync."""
+    db_path = os.path.join(folder, ".index.sqlite")
+    create_file(folder, "backup1.tar", 1000)
+
+    backup_index.add_backup(db_path, folder, "backup1.tar", SHA256)
+    assert backup_index.get_backup(db_path, folder, "backup1.tar") == {
+        "name": "backup1.tar", "size": 11, "mtime": 1000, "sha256": SHA256
+    }
+
+    backup_index.remove_backup(db_path, folder, "backup1.tar")
+    assert backup_index.get_backup(db_path, folder, "backup1.tar") is None
+
+
+def test_rebuild_folder(folder):
+    """Test that rebuild_folder adds new files, removes gone files and keeps known checksums."""
+    db_path = os.path.join(folder, ".index.sqlite")
+    create_file(folder, "kept.tar", 1000)
+    create_file(folder, "changed.tar", 1000)
+    create_file(folder, "removed.tar", 1000)
+    for name in ["kept.tar", "changed.tar", "removed.tar"]:
+        backup_index.add_backup(db_path, folder, name, SHA256)
+
+    os.remove(os.path.join(folder, "removed.tar"))
+    create_file(folder, "changed.tar", 2000)
+    create_file(folder, "new.tar", 3000)
+    backup_index.rebuild_folder(db_path, folder)
+
+    assert backup_index.get_backup(db_path, folder, "kept.tar")["sha256"] == SHA256
+    assert backup_index.get_backup(db_path, folder, "changed.tar")["sha256"] is None
+    assert backup_index.get_backup(db_path, folder, "changed.tar")["mtime"] == 2000
+    assert backup_index.get_backup(db_path, folder, "new.tar")["sha256"] is None
+    assert backup_index.get_backup(db_path, folder, "removed.tar") is None
+    # Hidden files such as the index itself is not backups.
+    assert backup_index.get_backup(db_path, folder, ".index.sqlite") is None
+
+
+def test_sidecar(folder):
+    """Test that a checksum sidecar is saved with a backup and used when the index is lost."""
+    db_path = os.path.join(folder, ".index.sqlite")
+    create_file(folder, "backup1.tar", 1000)
+    create_file(folder, "backup2.tar", 1000)
+    backup_index.add_backup(db_path, folder, "backup1.tar", SHA256)
+    backup_index.add_backup(db_path, folder, "backup2.tar", "sha256-tree:" + SHA256)
+
+    with open(backup_index.sidecar_path(folder, "backup1.tar")) as f:
+        assert f.read() == SHA256 + "  backup1.tar\n"
+    assert backup_index.read_sidecar(folder, "backup2.tar") == "sha256-tree:" + SHA256
+
+    os.remove(db_path)
+    create_file(folder, "backup2.tar", 2000)
+    backup_index.rebuild_folder(db_path, folder)
+    assert backup_index.get_backup(db_path, folder, "backup1.tar")["sha256"] == SHA256
+    # The sidecar belongs to the file before it was changed.
+    assert backup_index.get_backup(db_path, folder, "backup2.tar")["sha256"] is None
+
+    os.remove(os.path.join(folder, "backup2.tar"))
+    backup_index.rebuild_folder(db_path, folder)
+    backup_index.remove_backup(db_path, folder, "backup1.tar")
+    assert os.listdir(backup_index.sidecar_folder(folder)) == []
+
+
+def test_backups_to_remove(folder):
+    """Test that backups_to_remove returns the backups older then the newest backups_to_save."""
+    db_path = os.path.join(folder, ".index.sqlite")
+    for i in range(5):
+        create_file(folder, "backup" + str(i) + ".tar", 1000 + i)
+    backup_index.rebuild_folder(db_path, folder)
+
+    assert backup_index.backups_to_remove(db_path, folder, 3) == ["backup1.tar", "backup0.tar"]
+    assert backup_index.backups_to_remove(db_path, folder, 5) == []
+
+
+def test_delete_old_backups_uses_index(app, folder):
+    """Test that delete_old_backups removes files and index rows without scanning the folder again.
+
+    After the first call has indexed the folder a file created outside the application
+    is not seen until the index is rebuilt, which shows that the folder is not scanned.
+    """
+    for i in range(4):
+        create_file(folder, "backup" + str(i) + ".tar", 1000 + i)
+
+    with app.app_context():
+        app.logger = MagicMock()
+        db_path = app.config["BACKUP_INDEX"]
+
+        delete_old_backups(folder, 3)
+        assert sorted(os.listdir(folder)) == ["backup1.tar", "backup2.tar", "backup3.tar"]
+        assert backup_index.get_backup(db_path, folder, "backup0.tar") is None
+
+        create_file(folder, "outside.tar", 500)
+        delete_old_backups(folder, 3)
+        assert os.path.exists(os.path.join(folder, "outside.tar"))
+
+
+def test_receive_backup_adds_to_index(app, client, password, folder):
+    """Test that receive_backup adds the stored backup with its checksum to the index."""
+    app.config["UPLOAD_FOLDER"] = folder
+
+    response = client.post(
+        "/receive_backup",
+        content_type='multipart/form-data',
+        data={
+            "password": password,
+            "filename": "test_file.txt",
+            "file": (open("tests/test_file.txt", 'rb'), "test_file.txt"),
+            "sha256": SHA256
+            }
+        )
+    assert b"done" in response.data
+
+    backup = backup_index.get_backup(app.config["BACKUP_INDEX"], folder, "test_file.txt")
+    assert backup["sha256"] == SHA256
+    assert backup["size"] == os.path.getsize(os.path.join(folder, "test_file.txt"))
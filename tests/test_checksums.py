@@ -0,0 +1,134 @@
+import hashlib
+import os
+import random
+import tempfile
+import pytest
+from ddmail_backup_receiver import backup_index
+from ddmail_backup_receiver import checksums
+from ddmail_backup_receiver.checksums import LEAF_SIZE, TreeSha256
+
+
+def reference_tree_sha256(data: bytes) -> str:
+    """Calculate sha256-tree as a client would, one leaf at a time."""
+    leaves = [hashlib.sha256(b"\x00" + data[i:i + LEAF_SIZE]).digest()
+              for i in range(0, max(len(data), 1), LEAF_SIZE)]
+    while len(leaves) > 1:
+        pairs = [hashlib.sha256(b"\x01" + leaves[i] + leaves[i + 1]).digest() for i in range(0, len(leaves) - 1, 2)]
+        leaves = pairs + leaves[len(pairs) * 2:]
+    return leaves[0].hex()
+
+
+@pytest.mark.parametrize("size", [0, 1, LEAF_SIZE, LEAF_SIZE + 1, 5 * LEAF_SIZE + 17])
+@pytest.mark.parametrize("threads", [1, 4])
+def test_tree_sha256(size, threads):
+    """Test that sha256-tree is the same with any thread count and update sizes."""
+    data = random.Random(size).randbytes(size)
+    expected = reference_tree_sha256(data)
+
+    hasher = TreeSha256(threads)
+    hasher.update(data)
+    assert hasher.hexdigest() == expected
+
+    hasher = TreeSha256(threads)
+    pos = 0
+    rng = random.Random(1)
+    while pos < size:
+        n = rng.choice([1, 1000, 65536, LEAF_SIZE, LEAF_SIZE + 3])
+        hasher.update(bytearray(data[pos:pos + n]))
+        pos += n
+    assert hasher.hexdigest() == expected
+    assert hasher.hexdigest() == expected
+
+
+def test_new_hasher():
+    """Test the available algorithms and that an unknown algorithm is refused."""
+    assert checksums.available_algorithms()[0] == "sha256"
+    assert checksums.new_hasher("sha256").name == "sha256"
+    with pytest.raises(ValueError):
+        checksums.new_hasher("md5")
+
+
+def test_blake3():
+    """Test that blake3 is used with several threads when it is installed."""
+    blake3 = pytest.importorskip("blake3")
+    data = random.Random(1).randbytes(3 * LEAF_SIZE)
+    hasher = checksums.new_hasher("blake3", 4)
+    hasher.update(data)
+    assert hasher.hexdigest() == blake3.blake3(data).hexdigest()
+    assert "blake3" in checksums.available_algorithms()
+
+
+def test_index_checksum():
+    """Test that sha256 is stored as before and other algorithms with a prefix."""
+    assert checksums.index_checksum("sha256", "ab") == "ab"
+    assert checksums.index_checksum("sha256-tree", "ab") == "sha256-tree:ab"
+    assert checksums.split_checksum("ab") == ("sha256", "ab")
+    assert checksums.split_checksum("sha256-tree:ab") == ("sha256-tree", "ab")
+    assert checksums.split_checksum(None) == (None, None)
+
+
+@pytest.mark.parametrize("storage_mode", ["plain", "dedup"])
+def test_upload_with_tree_sha256(app, client, password, folder, storage_mode):
+    """Test uploads with sha256-tree to both upload endpoints."""
+    app.config["STORAGE_MODE"] = storage_mode
+    data = random.Random(1).randbytes(3 * LEAF_SIZE + 5)
+    checksum = reference_tree_sha256(data)
+
+    response = client.post("/receive_backup_stream", data=data, headers={
+        "X-Filename": "backup1.tar",
+        "X-Password": password,
+        "X-Sha256": checksum,
+        "X-Checksum-Algorithm": "sha256-tree",
+    })
+    assert response.status_code == 200
+
+    response = client.post("/receive_backup", data={
+        "file": (tempfile.SpooledTemporaryFile(), "backup2.tar"),
+        "filename": "backup2.tar",
+        "password": password,
+        "sha256": reference_tree_sha256(b""),
+        "checksum_algorithm": "sha256-tree",
+    }, content_type="multipart/form-data")
+    assert response.data == b"done"
+
+    name = "backup1.tar.manifest" if storage_mode == "dedup" else "backup1.tar"
+    backup = backup_index.get_backup(app.config["BACKUP_INDEX"], folder, name)
+    assert backup["sha256"] == "sha256-tree:" + checksum
+
+    response = client.post("/receive_backup_stream", data=data, headers={
+        "X-Filename": "backup3.tar",
+        "X-Password": password,
+        "X-Sha256": hashlib.sha256(data).hexdigest(),
+        "X-Checksum-Algorithm": "sha256-tree",
+    })
+    assert response.status_code == 400
+    assert b"error: sha256 checksum do not match" in response.data
+
+
+def test_upload_unsupported_algorithm(client, password, folder):
+    """Test that an unknown algorithm is refused before the body is read."""
+    response = client.post("/receive_backup_stream", data=b"data", headers={
+        "X-Filename": "backup.tar",
+        "X-Password": password,
+        "X-Sha256": hashlib.sha256(b"data").hexdigest(),
+        "X-Checksum-Algorithm": "md5",
+    })
+    assert response.status_code == 400
+    assert b"error: checksum algorithm is not supported" in response.data
+    assert not os.path.exists(os.path.join(folder, "backup.tar"))
+
+    response = client.post("/receive_backup", data={
+        "file": (tempfile.SpooledTemporaryFile(), "backup.tar"),
+        "filename": "backup.tar",
+        "password": password,
+        "sha256": hashlib.sha256(b"").hexdigest(),
+        "checksum_algorithm": "md5",
+    }, content_type="multipart/form-data")
+    assert response.data == b"error: checksum algorithm is not supported"
+
+
+def test_checksum_algorithms(client):
+    """Test that the available algorithms can be listed before an upload."""
+    response = client.get("/checksum_algorithms")
+    assert response.get_json()["default"] == "sha256"
+    assert response.get_json()["algorithms"] == checksums.available_algorithms()
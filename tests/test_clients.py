@@ -0,0 +1,115 @@
+from io import BytesIO
+import hashlib
+import os
+import shutil
+import tempfile
+import pytest
+from argon2 import PasswordHasher
+from ddmail_backup_receiver.clients import get_client, client_upload_folder
+
+# Password of the client used in the tests.
+CLIENT_PASSWORD = "clientpassword1234567890"
+
+
+@pytest.fixture
+def upload_folder(app):
+    """Temporary upload folder with the client mail1 configured."""
+    folder = tempfile.mkdtemp()
+    app.config["UPLOAD_FOLDER"] = folder
+    app.config["CLIENTS"] = {
+        "mail1": {"PASSWORD_HASH": PasswordHasher().hash(CLIENT_PASSWORD), "BACKUPS_TO_SAVE": 1},
+    }
+
+    yield folder
+
+    shutil.rmtree(folder)
+
+
+def upload(test_client, data, filename, **fields):
+    """Upload data with receive_backup and return the response."""
+    form = {
+        "filename": filename,
+        "file": (BytesIO(data), filename),
+        "sha256": hashlib.sha256(data).hexdigest(),
+    }
+    form.update(fields)
+    return test_client.post("/receive_backup", content_type='multipart/form-data', data=form)
+
+
+def test_get_client_default(app, upload_folder):
+    """Test that get_client without client id returns the top level settings."""
+    with app.app_context():
+        client, error = get_client(None)
+
+    assert error is None
+    assert client["id"] is None
+    assert client["upload_folder"] == upload_folder
+    assert client["password_hash"] == app.config["PASSWORD_HASH"]
+    assert client["backups_to_save"] == app.config["BACKUPS_TO_SAVE"]
+
+
+def test_get_client(app, upload_folder):
+    """Test that get_client returns the settings of a configured client and creates its folder."""
+    with app.app_context():
+        client, error = get_client(" mail1 ")
+
+    assert error is None
+    assert client["id"] == "mail1"
+    assert client["upload_folder"] == os.path.join(upload_folder, ".clients", "mail1")
+    assert client["backups_to_save"] == 1
+    assert os.path.isdir(client["upload_folder"])
+
+
+def test_get_client_errors(app, upload_folder):
+    """Test that get_client refuses invalid and unknown client ids."""
+    with app.app_context():
+        assert get_client("../mail1") == (None, "client validation failed")
+        assert get_client("mail2") == (None, "client do not exist")
+
+
+def test_receive_backup_client_namespace(client, password, upload_folder):
+    """Test that backups of a client is stored and pruned in the client folder only.
+
+    The client keeps 1 backup. Uploading two backups for the client removes the
+    first one, while a backup uploaded without client is not touched.
+    """
+    response = upload(client, b"default backup", "default.tar", password=password)
+    assert b"done" in response.data
+
+    for i in range(2):
+        response = upload(client, b"mail1 backup " + bytes([i]), "mail1_" + str(i) + ".tar",
+                          client="mail1", password=CLIENT_PASSWORD)
+        assert b"done" in response.data
+
+    assert sorted(os.listdir(os.path.join(upload_folder, ".clients", "mail1"))) == [".checksums", "mail1_1.tar"]
+    assert os.listdir(os.path.join(upload_folder, ".clients", "mail1", ".checksums")) == ["mail1_1.tar"]
+    assert os.path.exists(os.path.join(upload_folder, "default.tar"))
+
+
+def test_receive_backup_client_wrong_password(client, password, upload_folder):
+    """Test that a client can not upload with the password of another client."""
+    response = upload(client, b"backup", "backup.tar", client="mail1", password=password)
+    assert b"error: wrong password" in response.data
+
+
+def test_upload_token_client(client, password, upload_folder):
+    """Test that an upload token is only valid for the client it was created for."""
+    token = client.post("/auth", data={"client": "mail1", "password": CLIENT_PASSWORD}).get_json()["token"]
+
+    response = upload(client, b"backup", "backup.tar", client="mail1", token=token)
+    assert b"done" in response.data
+
+    response = upload(client, b"backup", "backup.tar", token=token)
+    assert b"error: wrong token" in response.data
+
+
+def test_client_folder_do_not_collide_with_backups(client, password, upload_folder):
+    """Test that the default client can store a backup named like a client and the client still works."""
+    response = upload(client, b"default backup", "mail1", password=password)
+    assert b"done" in response.data
+
+    response = upload(client, b"mail1 backup", "backup.tar", client="mail1", password=CLIENT_PASSWORD)
+    assert b"done" in response.data
+
+    assert os.path.isfile(os.path.join(upload_folder, "mail1"))
+    assert os.path.isfile(os.path.join(client_upload_folder(upload_folder, "mail1"), "backup.tar"))
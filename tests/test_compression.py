@@ -0,0 +1,77 @@
+from io import BytesIO
+import hashlib
+import os
+import pytest
+from ddmail_backup_receiver import backup_index
+from ddmail_backup_receiver import compression
+
+zstandard = pytest.importorskip("zstandard")
+
+# Compressible test data, like a log file.
+DATA = b"".join(b"2026-10-18 12:00:" + str(i).encode() + b" postfix/smtpd: connect from mail.example.com\n"
+                for i in range(20000))
+
+
+def test_save_zstd_and_sha256(folder):
+    """Test that the checksum is taken over the uncompressed data and the file can be decompressed."""
+    full_path = os.path.join(folder, "backup.tar.zst")
+
+    sha256 = compression.save_zstd_and_sha256(BytesIO(DATA), full_path, 3, 2, 65536)
+
+    assert sha256 == hashlib.sha256(DATA).hexdigest()
+    assert os.path.getsize(full_path) < len(DATA) / 10
+    with compression.open_backup(full_path) as f:
+        assert f.read() == DATA
+
+
+def test_open_backup_plain(folder):
+    """Test that open_backup reads uncompressed backups as they are."""
+    full_path = os.path.join(folder, "backup.tar")
+    with open(full_path, 'wb') as f:
+        f.write(DATA)
+
+    with compression.open_backup(full_path) as f:
+        assert f.read() == DATA
+
+
+def test_receive_backup_stream_zstd(app, client, password, folder):
+    """Test that receive_backup_stream with COMPRESSION zstd stores a .zst file and retention prunes it."""
+    app.config["COMPRESSION"] = "zstd"
+    app.config["BACKUPS_TO_SAVE"] = 1
+
+    for i in range(2):
+        data = DATA + bytes([i])
+        response = client.post(
+            "/receive_backup_stream",
+            data=data,
+            headers={
+                "X-Filename": "backup" + str(i) + ".tar",
+                "X-Password": password,
+                "X-Sha256": hashlib.sha256(data).hexdigest(),
+            },
+        )
+        assert response.status_code == 200
+
+    assert sorted(os.listdir(folder)) == [".checksums", "backup1.tar.zst"]
+    with compression.open_backup(os.path.join(folder, "backup1.tar.zst")) as f:
+        assert f.read() == data
+
+    backup = backup_index.get_backup(app.config["BACKUP_INDEX"], folder, "backup1.tar.zst")
+    assert backup["sha256"] == hashlib.sha256(data).hexdigest()
+
+
+def test_receive_backup_stream_zstd_checksum_mismatch(app, client, password, folder):
+    """Test that a wrong checksum is detected against the uncompressed data."""
+    app.config["COMPRESSION"] = "zstd"
+
+    response = client.post(
+        "/receive_backup_stream",
+        data=DATA,
+        headers={
+            "X-Filename": "backup.tar",
+            "X-Password": password,
+            "X-Sha256": hashlib.sha256(DATA + b"x").hexdigest(),
+        },
+    )
+    assert response.status_code == 400
+    assert b"error: sha256 checksum do not match" in response.data
@@ -0,0 +1,185 @@
+from collections import Counter
+from io import BytesIO
+import hashlib
+import os
+import random
+import threading
+from ddmail_backup_receiver import backup_index
+from ddmail_backup_receiver import dedup
+
+
+def random_data(size, seed=0):
+    """Return size bytes of reproducible random data."""
+    return random.Random(seed).randbytes(size)
+
+
+def stored_chunks(store):
+    """Return the digests of the chunks in store."""
+    return sorted(
+        name for _, _, files in os.walk(store) for name in files
+        if name not in ("lock", "manifests.lock") and not name.startswith(".")
+    )
+
+
+def refcounts(db_path):
+    """Return the reference count of every chunk in the index."""
+    conn = backup_index.connect(db_path)
+    try:
+        return dict(conn.execute("SELECT digest, refcount FROM chunks").fetchall())
+    finally:
+        conn.close()
+
+
+def test_iter_chunks_sizes():
+    """Test that chunks keep the size limits and joined give back the stream."""
+    data = random_data(20 * 1024 * 1024)
+    chunks = list(dedup.iter_chunks(BytesIO(data), 65536))
+
+    assert b"".join(chunks) == data
+    assert len(chunks) > 4
+    for chunk in chunks[:-1]:
+        assert dedup.MIN_CHUNK_SIZE <= len(chunk) <= dedup.MAX_CHUNK_SIZE
+
+    assert list(dedup.iter_chunks(BytesIO(b"small"))) == [b"small"]
+    assert list(dedup.iter_chunks(BytesIO(b""))) == []
+
+
+def test_iter_chunks_insert():
+    """Test that data inserted in the stream only changes the chunks around the insert."""
+    data = random_data(20 * 1024 * 1024)
+    changed = data[:5000000] + b"inserted" + data[5000000:]
+
+    chunks = set(dedup.iter_chunks(BytesIO(data)))
+    changed_chunks = list(dedup.iter_chunks(BytesIO(changed)))
+
+    new = [chunk for chunk in changed_chunks if chunk not in chunks]
+    assert len(new) <= 2
+    assert len(changed_chunks) - len(new) >= len(chunks) - 3
+
+
+def test_save_dedup(folder):
+    """Test that save_dedup stores shared chunks once and iter_backup gives back the data."""
+    store = dedup.chunk_store_folder(folder)
+    db_path = os.path.join(folder, ".index.sqlite")
+    data = random_data(8 * 1024 * 1024)
+
+    sha256 = dedup.save_dedup(BytesIO(data), store, db_path, os.path.join(folder, "a.manifest"))
+    assert sha256 == hashlib.sha256(data).hexdigest()
+    chunks = stored_chunks(store)
+
+    dedup.save_dedup(BytesIO(data), store, db_path, os.path.join(folder, "b.manifest"))
+    assert stored_chunks(store) == chunks
+    assert set(refcounts(db_path).values()) == {2}
+
+    assert b"".join(dedup.iter_backup(store, os.path.join(folder, "b.manifest"))) == data
+    manifest = dedup.read_manifest(os.path.join(folder, "b.manifest"))
+    assert manifest["size"] == len(data)
+    assert manifest["sha256"] == sha256
+
+
+def test_remove_manifest(folder):
+    """Test that remove_manifest only removes chunks that no other manifest use."""
+    store = dedup.chunk_store_folder(folder)
+    db_path = os.path.join(folder, ".index.sqlite")
+    data = random_data(8 * 1024 * 1024)
+
+    dedup.save_dedup(BytesIO(data), store, db_path, os.path.join(folder, "a.manifest"))
+    dedup.save_dedup(BytesIO(data + b"more"), store, db_path, os.path.join(folder, "b.manifest"))
+    chunks_b = set(chunk[0] for chunk in dedup.read_manifest(os.path.join(folder, "b.manifest"))["chunks"])
+
+    assert dedup.remove_manifest(store, db_path, os.path.join(folder, "a.manifest")) == 1
+    assert not os.path.exists(os.path.join(folder, "a.manifest"))
+    assert set(stored_chunks(store)) == chunks_b
+    assert set(refcounts(db_path)) == chunks_b
+
+    dedup.remove_manifest(store, db_path, os.path.join(folder, "b.manifest"))
+    assert stored_chunks(store) == []
+    assert refcounts(db_path) == {}
+
+
+def test_save_dedup_replace(folder):
+    """Test that replacing a manifest releases the chunks of the old manifest."""
+    store = dedup.chunk_store_folder(folder)
+    db_path = os.path.join(folder, ".index.sqlite")
+    manifest_path = os.path.join(folder, "a.manifest")
+
+    for i in range(2):
+        new_path = os.path.join(folder, ".tmp-" + str(i))
+        dedup.save_dedup(BytesIO(random_data(1024 * 1024, i + 1)), store, db_path, new_path)
+        dedup.replace_manifest(store, db_path, new_path, manifest_path)
+
+    chunks = [chunk[0] for chunk in dedup.read_manifest(manifest_path)["chunks"]]
+    assert stored_chunks(store) == sorted(chunks)
+    assert refcounts(db_path) == {digest: 1 for digest in chunks}
+
+
+def test_receive_backup_dedup(app, client, password, folder):
+    """Test that receive_backup in dedup mode stores manifests and retention removes unused chunks."""
+    app.config["STORAGE_MODE"] = "dedup"
+    app.config["BACKUPS_TO_SAVE"] = 1
+    store = dedup.chunk_store_folder(folder)
+
+    for i in range(2):
+        data = random_data(2 * 1024 * 1024, i)
+        response = client.post(
+            "/receive_backup",
+            content_type='multipart/form-data',
+            data={
+                "password": password,
+                "filename": "backup" + str(i) + ".tar",
+                "file": (BytesIO(data), "backup" + str(i) + ".tar"),
+                "sha256": hashlib.sha256(data).hexdigest()
+                }
+            )
+        assert b"done" in response.data
+
+    assert sorted(os.listdir(folder)) == [".checksums", ".chunks", "backup1.tar.manifest"]
+    manifest_path = os.path.join(folder, "backup1.tar.manifest")
+    assert b"".join(dedup.iter_backup(store, manifest_path)) == data
+    assert stored_chunks(store) == sorted(chunk[0] for chunk in dedup.read_manifest(manifest_path)["chunks"])
+
+    backup = backup_index.get_backup(app.config["BACKUP_INDEX"], folder, "backup1.tar.manifest")
+    assert backup["sha256"] == hashlib.sha256(data).hexdigest()
+
+
+def test_replace_manifest_concurrent(folder, monkeypatch):
+    """Test that uploads of the same name at the same time release the chunks of the old manifest once."""
+    store = dedup.chunk_store_folder(folder)
+    db_path = os.path.join(folder, ".index.sqlite")
+    manifest_path = os.path.join(folder, "a.manifest")
+    shared = random_data(2 * 1024 * 1024, 1)
+    dedup.save_dedup(BytesIO(shared), store, db_path, os.path.join(folder, "b.manifest"))
+    dedup.save_dedup(BytesIO(shared + random_data(1024 * 1024, 2)), store, db_path, os.path.join(folder, ".tmp"))
+    dedup.replace_manifest(store, db_path, os.path.join(folder, ".tmp"), manifest_path)
+
+    # Both uploads read the old manifest before either replace it, unless the first holds a lock.
+    barrier = threading.Barrier(2, timeout=0.5)
+    read_manifest = dedup.read_manifest
+
+    def read_manifest_and_wait(path):
+        manifest = read_manifest(path)
+        if path == manifest_path:
+            try:
+                barrier.wait()
+            except threading.BrokenBarrierError:
+                pass
+        return manifest
+
+    monkeypatch.setattr(dedup, "read_manifest", read_manifest_and_wait)
+
+    new_paths = []
+    for i in range(2):
+        new_paths.append(os.path.join(folder, ".tmp-" + str(i)))
+        dedup.save_dedup(BytesIO(shared + random_data(1024 * 1024, i + 3)), store, db_path, new_paths[i])
+    threads = [threading.Thread(target=dedup.replace_manifest, args=(store, db_path, path, manifest_path))
+               for path in new_paths]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    expected = Counter()
+    for name in ("a.manifest", "b.manifest"):
+        expected.update(chunk[0] for chunk in read_manifest(os.path.join(folder, name))["chunks"])
+    assert refcounts(db_path) == dict(expected)
+    assert stored_chunks(store) == sorted(expected)
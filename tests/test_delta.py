@@ -0,0 +1,171 @@
+from io import BytesIO
+import hashlib
+import os
+import random
+import tempfile
+import zlib
+import pytest
+from ddmail_backup_receiver import backup_index
+from ddmail_backup_receiver import delta
+from ddmail_backup_receiver.delta import DeltaError, DeltaReader, OP_COPY, OP_LITERAL, COPY_HEADER, LITERAL_HEADER
+
+
+def make_delta(signatures, data):
+    """Create a delta of data against the signatures from /delta/signatures, as a client does."""
+    block_size = signatures["block_size"]
+    blocks = {}
+    for i, (weak, strong) in enumerate(signatures["signatures"]):
+        blocks.setdefault(weak, {}).setdefault(strong, i)
+
+    out = []
+    literal = bytearray()
+    pos = 0
+    while pos < len(data):
+        window = data[pos:pos + block_size]
+        matches = blocks.get(zlib.adler32(window))
+        if matches is not None and len(window) == block_size:
+            i = matches.get(hashlib.blake2b(window, digest_size=16).hexdigest())
+            if i is not None:
+                if literal:
+                    out.append(OP_LITERAL + LITERAL_HEADER.pack(len(literal)) + bytes(literal))
+                    literal = bytearray()
+                out.append(OP_COPY + COPY_HEADER.pack(i * block_size, block_size))
+                pos += block_size
+                continue
+        literal.append(data[pos])
+        pos += 1
+    if literal:
+        out.append(OP_LITERAL + LITERAL_HEADER.pack(len(literal)) + bytes(literal))
+    return b"".join(out)
+
+
+def upload_delta(test_client, password, body, data, filename, basis):
+    """Upload a delta of data against basis with /delta/upload."""
+    return test_client.post("/delta/upload", data=body, headers={
+        "X-Filename": filename,
+        "X-Password": password,
+        "X-Sha256": hashlib.sha256(data).hexdigest(),
+        "X-Basis": basis,
+    })
+
+
+def test_delta_reader():
+    """Test that DeltaReader rebuilds a file from copy and literal instructions."""
+    basis = tempfile.TemporaryFile()
+    basis.write(b"0123456789")
+    basis.flush()
+    body = (OP_COPY + COPY_HEADER.pack(5, 5) + OP_LITERAL + LITERAL_HEADER.pack(3) + b"abc"
+            + OP_COPY + COPY_HEADER.pack(0, 2))
+
+    assert DeltaReader(BytesIO(body), basis).read() == b"56789abc01"
+    reader = DeltaReader(BytesIO(body), basis)
+    assert [reader.read(4) for _ in range(4)] == [b"5678", b"9abc", b"01", b""]
+
+    with pytest.raises(DeltaError):
+        DeltaReader(BytesIO(OP_COPY + COPY_HEADER.pack(8, 5)), basis).read()
+    with pytest.raises(DeltaError):
+        DeltaReader(BytesIO(OP_LITERAL + LITERAL_HEADER.pack(5) + b"ab"), basis).read()
+    with pytest.raises(DeltaError):
+        DeltaReader(BytesIO(b"X"), basis).read()
+
+
+def test_default_block_size():
+    """Test that the default block size is about the square root of the size within the limits."""
+    assert delta.default_block_size(0) == delta.MIN_BLOCK_SIZE
+    assert delta.default_block_size(1024 ** 3) == 32768
+    assert delta.default_block_size(1024 ** 5) == delta.MAX_BLOCK_SIZE
+
+
+@pytest.mark.parametrize("storage_mode, compression", [("plain", "none"), ("plain", "zstd"), ("dedup", "none")])
+def test_delta_upload(app, client, password, folder, storage_mode, compression, upload_stream):
+    """Test a delta upload against the newest backup, stored plain, compressed or deduplicated."""
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    app.config["STORAGE_MODE"] = storage_mode
+    app.config["COMPRESSION"] = compression
+
+    rng = random.Random(1)
+    old = rng.randbytes(300000)
+    new = old[:100000] + b"changed" + old[100000:250000] + rng.randbytes(1000)
+    assert upload_stream(old, "backup1.tar").status_code == 200
+
+    signatures = client.post("/delta/signatures", data={"password": password, "block_size": "4096"}).get_json()
+    assert signatures["size"] == len(old)
+    assert signatures["sha256"] == hashlib.sha256(old).hexdigest()
+    assert len(signatures["signatures"]) == 74
+
+    body = make_delta(signatures, new)
+    assert len(body) < len(new) / 10
+
+    response = upload_delta(client, password, body, new, "backup2.tar", signatures["name"])
+    assert response.status_code == 200
+
+    signatures = client.post("/delta/signatures", data={"password": password}).get_json()
+    assert signatures["name"].startswith("backup2.tar")
+    assert signatures["sha256"] == hashlib.sha256(new).hexdigest()
+
+
+def test_delta_upload_same_name(client, password, folder, upload_stream):
+    """Test that a delta upload can replace the plain file it was created against."""
+    old = random.Random(1).randbytes(100000)
+    new = old + b"appended"
+    assert upload_stream(old, "backup.tar").status_code == 200
+
+    signatures = client.post("/delta/signatures", data={"password": password}).get_json()
+    response = upload_delta(client, password, make_delta(signatures, new), new, "backup.tar", "backup.tar")
+    assert response.status_code == 200
+
+    with open(os.path.join(folder, "backup.tar"), 'rb') as f:
+        assert f.read() == new
+
+
+@pytest.mark.parametrize("storage_mode", ["plain", "dedup"])
+def test_invalid_delta_keeps_backup(app, client, password, folder, storage_mode, upload_stream):
+    """Test that an invalid delta with the name of a stored backup do not remove or change it."""
+    app.config["STORAGE_MODE"] = storage_mode
+    old = random.Random(1).randbytes(100000)
+    assert upload_stream(old, "backup.tar").status_code == 200
+    signatures = client.post("/delta/signatures", data={"password": password}).get_json()
+
+    body = OP_COPY + COPY_HEADER.pack(0, 1000) + OP_COPY + COPY_HEADER.pack(0, 100001)
+    response = upload_delta(client, password, body, old, "backup.tar", signatures["name"])
+    assert response.status_code == 400
+    assert b"error: delta copy is outside of basis" in response.data
+
+    signatures = client.post("/delta/signatures", data={"password": password}).get_json()
+    assert signatures["size"] == len(old)
+    assert signatures["sha256"] == hashlib.sha256(old).hexdigest()
+    assert not [name for name in os.listdir(folder) if name.startswith(".tmp-")]
+
+
+def test_delta_upload_errors(app, client, password, folder, upload_stream):
+    """Test that a wrong checksum, an invalid delta and a missing basis is refused."""
+    old = random.Random(1).randbytes(100000)
+    assert upload_stream(old, "backup1.tar").status_code == 200
+    body = OP_COPY + COPY_HEADER.pack(0, 100000)
+
+    response = upload_delta(client, password, body, old + b"x", "backup2.tar", "backup1.tar")
+    assert response.status_code == 400
+    assert b"error: sha256 checksum do not match" in response.data
+    assert not os.path.exists(os.path.join(folder, "backup2.tar"))
+    assert backup_index.get_backup(app.config["BACKUP_INDEX"], folder, "backup2.tar") is None
+
+    response = upload_delta(client, password, OP_COPY + COPY_HEADER.pack(0, 100001), old, "backup3.tar", "backup1.tar")
+    assert response.status_code == 400
+    assert b"error: delta copy is outside of basis" in response.data
+    assert not os.path.exists(os.path.join(folder, "backup3.tar"))
+
+    response = upload_delta(client, password, body, old, "backup4.tar", "backup0.tar")
+    assert response.status_code == 409
+
+    response = upload_delta(client, "wrong" + password[5:], body, old, "backup4.tar", "backup1.tar")
+    assert response.status_code == 401
+
+
+def test_signatures_errors(client, password, folder):
+    """Test that signatures refuses an invalid block size and an empty upload folder."""
+    response = client.post("/delta/signatures", data={"password": password})
+    assert b"error: no backup to create a delta against" in response.data
+
+    response = client.post("/delta/signatures", data={"password": password, "block_size": "1"})
+    assert b"error: block_size validation failed" in response.data
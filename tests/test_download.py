@@ -0,0 +1,117 @@
+import hashlib
+import random
+from io import BytesIO
+from unittest.mock import MagicMock
+import pytest
+from werkzeug.wrappers import Response
+from ddmail_backup_receiver.download import DownloadResponse, GunicornFileWrapper
+
+
+@pytest.mark.parametrize("storage_mode, compression", [("plain", "none"), ("plain", "zstd"), ("dedup", "none")])
+def test_download(app, client, password, folder, storage_mode, compression, upload_stream):
+    """Test that a download returns the uploaded data with the sha256 checksum as ETag."""
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    app.config["STORAGE_MODE"] = storage_mode
+    app.config["COMPRESSION"] = compression
+
+    data = random.Random(1).randbytes(300000)
+    assert upload_stream(data, "backup.tar").status_code == 200
+
+    response = client.get("/download/backup.tar", headers={"X-Password": password})
+    assert response.status_code == 200
+    assert response.data == data
+    assert response.headers["ETag"] == '"' + hashlib.sha256(data).hexdigest() + '"'
+    assert "backup.tar" in response.headers["Content-Disposition"]
+
+    response = client.get("/download/backup.tar", headers={
+        "X-Password": password,
+        "If-None-Match": response.headers["ETag"],
+    })
+    assert response.status_code == 304
+    assert response.data == b""
+
+
+def test_download_range(client, password, folder, upload_stream):
+    """Test that a plain backup can be downloaded from an offset to resume a restore."""
+    data = random.Random(1).randbytes(100000)
+    assert upload_stream(data, "backup.tar").status_code == 200
+    etag = '"' + hashlib.sha256(data).hexdigest() + '"'
+
+    response = client.get("/download/backup.tar", headers={"X-Password": password, "Range": "bytes=60000-"})
+    assert response.status_code == 206
+    assert response.data == data[60000:]
+    assert response.headers["Content-Range"] == "bytes 60000-99999/100000"
+
+    response = client.get("/download/backup.tar", headers={
+        "X-Password": password,
+        "Range": "bytes=10-19",
+        "If-Range": etag,
+    })
+    assert response.status_code == 206
+    assert response.data == data[10:20]
+
+    # The whole file is sent if it has changed since the first part was downloaded.
+    response = client.get("/download/backup.tar", headers={
+        "X-Password": password,
+        "Range": "bytes=10-19",
+        "If-Range": '"' + "0" * 64 + '"',
+    })
+    assert response.status_code == 200
+    assert response.data == data
+
+    response = client.get("/download/backup.tar", headers={"X-Password": password, "Range": "bytes=200000-"})
+    assert response.status_code == 416
+
+
+def test_download_errors(client, password, folder, upload_stream):
+    """Test that a wrong password, an invalid filename and a missing backup is refused."""
+    assert upload_stream(b"data", "backup.tar").status_code == 200
+
+    response = client.get("/download/backup.tar", headers={"X-Password": "wrong" + password[5:]})
+    assert response.status_code == 401
+
+    response = client.get("/download/backup.tar")
+    assert response.status_code == 401
+
+    response = client.get("/download/..backup", headers={"X-Password": password})
+    assert response.status_code == 400
+
+    response = client.get("/download/other.tar", headers={"X-Password": password})
+    assert response.status_code == 404
+
+
+def test_download_response_gunicorn_range():
+    """Test that a range of a file sent by gunicorn is sent from the file and not wrapped."""
+    f = BytesIO(b"0123456789")
+    wrapper = GunicornFileWrapper(f)
+    response = DownloadResponse(wrapper, status=206)
+    response._wrap_range_response(4, 3)
+    assert response.response is wrapper
+    assert f.tell() == 4
+
+    response = DownloadResponse(MagicMock(), status=206)
+    response._wrap_range_response(4, 3)
+    assert not isinstance(response.response, GunicornFileWrapper)
+
+
+def test_werkzeug_has_wrap_range_response():
+    """Test that Werkzeug still has the private method DownloadResponse overrides."""
+    assert hasattr(Response, "_wrap_range_response")
+    assert DownloadResponse._wrap_range_response is not Response._wrap_range_response
+
+
+def test_download_range_gunicorn_file_wrapper(app, client, password, folder, upload_stream):
+    """Test that a ranged download under gunicorn is sent with the file wrapper of gunicorn."""
+    data = random.Random(1).randbytes(100000)
+    assert upload_stream(data, "backup.tar").status_code == 200
+
+    with app.test_request_context("/download/backup.tar", headers={"X-Password": password, "Range": "bytes=60000-"},
+                                  environ_overrides={"wsgi.file_wrapper": GunicornFileWrapper}):
+        response = app.full_dispatch_request()
+        try:
+            assert response.status_code == 206
+            assert isinstance(response.response, GunicornFileWrapper)
+            assert b"".join(response.response) == data[60000:]
+        finally:
+            response.close()
@@ -0,0 +1,151 @@
+from io import BytesIO
+import os
+import hashlib
+import shutil
+import tempfile
+import threading
+import time
+import pytest
+import toml
+from ddmail_backup_receiver import create_app
+from ddmail_backup_receiver import ingest_limit
+from ddmail_backup_receiver.ingest_limit import IngestLimiter
+
+
+@pytest.fixture
+def lock_folder():
+    """Temporary folder for the lock files of a limiter."""
+    folder = tempfile.mkdtemp()
+
+    yield folder
+
+    shutil.rmtree(folder)
+
+
+def test_limiter_queue(lock_folder):
+    """Test that uploads wait in the queue for a slot and is refused when the queue is full."""
+    limiter = IngestLimiter(lock_folder, 1, 1, 5)
+    first, retry_after = limiter.acquire()
+    assert first is not None
+
+    result = {}
+    waiting = threading.Thread(target=lambda: result.update(slot=limiter.acquire()[0]))
+    waiting.start()
+    time.sleep(0.2)
+
+    # The only slot and the only place in the queue is taken.
+    assert limiter.acquire() == (None, ingest_limit.DEFAULT_RETRY_AFTER)
+
+    limiter.release(first, 4.0)
+    waiting.join()
+    assert result["slot"] is not None
+    # 4 seconds per upload for the slot, the queue and the refused upload.
+    assert limiter.retry_after() == 12
+    limiter.release(result["slot"], 4.0)
+
+
+def test_limiter_timeout(lock_folder):
+    """Test that an upload that waits longer than the timeout is refused."""
+    limiter = IngestLimiter(lock_folder, 1, 1, 0.2)
+    first, retry_after = limiter.acquire()
+
+    start = time.monotonic()
+    assert limiter.acquire() == (None, ingest_limit.DEFAULT_RETRY_AFTER)
+    assert time.monotonic() - start >= 0.2
+    limiter.release(first, 1.0)
+
+
+def test_busy_upload(app, client, password, folder, lock_folder):
+    """Test that an upload gets 503 with Retry-After while all slots is used, and is saved when one is free."""
+    limiter = IngestLimiter(lock_folder, 1, 0, 0)
+    app.extensions["ingest_limiter"] = limiter
+    headers = {"X-Filename": "backup.tar", "X-Password": password, "X-Sha256": hashlib.sha256(b"data").hexdigest()}
+
+    slot, retry_after = limiter.acquire()
+    response = client.post("/receive_backup_stream", data=b"data", headers=headers)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(ingest_limit.DEFAULT_RETRY_AFTER)
+    assert response.data == b"error: server is busy"
+
+    limiter.release(slot, 1.0)
+    response = client.post("/receive_backup_stream", data=b"data", headers=headers)
+    assert response.status_code == 200
+    # The slot of the upload is released when the request ends.
+    assert limiter.try_slot() is not None
+
+
+def test_busy_parts(app, client, password, folder, lock_folder):
+    """Test that multipart parts, session chunks and deltas also wait for an ingest slot."""
+    limiter = IngestLimiter(lock_folder, 1, 0, 0)
+    app.extensions["ingest_limiter"] = limiter
+    form = {"password": password, "filename": "backup.tar", "sha256": hashlib.sha256(b"data").hexdigest()}
+    upload_id = client.post("/multipart/create", data=form).get_json()["upload_id"]
+    session_id = client.post("/upload_session/open", data=form).get_json()["session_id"]
+    sha256 = hashlib.sha256(b"data").hexdigest()
+    # The basis of the delta.
+    with open(os.path.join(folder, "backup.tar"), "wb") as f:
+        f.write(b"data")
+
+    slot, retry_after = limiter.acquire()
+    response = client.post("/multipart/part", data=b"data", headers={
+        "X-Password": password, "X-Upload-Id": upload_id, "X-Part-Number": "1", "X-Sha256": sha256,
+    })
+    assert response.status_code == 503
+    response = client.post("/upload_session/chunk", content_type='multipart/form-data', data={
+        "password": password, "session_id": session_id, "offset": "0", "sha256": sha256,
+        "file": (BytesIO(b"data"), "chunk"),
+    })
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
+    response = client.post("/delta/upload", data=b"data", headers={
+        "X-Password": password, "X-Filename": "backup2.tar", "X-Sha256": sha256, "X-Basis": "backup.tar",
+    })
+    assert response.status_code == 503
+
+    limiter.release(slot, 1.0)
+    response = client.post("/multipart/part", data=b"data", headers={
+        "X-Password": password, "X-Upload-Id": upload_id, "X-Part-Number": "1", "X-Sha256": sha256,
+    })
+    assert response.status_code == 200
+
+
+def test_busy_complete(app, client, password, folder, lock_folder):
+    """Test that completing a multipart upload and finalizing a session also wait for an ingest slot."""
+    limiter = IngestLimiter(lock_folder, 1, 0, 0)
+    app.extensions["ingest_limiter"] = limiter
+    sha256 = hashlib.sha256(b"data").hexdigest()
+    form = {"password": password, "filename": "backup.tar", "sha256": sha256}
+    upload_id = client.post("/multipart/create", data=form).get_json()["upload_id"]
+    session_id = client.post("/upload_session/open", data=form).get_json()["session_id"]
+    client.post("/multipart/part", data=b"data", headers={
+        "X-Password": password, "X-Upload-Id": upload_id, "X-Part-Number": "1", "X-Sha256": sha256,
+    })
+    client.post("/upload_session/chunk", content_type='multipart/form-data', data={
+        "password": password, "session_id": session_id, "offset": "0", "sha256": sha256,
+        "file": (BytesIO(b"data"), "chunk"),
+    })
+    complete = {"password": password, "upload_id": upload_id, "parts": "1"}
+    finalize = {"password": password, "session_id": session_id}
+
+    slot, retry_after = limiter.acquire()
+    response = client.post("/multipart/complete", data=complete)
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
+    response = client.post("/upload_session/finalize", data=finalize)
+    assert response.status_code == 503
+
+    limiter.release(slot, 1.0)
+    assert client.post("/multipart/complete", data=complete).data == b"done"
+    assert client.post("/upload_session/finalize", data=finalize).data == b"done"
+
+
+@pytest.mark.parametrize("key", ["INGEST_CONCURRENCY", "INGEST_QUEUE_SIZE"])
+def test_ingest_settings_must_be_whole_numbers(config_file, key):
+    """Test that a fraction of a slot or a place in the queue is refused at startup."""
+    config = toml.load(config_file)
+    config["TESTING"][key] = 2.5
+    with tempfile.NamedTemporaryFile('w', suffix=".toml") as f:
+        toml.dump(config, f)
+        f.flush()
+        with pytest.raises(SystemExit):
+            create_app(config_file=f.name)
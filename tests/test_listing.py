@@ -0,0 +1,56 @@
+import hashlib
+import pytest
+
+
+@pytest.fixture
+def folder(app, folder):
+    """Temporary upload folder that keeps 10 backups."""
+    app.config["BACKUPS_TO_SAVE"] = 10
+    return folder
+
+
+def test_list_backups(client, password, folder, upload_stream):
+    """Test that the listing is paginated and sorted and changes with uploads."""
+    for i, size in enumerate([30, 10, 20]):
+        assert upload_stream(b"x" * size, "backup" + str(i) + ".tar").status_code == 200
+
+    response = client.get("/backups", headers={"X-Password": password})
+    assert response.status_code == 200
+    listing = response.get_json()
+    assert [backup["name"] for backup in listing["backups"]] == ["backup2.tar", "backup1.tar", "backup0.tar"]
+    assert listing["total"] == 3
+    assert listing["latest"]["name"] == "backup2.tar"
+    assert listing["backups"][0]["checksum"] == hashlib.sha256(b"x" * 20).hexdigest()
+    assert listing["backups"][0]["checksum_algorithm"] == "sha256"
+    assert listing["backups"][0]["size"] == 20
+
+    response = client.get("/backups?sort=size&order=asc&per_page=2&page=2", headers={"X-Password": password})
+    listing = response.get_json()
+    assert [backup["name"] for backup in listing["backups"]] == ["backup0.tar"]
+    assert listing["pages"] == 2
+
+    response = client.get("/backups?sort=name&order=asc", headers={"X-Password": password})
+    etag = response.headers["ETag"]
+    assert [backup["name"] for backup in response.get_json()["backups"]] == ["backup0.tar", "backup1.tar",
+                                                                             "backup2.tar"]
+
+    response = client.get("/backups?sort=name&order=asc", headers={"X-Password": password, "If-None-Match": etag})
+    assert response.status_code == 304
+
+    assert upload_stream(b"new", "backup3.tar").status_code == 200
+    response = client.get("/backups?sort=name&order=asc", headers={"X-Password": password, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.get_json()["total"] == 4
+
+
+@pytest.mark.parametrize("query", ["page=0", "per_page=1001", "per_page=x", "sort=sha256", "order=up"])
+def test_list_backups_validation(client, password, folder, query):
+    """Test that invalid query parameters is refused."""
+    response = client.get("/backups?" + query, headers={"X-Password": password})
+    assert response.status_code == 400
+
+
+def test_list_backups_unauthenticated(client, folder):
+    """Test that the listing needs a password or token."""
+    response = client.get("/backups", headers={"X-Password": "wrong"})
+    assert response.status_code == 401
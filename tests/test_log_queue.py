@@ -0,0 +1,81 @@
+import logging
+import shutil
+import tempfile
+import threading
+import time
+from ddmail_backup_receiver.log_queue import DroppingQueueHandler
+from ddmail_backup_receiver.metrics import Metrics
+
+
+class BlockedHandler(logging.Handler):
+    """Handler that waits until it is released before it saves a record, like a stalled syslog."""
+
+    def __init__(self):
+        super().__init__()
+        self.released = threading.Event()
+        self.records = []
+
+    def emit(self, record):
+        self.released.wait()
+        self.records.append(record.getMessage())
+
+
+def make_logger(handler: logging.Handler) -> logging.Logger:
+    """Return a logger that only logs to handler."""
+    logger = logging.Logger("test_log_queue")
+    logger.addHandler(handler)
+    return logger
+
+
+def test_records_reach_handler():
+    """Test that records is written to the handler from the listener thread."""
+    target = BlockedHandler()
+    target.released.set()
+    handler = DroppingQueueHandler([target], 100)
+    make_logger(handler).warning("hello %s", "world")
+
+    handler.stop()
+    assert target.records == ["hello world"]
+    assert handler.dropped == 0
+
+
+def test_blocked_handler_do_not_block_logging():
+    """Test that logging returns at once when the handler is stalled and that overflow is dropped and counted."""
+    target = BlockedHandler()
+    handler = DroppingQueueHandler([target], 10)
+    logger = make_logger(handler)
+
+    start = time.monotonic()
+    for i in range(100):
+        logger.warning("record %d", i)
+    assert time.monotonic() - start < 1
+
+    # The listener holds one record while it waits and the queue holds 10.
+    assert 89 <= handler.dropped <= 90
+
+    target.released.set()
+    handler.stop()
+    assert len(target.records) + handler.dropped == 100
+    assert target.records[0] == "record 0"
+
+
+def test_dropped_metric(app):
+    """Test that dropped records is counted in ddmail_log_records_dropped_total."""
+    folder = tempfile.mkdtemp()
+    app.extensions["metrics"] = Metrics(folder)
+    target = BlockedHandler()
+    handler = DroppingQueueHandler([target], 1)
+    logger = make_logger(handler)
+
+    try:
+        with app.app_context():
+            for i in range(10):
+                logger.warning("record %d", i)
+
+        target.released.set()
+        handler.stop()
+        text = app.extensions["metrics"].exposition()
+        assert "ddmail_log_records_dropped_total " + str(handler.dropped) + "\n" in text
+        assert handler.dropped >= 8
+    finally:
+        shutil.rmtree(folder)
@@ -0,0 +1,117 @@
+import hashlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+import pytest
+from ddmail_backup_receiver import metrics
+from ddmail_backup_receiver.metrics import Metrics, ValuesFile, read_values_file
+
+
+@pytest.fixture
+def metrics_folder(app):
+    """Temporary metrics folder used by the app."""
+    folder = tempfile.mkdtemp()
+    app.extensions["metrics"] = Metrics(folder)
+
+    yield folder
+
+    shutil.rmtree(folder)
+
+
+def record_in_child(folder):
+    """Record metrics in a child process."""
+    child_metrics = Metrics(folder)
+    child_metrics.inc("ddmail_pruned_backups_total", 2)
+    child_metrics.observe("ddmail_sha256_duration_seconds", 0.2)
+
+
+def test_values_file(metrics_folder):
+    """Test that values are stored and read back, also after the file has grown."""
+    path = os.path.join(metrics_folder, "1.db")
+    values = ValuesFile(path)
+    values.add(b"a", 1.5)
+    values.add(b"a", 2)
+    for i in range(5000):
+        values.add(b"key " + str(i).encode(), i)
+
+    read = read_values_file(path)
+    assert read[b"a"] == 3.5
+    assert read[b"key 4999"] == 4999
+    assert len(read) == 5001
+
+    assert ValuesFile(path).positions.keys() == read.keys()
+
+
+def test_metrics_across_processes(metrics_folder):
+    """Test that the values of all processes are summed."""
+    parent_metrics = Metrics(metrics_folder)
+    parent_metrics.inc("ddmail_pruned_backups_total")
+    parent_metrics.observe("ddmail_sha256_duration_seconds", 0.002)
+
+    process = multiprocessing.get_context("fork").Process(target=record_in_child, args=(metrics_folder,))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+
+    text = parent_metrics.exposition()
+    assert "ddmail_pruned_backups_total 3\n" in text
+    assert 'ddmail_sha256_duration_seconds_bucket{le="0.001"} 0\n' in text
+    assert 'ddmail_sha256_duration_seconds_bucket{le="0.005"} 1\n' in text
+    assert 'ddmail_sha256_duration_seconds_bucket{le="0.25"} 2\n' in text
+    assert 'ddmail_sha256_duration_seconds_bucket{le="+Inf"} 2\n' in text
+    assert "ddmail_sha256_duration_seconds_count 2\n" in text
+    assert "# TYPE ddmail_request_duration_seconds histogram\n" in text
+
+
+def test_metrics_endpoint(app, client, password, metrics_folder):
+    """Test that requests, errors and stages of an upload are shown on /metrics."""
+    upload_folder = tempfile.mkdtemp()
+    app.config["UPLOAD_FOLDER"] = upload_folder
+    app.config["BACKUPS_TO_SAVE"] = 1
+    app.config["RETENTION_SYNC"] = True
+    try:
+        for i in range(2):
+            data = b"backup" + str(i).encode()
+            response = client.post("/receive_backup_stream", data=data, headers={
+                "X-Filename": "backup" + str(i) + ".tar",
+                "X-Password": password,
+                "X-Sha256": hashlib.sha256(data).hexdigest(),
+            })
+            assert response.status_code == 200
+        client.post("/receive_backup_stream", data=b"x", headers={
+            "X-Filename": "backup.tar",
+            "X-Password": password,
+            "X-Sha256": "0" * 64,
+        })
+        # Refused before the body is read, so its bytes is not received.
+        response = client.post("/receive_backup_stream", data=bytes(1000), headers={
+            "X-Filename": "backup.tar",
+            "X-Password": "wrong" + password[5:],
+            "X-Sha256": "0" * 64,
+        })
+        assert response.status_code == 401
+    finally:
+        shutil.rmtree(upload_folder)
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    text = response.get_data(as_text=True)
+    assert 'ddmail_request_duration_seconds_count{endpoint="application.receive_backup_stream"} 4\n' in text
+    assert 'ddmail_received_bytes_total{endpoint="application.receive_backup_stream"} 15\n' in text
+    assert ('ddmail_errors_total{endpoint="application.receive_backup_stream",'
+            'error="sha256 checksum do not match"} 1\n') in text
+    assert 'ddmail_save_duration_seconds_count{storage="plain"} 3\n' in text
+    assert "ddmail_pruned_backups_total 1\n" in text
+    assert "ddmail_retention_duration_seconds_count 2\n" in text
+    assert "metrics.metrics" not in text
+
+    app.config["METRICS"] = False
+    assert client.get("/metrics").status_code == 404
+
+
+def test_error_type():
+    """Test that paths and numbers are removed from error labels."""
+    assert metrics.error_type("upload folder /tmp/abc do not exist") == "upload folder do not exist"
+    assert metrics.error_type("part 12 is missing") == "part N is missing"
@@ -0,0 +1,144 @@
+import errno
+import hashlib
+import os
+import random
+from unittest.mock import patch
+import pytest
+from ddmail_backup_receiver import backup_index
+from ddmail_backup_receiver import multipart
+from ddmail_backup_receiver.application import open_stored_backup
+
+DATA = random.Random(1).randbytes(300000)
+PARTS = [DATA[:100000], DATA[100000:200000], DATA[200000:]]
+
+
+def create(test_client, password, data=DATA):
+    """Create a multipart upload of data and return the upload id."""
+    response = test_client.post("/multipart/create", data={
+        "password": password,
+        "filename": "backup.tar",
+        "sha256": hashlib.sha256(data).hexdigest(),
+    })
+    return response.get_json()["upload_id"]
+
+
+def send_part(test_client, password, upload_id, part_number, data, sha256=None):
+    """Send one part of a multipart upload."""
+    return test_client.post("/multipart/part", data=data, headers={
+        "X-Password": password,
+        "X-Upload-Id": upload_id,
+        "X-Part-Number": str(part_number),
+        "X-Sha256": sha256 or hashlib.sha256(data).hexdigest(),
+    })
+
+
+def complete(test_client, password, upload_id, parts=3):
+    """Complete a multipart upload."""
+    return test_client.post("/multipart/complete", data={
+        "password": password,
+        "upload_id": upload_id,
+        "parts": str(parts),
+    })
+
+
+@pytest.mark.parametrize("storage_mode", ["plain", "dedup"])
+def test_multipart_upload(app, client, password, folder, storage_mode):
+    """Test that parts sent out of order is joined in part number order."""
+    app.config["STORAGE_MODE"] = storage_mode
+    upload_id = create(client, password)
+
+    for part_number in [3, 1, 2]:
+        response = send_part(client, password, upload_id, part_number, PARTS[part_number - 1])
+        assert response.get_json() == {"part_number": part_number, "size": len(PARTS[part_number - 1])}
+
+    response = complete(client, password, upload_id)
+    assert b"done" in response.data
+
+    name = "backup.tar" if storage_mode == "plain" else "backup.tar.manifest"
+    assert sorted(os.listdir(folder)) == sorted([name, ".checksums", ".multipart_uploads"] + ([".chunks"] if storage_mode == "dedup" else []))
+    assert os.listdir(os.path.join(folder, ".multipart_uploads")) == []
+    backup = backup_index.get_backup(app.config["BACKUP_INDEX"], folder, name)
+    assert backup["sha256"] == hashlib.sha256(DATA).hexdigest()
+
+
+def test_copy_file_fallback(folder):
+    """Test that join_parts copies with read and write when copy_file_range is not supported."""
+    paths = []
+    for i, data in enumerate(PARTS):
+        paths.append(os.path.join(folder, "part-" + str(i)))
+        with open(paths[-1], 'wb') as f:
+            f.write(data)
+
+    with patch.object(multipart.os, "copy_file_range", side_effect=OSError(errno.EXDEV, "cross device")):
+        multipart.join_parts(paths, os.path.join(folder, "joined"))
+
+    with open(os.path.join(folder, "joined"), 'rb') as f:
+        assert f.read() == DATA
+
+
+def test_multipart_part_errors(client, password, folder):
+    """Test that damaged parts, bad part numbers and unknown uploads is refused."""
+    upload_id = create(client, password)
+
+    response = send_part(client, password, upload_id, 1, PARTS[0], hashlib.sha256(b"other").hexdigest())
+    assert response.status_code == 400
+    assert [name for name in os.listdir(os.path.join(folder, ".multipart_uploads", upload_id))] == ["upload.json"]
+
+    assert send_part(client, password, upload_id, 0, PARTS[0]).status_code == 400
+    assert send_part(client, password, upload_id, 10001, PARTS[0]).status_code == 400
+    assert send_part(client, password, "0" * 32, 1, PARTS[0]).status_code == 404
+    assert send_part(client, "wrong" + password[5:], upload_id, 1, PARTS[0]).status_code == 401
+
+
+def test_multipart_complete_errors(client, password, folder):
+    """Test that complete refuses missing parts and a wrong checksum of the joined file."""
+    upload_id = create(client, password)
+    send_part(client, password, upload_id, 1, PARTS[0])
+    send_part(client, password, upload_id, 2, PARTS[1])
+
+    response = complete(client, password, upload_id)
+    assert b"error: part 3 is missing" in response.data
+
+    response = complete(client, password, upload_id, 2)
+    assert b"error: sha256 checksum do not match" in response.data
+    assert not os.path.exists(os.path.join(folder, "backup.tar"))
+
+    response = client.post("/multipart/abort", data={"password": password, "upload_id": upload_id})
+    assert b"done" in response.data
+    assert os.listdir(os.path.join(folder, ".multipart_uploads")) == []
+
+
+@pytest.mark.parametrize("storage_mode", ["plain", "dedup"])
+def test_multipart_checksum_mismatch_keeps_backup(app, client, password, folder, storage_mode, upload_stream):
+    """Test that a joined file with a wrong checksum do not replace the stored backup with the same name."""
+    app.config["STORAGE_MODE"] = storage_mode
+    assert upload_stream(DATA, "backup.tar").status_code == 200
+    name = "backup.tar" if storage_mode == "plain" else "backup.tar.manifest"
+
+    upload_id = create(client, password)
+    for part_number, data in enumerate([PARTS[0], PARTS[2], PARTS[1]], 1):
+        send_part(client, password, upload_id, part_number, data)
+    response = complete(client, password, upload_id)
+    assert b"error: sha256 checksum do not match" in response.data
+
+    backup = backup_index.get_backup(app.config["BACKUP_INDEX"], folder, name)
+    assert backup["sha256"] == hashlib.sha256(DATA).hexdigest()
+    with app.app_context():
+        with open_stored_backup(folder, name) as f:
+            assert f.read() == DATA
+
+
+def test_multipart_part_disconnect(client, password, folder):
+    """Test that a part that fails while it is read leaves no temporary file behind."""
+    upload_id = create(client, password)
+
+    def broken_save(stream, path, buf_size, hasher):
+        with open(path, 'wb') as f:
+            f.write(stream.read(1000))
+        raise OSError("connection reset")
+
+    with patch("ddmail_backup_receiver.multipart.save_and_sha256", broken_save):
+        with pytest.raises(OSError):
+            send_part(client, password, upload_id, 1, PARTS[0])
+
+    assert os.listdir(os.path.join(folder, ".multipart_uploads", upload_id)) == ["upload.json"]
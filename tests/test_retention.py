@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+import threading
+from unittest.mock import MagicMock, patch
+from ddmail_backup_receiver import retention
+from ddmail_backup_receiver.retention import RetentionWorker, run_retention, schedule_retention
+
+
+def create_files(folder, count):
+    """Create count files in folder with increasing modification times."""
+    for i in range(count):
+        path = os.path.join(folder, "backup" + str(i) + ".tar")
+        with open(path, 'w') as f:
+            f.write(str(i))
+        os.utime(path, (1000 + i, 1000 + i))
+
+
+def test_run_retention(app):
+    """Test that run_retention removes old backups while holding the folder lock."""
+    folder = tempfile.mkdtemp()
+    try:
+        create_files(folder, 5)
+        with app.app_context():
+            app.logger = MagicMock()
+            run_retention(app, folder, 2)
+
+        assert sorted(os.listdir(folder)) == ["backup3.tar", "backup4.tar"]
+        assert os.path.exists(retention.retention_lock_path(app, folder))
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_retention_worker_coalesces(app):
+    """Test that prunes queued for a folder while the worker is busy are merged into one pass."""
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def fake_run_retention(app, folder, backups_to_save):
+        calls.append((folder, backups_to_save))
+        started.set()
+        release.wait(5)
+
+    worker = RetentionWorker(app)
+    with patch.object(retention, "run_retention", fake_run_retention):
+        worker.submit("/backups/a", 7)
+        assert started.wait(5)
+
+        # The worker is busy with the first prune, these are queued and merged.
+        worker.submit("/backups/a", 7)
+        worker.submit("/backups/a", 7)
+        worker.submit("/backups/b", 3)
+        worker.submit("/backups/a", 5)
+        release.set()
+
+        assert worker.wait_idle(5)
+
+    assert calls[0] == ("/backups/a", 7)
+    assert sorted(calls[1:]) == [("/backups/a", 5), ("/backups/b", 3)]
+
+
+def test_schedule_retention_async(app):
+    """Test that schedule_retention hands the prune to the background worker when RETENTION_SYNC is false."""
+    folder = tempfile.mkdtemp()
+    try:
+        create_files(folder, 4)
+        app.config["RETENTION_SYNC"] = False
+        worker = app.extensions["retention_worker"]
+
+        with app.app_context():
+            with patch.object(worker, "submit", wraps=worker.submit) as submit:
+                schedule_retention(folder, 1)
+                submit.assert_called_once_with(folder, 1)
+        assert worker.wait_idle(5)
+
+        assert os.listdir(folder) == ["backup3.tar"]
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_schedule_retention_sync(app):
+    """Test that schedule_retention removes old backups before returning when RETENTION_SYNC is true."""
+    folder = tempfile.mkdtemp()
+    try:
+        create_files(folder, 4)
+        app.config["RETENTION_SYNC"] = True
+
+        with app.app_context():
+            schedule_retention(folder, 2)
+
+        assert sorted(os.listdir(folder)) == ["backup2.tar", "backup3.tar"]
+    finally:
+        shutil.rmtree(folder)
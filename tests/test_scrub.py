@@ -0,0 +1,132 @@
+import hashlib
+import os
+import random
+import time
+from unittest.mock import patch
+import pytest
+from ddmail_backup_receiver import backup_index
+from ddmail_backup_receiver import scrub
+from ddmail_backup_receiver.scrub import Throttle
+
+
+@pytest.fixture
+def folder(app, folder):
+    """Temporary upload folder and no result of an earlier scrub pass."""
+    app.config["SCRUB_RATE_MB"] = 0
+    if os.path.exists(scrub.status_path(app)):
+        os.remove(scrub.status_path(app))
+
+    yield folder
+
+    if os.path.exists(scrub.status_path(app)):
+        os.remove(scrub.status_path(app))
+
+
+@pytest.mark.parametrize("storage_mode", ["plain", "dedup"])
+def test_run_scrub(app, client, password, folder, storage_mode, upload_stream):
+    """Test that intact backups is verified and a changed backup is reported."""
+    app.config["STORAGE_MODE"] = storage_mode
+    data = random.Random(1).randbytes(300000)
+    assert upload_stream(data, "backup1.tar").status_code == 200
+    assert upload_stream(data[::-1], "backup2.tar").status_code == 200
+
+    with app.app_context():
+        status = scrub.run_scrub(app)
+    assert status["verified"] == 2
+    assert status["failed"] == []
+    assert status["bytes"] == 2 * len(data)
+
+    if storage_mode == "plain":
+        with open(os.path.join(folder, "backup1.tar"), 'r+b') as f:
+            f.write(b"x")
+        failed_path = os.path.join(folder, "backup1.tar")
+    else:
+        os.remove(os.path.join(folder, "backup2.tar.manifest"))
+        failed_path = os.path.join(folder, "backup2.tar.manifest")
+
+    with app.app_context():
+        status = scrub.run_scrub(app)
+    assert status["verified"] == 1
+    assert [failed["path"] for failed in status["failed"]] == [failed_path]
+    assert scrub.read_status(app) == status
+
+
+def test_rejected_upload_has_no_sidecar(app, client, password, folder, upload_stream):
+    """Test that an upload with a wrong checksum leaves no index row or sidecar and keeps the sidecar of the stored backup."""
+    data = random.Random(1).randbytes(1000)
+    assert upload_stream(data, "backup1.tar").status_code == 200
+
+    for filename in ("backup1.tar", "backup2.tar"):
+        response = client.post("/receive_backup_stream", data=data[::-1], headers={
+            "X-Filename": filename,
+            "X-Password": password,
+            "X-Sha256": hashlib.sha256(data).hexdigest(),
+        })
+        assert response.status_code == 400
+
+    assert backup_index.get_backup(app.config["BACKUP_INDEX"], folder, "backup2.tar") is None
+    assert os.listdir(backup_index.sidecar_folder(folder)) == ["backup1.tar"]
+    assert backup_index.read_sidecar(folder, "backup1.tar") == hashlib.sha256(data).hexdigest()
+
+    with app.app_context():
+        status = scrub.run_scrub(app)
+    assert status["verified"] == 1
+    assert status["failed"] == []
+
+
+def test_run_scrub_reuploaded_backup(app, client, password, folder, upload_stream):
+    """Test that a backup uploaded again during the pass is not reported as failed."""
+    data = random.Random(1).randbytes(1000)
+    assert upload_stream(data, "backup1.tar").status_code == 200
+    verify_backup = scrub.verify_backup
+
+    def reupload_and_verify(folder, name, checksum, throttle):
+        # The backup is replaced after the pass listed it.
+        with open(os.path.join(folder, name), 'wb') as f:
+            f.write(data[::-1])
+        os.utime(os.path.join(folder, name), (time.time() + 10, time.time() + 10))
+        backup_index.add_backup(app.config["BACKUP_INDEX"], folder, name, hashlib.sha256(data[::-1]).hexdigest())
+        return verify_backup(folder, name, checksum, throttle)
+
+    with patch("ddmail_backup_receiver.scrub.verify_backup", reupload_and_verify):
+        with app.app_context():
+            status = scrub.run_scrub(app)
+    assert status["verified"] == 0
+    assert status["failed"] == []
+
+
+def test_run_scrub_locked(app, folder):
+    """Test that a pass is skipped while another process holds the lock."""
+    import fcntl
+    with open(os.path.join(app.instance_path, scrub.SCRUB_LOCK_NAME), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        with app.app_context():
+            assert scrub.run_scrub(app) is None
+
+
+def test_throttle():
+    """Test that reads is paced to the rate."""
+    throttle = Throttle(1000000)
+    start = time.monotonic()
+    for _ in range(5):
+        throttle.consume(40000)
+    assert time.monotonic() - start >= 0.19
+    assert throttle.done == 200000
+
+
+def test_scrub_status(app, client, password, folder, upload_stream):
+    """Test that the result of the last pass can be read with the default password."""
+    response = client.get("/scrub/status")
+    assert response.status_code == 401
+
+    response = client.get("/scrub/status", headers={"X-Password": password})
+    assert response.status_code == 200
+    assert response.get_json()["finished"] is None
+
+    assert upload_stream(b"data", "backup.tar").status_code == 200
+    with app.app_context():
+        scrub.run_scrub(app)
+
+    response = client.get("/scrub/status", headers={"X-Password": password})
+    assert response.get_json()["verified"] == 1
+    assert response.get_json()["failed"] == []
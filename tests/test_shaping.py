@@ -0,0 +1,160 @@
+import hashlib
+from io import BytesIO
+import os
+import threading
+import time
+import pytest
+from ddmail_backup_receiver import shaping
+from ddmail_backup_receiver.shaping import MB, Shaper, ShapedStream, TokenBucket, allocate, water_fill
+
+INF = float("inf")
+
+
+@pytest.fixture
+def shaper(app):
+    """Shaper with a global limit of 8 MB/s and no uploads from earlier tests."""
+    app.config["RATE_LIMIT_MB"] = 8
+    path = os.path.join(app.instance_path, shaping.STREAMS_NAME)
+    if os.path.exists(path):
+        os.remove(path)
+
+    yield Shaper(app)
+
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class Sender:
+    """Client that sends as fast as it can, or at most rate bytes per second."""
+
+    def __init__(self, rate: float = INF):
+        self.rate = rate
+        self.sent = 0
+        self.start = time.monotonic()
+
+    def read(self, size: int) -> bytes:
+        if self.rate != INF:
+            time.sleep(max(0.0, self.start + (self.sent + size) / self.rate - time.monotonic()))
+        self.sent += size
+        return bytes(size)
+
+
+def run_senders(shaper: Shaper, senders: list, duration: float) -> list:
+    """Read from every (client, cap, sender) at the same time for duration seconds and return the bytes per second of each."""
+    received = [0] * len(senders)
+    end = time.monotonic() + duration
+
+    def read(i, client, cap, sender):
+        stream = ShapedStream(sender, shaper, client, cap)
+        while time.monotonic() < end:
+            received[i] += len(stream.read(65536))
+        stream.close()
+
+    threads = [threading.Thread(target=read, args=(i,) + sender) for i, sender in enumerate(senders)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [size / duration for size in received]
+
+
+def test_water_fill():
+    """Test that what a key do not use is shared by the others."""
+    assert water_fill(12, {"a": INF, "b": INF, "c": INF}) == {"a": 4, "b": 4, "c": 4}
+    assert water_fill(12, {"a": 2, "b": INF, "c": INF}) == {"a": 2, "b": 5, "c": 5}
+    assert water_fill(INF, {"a": 2, "b": INF}) == {"a": 2, "b": INF}
+
+
+def test_allocate():
+    """Test that the rate is shared between clients first and then between the uploads of a client."""
+    rates = allocate({
+        "a1": {"client": "a", "cap": INF, "demand": INF},
+        "a2": {"client": "a", "cap": INF, "demand": INF},
+        "a3": {"client": "a", "cap": INF, "demand": INF},
+        "b1": {"client": "b", "cap": INF, "demand": INF},
+        "c1": {"client": "c", "cap": 1, "demand": INF},
+    }, 9)
+    assert rates == pytest.approx({"a1": 4 / 3, "a2": 4 / 3, "a3": 4 / 3, "b1": 4, "c1": 1})
+
+
+def test_token_bucket():
+    """Test that the bucket sleeps when more is taken than the rate allows."""
+    bucket = TokenBucket(1000000)
+    start = time.monotonic()
+    for _ in range(10):
+        bucket.consume(65536)
+    # The bucket starts with one read of tokens.
+    assert time.monotonic() - start >= 9 * 65536 / 1000000 * 0.95
+
+
+def test_fair_sharing(shaper):
+    """Test that concurrent uploads of different clients get the same share of the global limit."""
+    rates = run_senders(shaper, [("a", INF, Sender()), ("b", INF, Sender()), ("c", INF, Sender())], 1.5)
+
+    assert 6 * MB < sum(rates) < 10 * MB
+    # Jain's fairness index, 1 is a perfectly fair share.
+    assert sum(rates) ** 2 / (len(rates) * sum(rate ** 2 for rate in rates)) > 0.95
+
+
+def test_idle_capacity_is_shared(shaper):
+    """Test that what a slow client do not use is given to the others."""
+    rates = run_senders(shaper, [("a", INF, Sender()), ("b", INF, Sender()), ("slow", INF, Sender(1 * MB))], 2)
+
+    assert rates[2] < 1.2 * MB
+    # The fast clients get more than a third of the limit each.
+    assert rates[0] > 3 * MB and rates[1] > 3 * MB
+
+
+def test_client_limit(shaper):
+    """Test that a client limit is kept while the global limit is shared by the others."""
+    rates = run_senders(shaper, [("a", 1 * MB, Sender()), ("b", INF, Sender())], 1.5)
+
+    assert rates[0] < 1.3 * MB
+    assert rates[1] > 5 * MB
+
+
+def test_shaped_upload(app, client, password, folder, shaper):
+    """Test that an upload is read through the shaper and removed from it when it is done."""
+    app.extensions["shaper"] = shaper
+    data = bytes(3 * MB)
+    start = time.monotonic()
+    response = client.post("/receive_backup_stream", data=data, headers={
+        "X-Filename": "backup.tar",
+        "X-Password": password,
+        "X-Sha256": hashlib.sha256(data).hexdigest(),
+    })
+    assert response.status_code == 200
+    # 3 MB at 8 MB/s.
+    assert time.monotonic() - start >= 0.3
+
+    with shaper.lock() as streams:
+        assert streams == {}
+
+
+def test_shaped_part_and_chunk(app, client, password, folder, shaper):
+    """Test that multipart parts and session chunks is read through the shaper."""
+    app.extensions["shaper"] = shaper
+    data = bytes(3 * MB)
+    sha256 = hashlib.sha256(data).hexdigest()
+    form = {"password": password, "filename": "backup.tar", "sha256": sha256}
+    upload_id = client.post("/multipart/create", data=form).get_json()["upload_id"]
+    session_id = client.post("/upload_session/open", data=form).get_json()["session_id"]
+
+    start = time.monotonic()
+    response = client.post("/multipart/part", data=data, headers={
+        "X-Password": password, "X-Upload-Id": upload_id, "X-Part-Number": "1", "X-Sha256": sha256,
+    })
+    assert response.status_code == 200
+    # 3 MB at 8 MB/s.
+    assert time.monotonic() - start >= 0.3
+
+    start = time.monotonic()
+    response = client.post("/upload_session/chunk", content_type='multipart/form-data', data={
+        "password": password, "session_id": session_id, "offset": "0", "sha256": sha256,
+        "file": (BytesIO(data), "chunk"),
+    })
+    assert response.status_code == 200
+    assert time.monotonic() - start >= 0.3
+
+    with shaper.lock() as streams:
+        assert streams == {}
@@ -0,0 +1,100 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import pstats
+import shutil
+import sys
+import tempfile
+from unittest.mock import patch
+import pytest
+from ddmail_backup_receiver import tracing
+from ddmail_backup_receiver.tracing import RequestTrace
+
+
+def slow_request_logs(caplog):
+    """Return the breakdowns of the slow request log records."""
+    return [json.loads(record.getMessage()[len("slow request "):]) for record in caplog.records
+            if record.getMessage().startswith("slow request ")]
+
+
+def test_request_trace():
+    """Test that marking a stage again adds to it and the rest is counted as other."""
+    trace = RequestTrace()
+    trace.mark("validation")
+    trace.mark("save")
+    trace.mark("validation")
+    stages = trace.breakdown()
+    assert list(stages) == ["validation", "save", "other"]
+    assert all(seconds >= 0 for seconds in stages.values())
+
+
+def test_slow_request_log(app, client, password, folder, caplog, monkeypatch, upload_stream):
+    """Test that the stages of an upload is logged when it is over SLOW_REQUEST_THRESHOLD."""
+    # dictConfig in create_app disables the loggers of apps created by earlier tests.
+    monkeypatch.setattr(app.logger, "disabled", False)
+    app.config["SLOW_REQUEST_THRESHOLD"] = 0
+    with caplog.at_level(logging.WARNING):
+        assert upload_stream(b"data", "backup.tar").status_code == 200
+        response = client.post("/receive_backup", data={
+            "file": (tempfile.SpooledTemporaryFile(), "backup2.tar"),
+            "filename": "backup2.tar",
+            "password": password,
+            "sha256": hashlib.sha256(b"").hexdigest(),
+        }, content_type="multipart/form-data")
+        assert response.data == b"done"
+
+    stream_log, form_log = slow_request_logs(caplog)
+    assert stream_log["endpoint"] == "application.receive_backup_stream"
+    assert stream_log["status"] == 200
+    assert list(stream_log["stages"]) == ["auth", "validation", "queue", "save", "index", "retention", "other"]
+    assert form_log["endpoint"] == "application.receive_backup"
+    assert list(form_log["stages"]) == ["auth", "queue", "receive", "validation", "save", "index", "retention",
+                                        "other"]
+    assert abs(sum(form_log["stages"].values()) - form_log["duration"]) < 0.001
+
+    caplog.clear()
+    app.config["SLOW_REQUEST_THRESHOLD"] = 60
+    with caplog.at_level(logging.WARNING):
+        assert upload_stream(b"data", "backup3.tar").status_code == 200
+    assert slow_request_logs(caplog) == []
+
+
+def test_profile_sample(app, client, password, folder, upload_stream):
+    """Test that a profile is saved in the instance folder for sampled requests."""
+    profiles = tempfile.mkdtemp()
+    instance_path = app.instance_path
+    app.instance_path = profiles
+    app.config["PROFILE_SAMPLE_RATE"] = 1
+    try:
+        assert upload_stream(b"data", "backup.tar").status_code == 200
+        paths = glob.glob(os.path.join(profiles, tracing.PROFILES_FOLDER_NAME, "*.prof"))
+        assert len(paths) == 1
+        assert "application.receive_backup_stream" in os.path.basename(paths[0])
+        assert pstats.Stats(paths[0]).total_calls > 0
+
+        app.config["PROFILE_SAMPLE_RATE"] = 0
+        assert upload_stream(b"data", "backup2.tar").status_code == 200
+        assert len(glob.glob(os.path.join(profiles, tracing.PROFILES_FOLDER_NAME, "*.prof"))) == 1
+    finally:
+        app.instance_path = instance_path
+        shutil.rmtree(profiles)
+
+
+def test_profile_stopped_when_view_raise(app, client, password, folder, upload_stream):
+    """Test that the profiler is stopped and the profile saved when the view raise."""
+    profiles = tempfile.mkdtemp()
+    instance_path = app.instance_path
+    app.instance_path = profiles
+    app.config["PROFILE_SAMPLE_RATE"] = 1
+    try:
+        with patch("ddmail_backup_receiver.application.store_backup", side_effect=RuntimeError("broken")):
+            with pytest.raises(RuntimeError):
+                upload_stream(b"data", "backup.tar")
+        assert sys.getprofile() is None
+        assert len(glob.glob(os.path.join(profiles, tracing.PROFILES_FOLDER_NAME, "*.prof"))) == 1
+    finally:
+        app.config["PROFILE_SAMPLE_RATE"] = 0
+        app.instance_path = instance_path
+        shutil.rmtree(profiles)
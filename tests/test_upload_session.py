@@ -0,0 +1,206 @@
+from io import BytesIO
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import pytest
+from ddmail_backup_receiver.upload_session import remove_stale_sessions
+
+# Test data that is uploaded in chunks.
+DATA = bytes(range(256)) * 400
+SHA256 = hashlib.sha256(DATA).hexdigest()
+FILENAME = "chunked_backup.bin"
+
+
+@pytest.fixture
+def upload_folder(app):
+    """Use a temporary upload folder for the test."""
+    folder = tempfile.mkdtemp()
+    app.config["UPLOAD_FOLDER"] = folder
+
+    yield folder
+
+    shutil.rmtree(folder)
+
+
+def open_session(client, password, sha256=SHA256):
+    """Open an upload session and return the response."""
+    return client.post(
+        "/upload_session/open",
+        content_type='multipart/form-data',
+        data={"password": password, "filename": FILENAME, "sha256": sha256}
+        )
+
+
+def send_chunk(client, password, session_id, offset, data, sha256=None):
+    """Send a chunk of an upload session and return the response."""
+    if sha256 is None:
+        sha256 = hashlib.sha256(data).hexdigest()
+
+    return client.post(
+        "/upload_session/chunk",
+        content_type='multipart/form-data',
+        data={
+            "password": password,
+            "session_id": session_id,
+            "offset": str(offset),
+            "sha256": sha256,
+            "file": (BytesIO(data), "chunk"),
+            }
+        )
+
+
+def test_upload_session(client, password, upload_folder):
+    """Test that a backup uploaded in chunks is stored when the session is finalized.
+
+    Opens a session, sends the data in two chunks, checks the status and finalizes
+    the session. Verifies that the stored file is identical to the uploaded data and
+    that the session folder is removed.
+    """
+    response = open_session(client, password)
+    assert response.status_code == 200
+    session_id = response.get_json()["session_id"]
+    assert response.get_json()["offset"] == 0
+
+    response = send_chunk(client, password, session_id, 0, DATA[:50000])
+    assert response.get_json()["offset"] == 50000
+
+    response = client.post(
+        "/upload_session/status",
+        data={"password": password, "session_id": session_id}
+        )
+    assert response.get_json()["offset"] == 50000
+
+    response = send_chunk(client, password, session_id, 50000, DATA[50000:])
+    assert response.get_json()["offset"] == len(DATA)
+
+    response = client.post(
+        "/upload_session/finalize",
+        data={"password": password, "session_id": session_id}
+        )
+    assert response.status_code == 200
+    assert b"done" in response.data
+
+    with open(os.path.join(upload_folder, FILENAME), 'rb') as f:
+        assert f.read() == DATA
+    assert os.listdir(os.path.join(upload_folder, ".upload_sessions")) == []
+
+
+def test_upload_session_header_credentials(client, password, upload_folder):
+    """Test that a chunk can be sent with credentials in headers, which is checked before the body is read."""
+    session_id = open_session(client, password).get_json()["session_id"]
+    form = {
+        "session_id": session_id,
+        "offset": "0",
+        "sha256": hashlib.sha256(DATA[:1000]).hexdigest(),
+        "file": (BytesIO(DATA[:1000]), "chunk"),
+    }
+
+    response = client.post("/upload_session/chunk", content_type='multipart/form-data',
+                           headers={"X-Password": "wrong" + password[5:]}, data=dict(form))
+    assert response.status_code == 401
+
+    form["file"] = (BytesIO(DATA[:1000]), "chunk")
+    response = client.post("/upload_session/chunk", content_type='multipart/form-data',
+                           headers={"X-Password": password}, data=form)
+    assert response.get_json()["offset"] == 1000
+
+
+def test_upload_session_damaged_chunk(client, password, upload_folder):
+    """Test that a chunk with the wrong checksum is discarded.
+
+    Sends a chunk with a checksum that do not match the data and verifies that the
+    error is returned and the upload can be resumed from the same offset.
+    """
+    session_id = open_session(client, password).get_json()["session_id"]
+    send_chunk(client, password, session_id, 0, DATA[:1000])
+
+    response = send_chunk(client, password, session_id, 1000, DATA[1000:2000], sha256=SHA256)
+    assert b"error: sha256 checksum do not match" in response.data
+
+    response = client.post(
+        "/upload_session/status",
+        data={"password": password, "session_id": session_id}
+        )
+    assert response.get_json()["offset"] == 1000
+
+
+def test_upload_session_resend_chunk(client, password, upload_folder):
+    """Test that a chunk can be sent again at an offset before the end of the received data."""
+    session_id = open_session(client, password).get_json()["session_id"]
+    send_chunk(client, password, session_id, 0, DATA[:3000])
+
+    response = send_chunk(client, password, session_id, 1000, DATA[1000:])
+    assert response.get_json()["offset"] == len(DATA)
+
+    response = client.post(
+        "/upload_session/finalize",
+        data={"password": password, "session_id": session_id}
+        )
+    assert b"done" in response.data
+
+
+def test_upload_session_offset_after_end(client, password, upload_folder):
+    """Test that a chunk sent after the end of the received data is refused."""
+    session_id = open_session(client, password).get_json()["session_id"]
+
+    response = send_chunk(client, password, session_id, 10, DATA[10:20])
+    assert b"error: offset is after end of received data" in response.data
+
+
+def test_upload_session_finalize_wrong_checksum(client, password, upload_folder):
+    """Test that finalize refuses a session when the received data do not match the checksum."""
+    wrong_sha256 = "1" * 64
+    session_id = open_session(client, password, sha256=wrong_sha256).get_json()["session_id"]
+    send_chunk(client, password, session_id, 0, DATA)
+
+    response = client.post(
+        "/upload_session/finalize",
+        data={"password": password, "session_id": session_id}
+        )
+    assert b"error: sha256 checksum do not match" in response.data
+    assert not os.path.exists(os.path.join(upload_folder, FILENAME))
+
+
+def test_upload_session_wrong_password(client, upload_folder):
+    """Test that an upload session can not be opened with the wrong password."""
+    response = open_session(client, "thisiswrongpassword12345")
+    assert b"error: wrong password" in response.data
+
+
+def test_upload_session_unknown_session(client, password, upload_folder):
+    """Test that chunks for invalid or unknown sessions are refused."""
+    response = send_chunk(client, password, "../../etc", 0, DATA)
+    assert b"error: session_id validation failed" in response.data
+
+    response = send_chunk(client, password, "0" * 32, 0, DATA)
+    assert b"error: upload session do not exist" in response.data
+
+
+def test_remove_stale_sessions(app, client, password, upload_folder):
+    """Test that only sessions where no data has been received for max_age is removed, and not while they are locked."""
+    session_id = open_session(client, password).get_json()["session_id"]
+    send_chunk(client, password, session_id, 0, DATA[:100])
+    folder = os.path.join(upload_folder, ".upload_sessions")
+    session_folder = os.path.join(folder, session_id)
+
+    # The session was opened long ago but data.part was just written.
+    old = time.time() - 1000
+    for path in (session_folder, os.path.join(session_folder, "session.json")):
+        os.utime(path, (old, old))
+    with app.app_context():
+        remove_stale_sessions(folder, 100)
+    assert os.path.isdir(session_folder)
+
+    os.utime(os.path.join(session_folder, "data.part"), (old, old))
+    with open(os.path.join(session_folder, "lock"), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        with app.app_context():
+            remove_stale_sessions(folder, 100)
+        assert os.path.isdir(session_folder)
+
+    with app.app_context():
+        remove_stale_sessions(folder, 100)
+    assert not os.path.exists(session_folder)